@@ -1,16 +1,76 @@
+import argparse
+import asyncio
+import math
+import queue
+import selectors
 import socket
 import json
+import threading
 import time
 
+from rl_algorithms import ALGORITHMS, make_limiter
+from rl_rules import load_rules
+from rl_service import ServiceStore, SyncedWindowCounter
+from rl_store import SharedMemoryStore, ShardedStore
+
 HOST = "127.0.0.1"
 PORT = 5050
 
+# serial handles one connection at a time; threaded and asyncio serve many, with keep-alive
+ENGINES = ("serial", "threaded", "asyncio")
+ENGINE = "threaded"
+WORKERS = 64
+MAX_CONNECTIONS = 10_000
+BACKLOG = socket.SOMAXCONN
+CLIENT_TIMEOUT = 5.0
+MAX_HEAD = 8192
+VERBOSE = True
+
 RATE_LIMIT = 1         
 TIME_WINDOW = 10
+# sliding_log (exact, a list per IP), sliding_window, token_bucket or gcra; see rl_algorithms.py
+ALGORITHM = "sliding_window"
+# idle clients are forgotten once their window has passed; past MAX_CLIENTS the least recent go first
+MAX_CLIENTS = 1_000_000
+# where the counts live; anything but memory is shared by every copy of the server, see open_limiter
+STORE = "memory"
+
+client_requests = ShardedStore(max_keys=MAX_CLIENTS)
+limiter = make_limiter(ALGORITHM, RATE_LIMIT, TIME_WINDOW, client_requests)
+# a rl_rules.RuleEngine (--rules FILE) replaces the single per-IP limit above
+rules = None
+
+def open_limiter(algorithm, store, max_clients):
+    """(client table, limiter) for a --store spec:
+
+    memory             this process only
+    shm:PATH           a memory-mapped file shared by every process on the host
+    service:HOST:PORT  the rl_service.py limiter service, one round trip per check
+    synced:HOST:PORT   local counts synced with the service in the background (approximate)
+    """
+    kind, _, where = store.partition(":")
+    if kind == "memory":
+        table = ShardedStore(max_keys=max_clients)
+    elif kind == "shm":
+        if algorithm == "sliding_log":
+            raise ValueError("sliding_log keeps a list per client and cannot live in shared memory")
+        table = SharedMemoryStore(where or "/dev/shm/apirate_limit", slots=max_clients)
+    elif kind in ("service", "synced"):
+        host, _, port = where.rpartition(":")
+        if not host or not port.isdigit():
+            raise ValueError(f"--store {store}: expected {kind}:HOST:PORT")
+        if kind == "synced":
+            if algorithm != "sliding_window":
+                raise ValueError(f"--store synced only counts with --algorithm sliding_window, not {algorithm}")
+            limiter = SyncedWindowCounter(RATE_LIMIT, TIME_WINDOW, host, int(port))
+            return limiter, limiter
+        table = ServiceStore(host, int(port))
+    else:
+        raise ValueError(f"unknown --store {store!r}")
+    return table, make_limiter(algorithm, RATE_LIMIT, TIME_WINDOW, table)
 
-client_requests = {}
 
-def build_response(status_code, data=None, message=None):
+def build_response(status_code, data=None, message=None, extra_headers=(), keep_alive=False):
     status_messages = {
         200: "OK",
         400: "Bad Request",
@@ -31,7 +91,8 @@ def build_response(status_code, data=None, message=None):
         status_line,
         "Content-Type: application/json",
         f"Content-Length: {len(body)}",
-        "Connection: close",
+        "Connection: keep-alive" if keep_alive else "Connection: close",
+        *extra_headers,
         "",
         ""
     ]
@@ -39,18 +100,48 @@ def build_response(status_code, data=None, message=None):
 
 
 def is_rate_limited(client_ip):
-    now = time.time()
-    request_times = client_requests.get(client_ip, [])
+    return limiter.is_limited(client_ip)
+
 
-    request_times = [t for t in request_times if now - t < TIME_WINDOW]
+def respond(request, client_ip, keep_alive=False):
+    """The response for one request head (str); keep_alive is honoured unless the client asked to close."""
+    lines = request.splitlines()
+    parts = lines[0].split(" ") if lines else []
 
-    if len(request_times) >= RATE_LIMIT:
-        client_requests[client_ip] = request_times 
-        return True
+    if len(parts) != 3:
+        return build_response(400), False
 
-    request_times.append(now)
-    client_requests[client_ip] = request_times
-    return False
+    method, path, version = parts
+    if VERBOSE:
+        print(f"→ {method} {path} from {client_ip}")
+    headers = {}
+    if keep_alive or rules is not None:
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+    if keep_alive:
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close" \
+            and "content-length" not in headers and "transfer-encoding" not in headers
+
+    if method != "GET":
+        return build_response(405, keep_alive=keep_alive), keep_alive
+
+    if rules is not None:
+        wait, rule = rules.check(client_ip, method, path.split("?", 1)[0], headers)
+        error = {"error": "Rate limit exceeded. Try again later.", "rule": rule and rule.name}
+    else:
+        wait = limiter.check(client_ip)
+        error = {"error": "Rate limit exceeded. Try again later."}
+    if wait > 0:
+        return build_response(429, error, extra_headers=[f"Retry-After: {math.ceil(wait)}"],
+                              keep_alive=keep_alive), keep_alive
+
+    data = {
+        "message": "Request successful!",
+        "time": time.strftime("%H:%M:%S"),
+        "client_ip": client_ip
+    }
+    return build_response(200, data, keep_alive=keep_alive), keep_alive
 
 
 def handle_request(client_socket, client_ip):
@@ -58,29 +149,7 @@ def handle_request(client_socket, client_ip):
         request = client_socket.recv(1024).decode("utf-8")
         if not request:
             return
-
-        request_line = request.splitlines()[0]
-        parts = request_line.split(" ")
-
-        if len(parts) < 3:
-            response = build_response(400)
-        else:
-            method, path, _ = parts
-            print(f"→ {method} {path} from {client_ip}")
-
-            if method != "GET":
-                response = build_response(405)
-            else:
-                if is_rate_limited(client_ip):
-                    response = build_response(429, {"error": "Rate limit exceeded. Try again later."})
-                else:
-                    data = {
-                        "message": "Request successful!",
-                        "time": time.strftime("%H:%M:%S"),
-                        "client_ip": client_ip
-                    }
-                    response = build_response(200, data)
-
+        response, _ = respond(request, client_ip)
         client_socket.sendall(response.encode("utf-8"))
 
     except Exception as e:
@@ -91,30 +160,263 @@ def handle_request(client_socket, client_ip):
         client_socket.close()
 
 
-def start_server():
+class Connection:
+    __slots__ = ("sock", "ip", "buffer", "idle_since")
+
+    def __init__(self, sock, ip):
+        self.sock = sock
+        self.ip = ip
+        self.buffer = b""
+        self.idle_since = time.monotonic()
+
+
+def serve_ready(conn):
+    """Answers the requests that have arrived on a readable connection; False once it should close."""
+    try:
+        chunk = conn.sock.recv(65536)
+        if not chunk:
+            return False
+        conn.buffer += chunk
+        while True:
+            end = conn.buffer.find(b"\r\n\r\n")
+            if end < 0:
+                if len(conn.buffer) > MAX_HEAD:
+                    conn.sock.sendall(build_response(400).encode("utf-8"))
+                    return False
+                return True
+            head, conn.buffer = conn.buffer[:end].decode("latin-1"), conn.buffer[end + 4:]
+            response, keep_alive = respond(head, conn.ip, keep_alive=True)
+            conn.sock.sendall(response.encode("utf-8"))
+            if not keep_alive:
+                return False
+    except (socket.timeout, ConnectionError):
+        return False
+    except Exception as e:
+        print(f"Error: {e}")
+        return False
+
+
+def open_server_socket():
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind((HOST, PORT))
-    server_socket.listen(5)
+    server_socket.listen(BACKLOG)
     server_socket.settimeout(1.0)
+    return server_socket
 
-    print(f"🚦 Rate-Limited API Server running on http://{HOST}:{PORT}")
-    print(f"→ Limit: {RATE_LIMIT} requests per {TIME_WINDOW} seconds")
-    print("Press Ctrl+C to stop.\n")
 
+def accept_loop(server_socket, handle):
     try:
         while True:
             try:
                 client_conn, client_addr = server_socket.accept()
                 client_ip = client_addr[0]
-                handle_request(client_conn, client_ip)
+                handle(client_conn, client_ip)
             except socket.timeout:
+                # idle: a good moment to drop clients whose window has passed
+                client_requests.sweep()
                 continue
     except KeyboardInterrupt:
         print("\nServer shutting down...")
+        print(f"Clients: {client_requests.stats()}")
     finally:
         server_socket.close()
         print("Server closed.")
 
 
+def serve_threaded(server_socket):
+    """A selector watches every open connection and WORKERS threads answer the ones with a request.
+
+    A keep-alive connection only holds a worker while its request is being
+    answered, then goes back to the selector, so idle clients cost a file
+    descriptor rather than a thread and never keep new ones waiting. Past
+    MAX_CONNECTIONS (or out of file descriptors) the selector stops
+    accepting and new connections wait in the listen backlog.
+    """
+    selector = selectors.DefaultSelector()
+    ready = queue.SimpleQueue()
+    # workers hand connections back through `done` and wake the selector through the socket pair
+    done = queue.SimpleQueue()
+    wake_read, wake_write = socket.socketpair()
+    wake_read.setblocking(False)
+    wake_write.setblocking(False)
+    open_connections = 0
+    paused = False
+
+    def worker():
+        while True:
+            conn = ready.get()
+            done.put((conn, serve_ready(conn)))
+            try:
+                wake_write.send(b"\0")
+            except BlockingIOError:
+                # the selector has wake-ups pending already
+                pass
+
+    def pause():
+        nonlocal paused
+        if not paused:
+            selector.unregister(server_socket)
+            paused = True
+
+    def close(conn):
+        nonlocal open_connections, paused
+        conn.sock.close()
+        open_connections -= 1
+        if paused:
+            selector.register(server_socket, selectors.EVENT_READ)
+            paused = False
+
+    def accept():
+        nonlocal open_connections
+        while True:
+            try:
+                client_conn, client_addr = server_socket.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                print(f"Error: {e}")
+                pause()
+                return
+            client_conn.settimeout(CLIENT_TIMEOUT)
+            client_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            selector.register(client_conn, selectors.EVENT_READ, Connection(client_conn, client_addr[0]))
+            open_connections += 1
+            if open_connections >= MAX_CONNECTIONS:
+                pause()
+                return
+
+    for _ in range(WORKERS):
+        threading.Thread(target=worker, daemon=True).start()
+    server_socket.setblocking(False)
+    selector.register(server_socket, selectors.EVENT_READ)
+    selector.register(wake_read, selectors.EVENT_READ)
+    next_sweep = time.monotonic() + 1.0
+    try:
+        while True:
+            for key, _ in selector.select(timeout=1.0):
+                if key.fileobj is server_socket:
+                    accept()
+                elif key.fileobj is wake_read:
+                    try:
+                        while wake_read.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    while not done.empty():
+                        conn, keep = done.get()
+                        if keep:
+                            conn.idle_since = time.monotonic()
+                            selector.register(conn.sock, selectors.EVENT_READ, conn)
+                        else:
+                            close(conn)
+                else:
+                    # the connection is the worker's until it comes back through `done`
+                    selector.unregister(key.fileobj)
+                    ready.put(key.data)
+            now = time.monotonic()
+            if now >= next_sweep:
+                for key in list(selector.get_map().values()):
+                    conn = key.data
+                    if conn is not None and now - conn.idle_since > CLIENT_TIMEOUT:
+                        selector.unregister(conn.sock)
+                        close(conn)
+                # a good moment to drop clients whose window has passed
+                client_requests.sweep()
+                next_sweep = now + 1.0
+    except KeyboardInterrupt:
+        print("\nServer shutting down...")
+        print(f"Clients: {client_requests.stats()}")
+    finally:
+        server_socket.close()
+        print("Server closed.")
+
+
+async def serve_asyncio_connection(reader, writer):
+    client_ip = writer.get_extra_info("peername")[0]
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), CLIENT_TIMEOUT)
+            except asyncio.LimitOverrunError:
+                writer.write(build_response(400).encode("utf-8"))
+                return
+            response, keep_alive = respond(head[:-4].decode("latin-1"), client_ip, keep_alive=True)
+            writer.write(response.encode("utf-8"))
+            await writer.drain()
+            if not keep_alive:
+                return
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as e:
+        print(f"Error: {e}")
+    finally:
+        writer.close()
+
+
+def serve_asyncio(server_socket):
+    async def main():
+        server = await asyncio.start_server(serve_asyncio_connection, sock=server_socket, limit=MAX_HEAD)
+        async with server:
+            while True:
+                await asyncio.sleep(1.0)
+                client_requests.sweep()
+
+    server_socket.settimeout(None)
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\nServer shutting down...")
+        print(f"Clients: {client_requests.stats()}")
+    finally:
+        server_socket.close()
+        print("Server closed.")
+
+
+def start_server(engine=None):
+    engine = engine or ENGINE
+    server_socket = open_server_socket()
+
+    print(f"🚦 Rate-Limited API Server running on http://{HOST}:{PORT}")
+    if rules is not None:
+        print(f"→ {len(rules.rules)} rate limit rules ({engine} engine)")
+        for line in rules.describe():
+            print(f"    {line}")
+    else:
+        print(f"→ Limit: {RATE_LIMIT} requests per {TIME_WINDOW} seconds ({limiter.name}, {engine} engine)")
+    print("Press Ctrl+C to stop.\n")
+
+    if engine == "threaded":
+        serve_threaded(server_socket)
+    elif engine == "asyncio":
+        serve_asyncio(server_socket)
+    else:
+        accept_loop(server_socket, handle_request)
+
+
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Rate-limited API server")
+    parser.add_argument("--algorithm", choices=sorted(ALGORITHMS), default=ALGORITHM)
+    parser.add_argument("--limit", type=int, default=RATE_LIMIT, help="requests per window")
+    parser.add_argument("--window", type=float, default=TIME_WINDOW, help="window in seconds")
+    parser.add_argument("--max-clients", type=int, default=MAX_CLIENTS, help="client IPs tracked at most")
+    parser.add_argument("--engine", choices=ENGINES, default=ENGINE,
+                        help="serial answers one connection at a time, as the original server did")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="threads answering requests in the threaded engine")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--quiet", action="store_true", help="do not print every request")
+    parser.add_argument("--store", default=STORE, help="memory, shm:PATH, service:HOST:PORT or synced:HOST:PORT")
+    parser.add_argument("--rules", metavar="FILE", help="JSON quota rules (see rules.example.json) instead of --limit")
+    args = parser.parse_args()
+    RATE_LIMIT, TIME_WINDOW = args.limit, args.window
+    HOST, PORT, WORKERS, VERBOSE = args.host, args.port, args.workers, not args.quiet
+    try:
+        client_requests, limiter = open_limiter(args.algorithm, args.store, args.max_clients)
+        if args.rules:
+            if client_requests is limiter:
+                raise ValueError("--rules needs a memory, shm or service store")
+            rules = load_rules(args.rules, args.algorithm, client_requests)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    start_server(args.engine)
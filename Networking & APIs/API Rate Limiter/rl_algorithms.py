@@ -0,0 +1,188 @@
+import time
+
+
+class RateLimiter:
+    """Allows `limit` requests per `window` seconds for each key.
+
+    `check(key)` counts a request and returns 0.0 when it is allowed, or
+    the seconds until the key may send again when it is limited (limited
+    requests are not counted). Subclasses implement `step(state, now)`,
+    which returns (wait, new state) for a key's state (None for a new key),
+    and `unstep(state, now)`, the state with one request admitted at `now`
+    taken back, which `refund(key, now)` applies.
+    Per-key state lives in `store`: a dict, or anything with
+    `apply(key, step, now, idle_after)` such as rl_store.ShardedStore, so
+    the table can be swapped without touching the algorithm. A key left
+    alone for `idle_after` seconds is back to its fresh state and can be
+    dropped.
+    """
+
+    name = None
+
+    def __init__(self, limit, window, store=None):
+        if limit < 1 or window <= 0:
+            raise ValueError("limit must be >= 1 and window > 0")
+        self.limit = limit
+        self.window = float(window)
+        self.idle_after = self.window
+        self.store = {} if store is None else store
+        self._apply = getattr(self.store, "apply", None)
+
+    def step(self, state, now):
+        raise NotImplementedError
+
+    def unstep(self, state, now):
+        raise NotImplementedError
+
+    def check(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        if self._apply is not None:
+            return self._apply(key, self.step, now, self.idle_after)
+        store = self.store
+        wait, store[key] = self.step(store.get(key), now)
+        return wait
+
+    def refund(self, key, now):
+        """Take back a request `check(key, now)` admitted, e.g. because another limit refused it."""
+        if self._apply is not None:
+            self._apply(key, self._refund_step, now, self.idle_after)
+        else:
+            self.store[key] = self.unstep(self.store.get(key), now)
+
+    def _refund_step(self, state, now):
+        return 0.0, self.unstep(state, now)
+
+    def is_limited(self, key, now=None):
+        return self.check(key, now) > 0.0
+
+    def describe(self):
+        return f"{self.name}({self.limit}/{self.window:g}s)"
+
+
+class SlidingLog(RateLimiter):
+    """Exact: a list of the key's request times inside the window (O(limit) memory per key)."""
+
+    name = "sliding_log"
+
+    def step(self, log, now):
+        if log is None:
+            log = []
+        cutoff = now - self.window
+        drop = 0
+        while drop < len(log) and log[drop] <= cutoff:
+            drop += 1
+        if drop:
+            del log[:drop]
+        if len(log) >= self.limit:
+            return log[0] + self.window - now, log
+        log.append(now)
+        return 0.0, log
+
+    def unstep(self, log, now):
+        # the newest entry: the refunded request's own, or one just as recent
+        if log:
+            log.pop()
+        return [] if log is None else log
+
+
+class TokenBucket(RateLimiter):
+    """`limit` tokens refilled evenly over `window`; a request takes one. State: (tokens, stamp)."""
+
+    name = "token_bucket"
+
+    def __init__(self, limit, window, store=None):
+        super().__init__(limit, window, store)
+        self.rate = limit / self.window
+
+    def step(self, state, now):
+        if state is None:
+            tokens = self.limit
+        else:
+            tokens = min(self.limit, state[0] + (now - state[1]) * self.rate)
+        if tokens < 1.0:
+            return (1.0 - tokens) / self.rate, (tokens, now)
+        return 0.0, (tokens - 1.0, now)
+
+    def unstep(self, state, now):
+        if state is None:
+            return self.limit, now
+        return min(self.limit, state[0] + 1.0), state[1]
+
+
+class GCRA(RateLimiter):
+    """Generic cell rate algorithm: one float per key, the theoretical arrival time (TAT).
+
+    Requests are spaced `window / limit` apart, with a burst allowance of
+    `limit`; it admits the same traffic as TokenBucket with less state.
+    """
+
+    name = "gcra"
+
+    def __init__(self, limit, window, store=None):
+        super().__init__(limit, window, store)
+        self.interval = self.window / limit
+
+    def step(self, tat, now):
+        if tat is None or tat < now:
+            tat = now
+        new_tat = tat + self.interval
+        wait = new_tat - self.window - now
+        if wait > 0:
+            return wait, tat
+        return 0.0, new_tat
+
+    def unstep(self, tat, now):
+        if tat is None:
+            return now
+        return max(now, tat - self.interval)
+
+
+class SlidingWindowCounter(RateLimiter):
+    """Two fixed-window counts, the previous one weighted by how much of it the sliding window still covers.
+
+    State: (window index, previous count, current count). Assumes requests
+    were spread evenly over the previous window, so it can be off by a
+    little in either direction near window edges.
+    """
+
+    name = "sliding_window"
+
+    def __init__(self, limit, window, store=None):
+        super().__init__(limit, window, store)
+        # the previous window's count still matters for up to two windows
+        self.idle_after = 2 * self.window
+
+    def step(self, state, now):
+        window = self.window
+        slot = now // window
+        offset = now - slot * window
+        if state is None or state[0] < slot - 1:
+            previous = current = 0
+        elif state[0] == slot - 1:
+            previous, current = state[2], 0
+        else:
+            previous, current = state[1], state[2]
+        weight = 1.0 - offset / window
+        if previous * weight + current >= self.limit:
+            state = (slot, previous, current)
+            # wait until the previous window's share has shrunk enough (or the next window starts)
+            if previous and current < self.limit:
+                need = (previous * weight + current - self.limit + 1) / previous * window
+                return min(need, window - offset), state
+            return window - offset, state
+        return 0.0, (slot, previous, current + 1)
+
+    def unstep(self, state, now):
+        slot = now // self.window
+        if state is None or state[0] != slot:
+            return (slot, 0, 0) if state is None else state
+        return slot, state[1], max(0, state[2] - 1)
+
+
+ALGORITHMS = {cls.name: cls for cls in (SlidingLog, TokenBucket, GCRA, SlidingWindowCounter)}
+
+
+def make_limiter(name, limit, window, store=None):
+    if name not in ALGORITHMS:
+        raise ValueError(f"unknown rate limiting algorithm {name!r}, expected one of {sorted(ALGORITHMS)}")
+    return ALGORITHMS[name](limit, window, store)
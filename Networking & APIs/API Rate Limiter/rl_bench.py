@@ -0,0 +1,163 @@
+import argparse
+import random
+import sys
+import time
+
+from rl_algorithms import ALGORITHMS, make_limiter
+from rl_rules import ipv4_int, parse_rules
+from rl_store import ShardedStore
+
+
+def make_stream(keys, requests, rate, seed=1, hot=0.01, hot_share=0.5):
+    """A synthetic request stream: (ips, times) in simulated seconds.
+
+    Every one of `keys` IPs shows up at least once; of the remaining
+    requests `hot_share` come from the first `hot` fraction of IPs, so those
+    keys run into their limit while the long tail stays idle.
+    """
+    rng = random.Random(seed)
+    ips = list(range(keys))
+    rng.shuffle(ips)
+    hot_keys = max(1, int(keys * hot))
+    for _ in range(requests - keys):
+        if rng.random() < hot_share:
+            ips.append(rng.randrange(hot_keys))
+        else:
+            ips.append(rng.randrange(keys))
+    head, tail = ips[:keys], ips[keys:]
+    rng.shuffle(tail)
+    ips = head + tail
+    rng.shuffle(ips)
+    step = 1.0 / rate
+    times = [i * step for i in range(len(ips))]
+    return [f"10.{ip >> 16 & 255}.{ip >> 8 & 255}.{ip & 255}" for ip in ips], times
+
+
+def state_bytes(store):
+    """Rough bytes of per-key state (values only, the table itself is the same for every algorithm)."""
+    total = 0
+    for value in store.values():
+        total += sys.getsizeof(value)
+        if isinstance(value, (list, tuple)):
+            total += sum(sys.getsizeof(v) for v in value)
+    return total
+
+
+def run(name, limit, window, ips, times, store=None):
+    limiter = make_limiter(name, limit, window, store)
+    check = limiter.check
+    decisions = bytearray(len(ips))
+    start = time.perf_counter_ns()
+    for i, (ip, now) in enumerate(zip(ips, times)):
+        if check(ip, now) == 0.0:
+            decisions[i] = 1
+    elapsed = time.perf_counter_ns() - start
+    return limiter, decisions, elapsed
+
+
+def make_rules(count, seed=1):
+    """`count` rules over a mix of path prefixes, exact paths, methods, header values and networks."""
+    rng = random.Random(seed)
+    rules = [{"name": "per-ip", "key": ["ip"], "limits": ["50/1s", "1000/1m"]},
+             {"name": "tenant", "match": {"headers": {"X-Tenant": "*"}}, "key": ["header:X-Tenant"],
+              "limits": ["5000/1m"]}]
+    while len(rules) < count:
+        i = len(rules)
+        match = {"path": f"/api/v{i % 3}/r{i}" + ("/*" if i % 2 else "")}
+        if i % 5 == 0:
+            match["method"] = "GET"
+        if i % 7 == 0:
+            match["headers"] = {"X-Plan": rng.choice(["free", "pro"])}
+        if i % 11 == 0:
+            match["ip"] = f"10.{i % 256}.0.0/16"
+        key = rng.choice([["ip"], ["ip", "path"], ["header:X-API-Key"], ["ip/24"]])
+        rule = {"name": f"r{i}", "match": match, "key": key, "limits": ["10/1s", "200/1m"]}
+        if "header:X-API-Key" in key:
+            rule["parent"] = "tenant"
+        rules.append(rule)
+    return rules
+
+
+def bench_rules(count, requests, seed=1):
+    engine = parse_rules(make_rules(count, seed), "gcra")
+    rng = random.Random(seed)
+    reqs = []
+    for _ in range(requests):
+        i = rng.randrange(2, count + 8)
+        path = f"/api/v{i % 3}/r{i}" + rng.choice(["", "/items", "/items/42"])
+        headers = {"x-tenant": f"t{rng.randrange(20)}", "x-api-key": f"k{rng.randrange(500)}",
+                   "x-plan": rng.choice(["free", "pro"])}
+        ip = f"10.{rng.randrange(4)}.{rng.randrange(8)}.{rng.randrange(64)}"
+        reqs.append((ip, "GET", path, headers))
+    matched = 0
+    start = time.perf_counter_ns()
+    for ip, method, path, headers in reqs:
+        matched += engine.match(ipv4_int(ip), method, path, headers).bit_count()
+    match_ns = (time.perf_counter_ns() - start) / requests
+    limited = 0
+    start = time.perf_counter_ns()
+    for n, (ip, method, path, headers) in enumerate(reqs):
+        if engine.check(ip, method, path, headers, n * 1e-4)[0] > 0:
+            limited += 1
+    check_ns = (time.perf_counter_ns() - start) / requests
+    print(f"[bench] {count} rules: match {match_ns / 1000:.2f}us, full check {check_ns / 1000:.2f}us "
+          f"({matched / requests:.1f} rules apply per request, {limited:,} of {requests:,} limited)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare rate limiting algorithms against the exact sliding log")
+    parser.add_argument("--keys", type=int, default=1_000_000, help="distinct client IPs")
+    parser.add_argument("--requests", type=int, default=3_000_000)
+    parser.add_argument("--rate", type=float, default=50_000.0, help="requests per simulated second")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--window", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--algorithms", nargs="+", default=list(ALGORITHMS), choices=list(ALGORITHMS))
+    parser.add_argument("--store", choices=["dict", "sharded"], default="dict",
+                        help="plain dict, or rl_store.ShardedStore with idle expiry")
+    parser.add_argument("--max-keys", type=int, default=None, help="cap for the sharded store")
+    parser.add_argument("--rules", type=int, nargs="*", metavar="N",
+                        help="time the rule engine with N synthetic rules instead")
+    args = parser.parse_args(argv)
+    if args.rules is not None:
+        for count in args.rules or [12, 48, 200]:
+            bench_rules(count, min(args.requests, 200_000), args.seed)
+        return
+    if args.requests < args.keys:
+        parser.error("--requests must be at least --keys")
+
+    print(f"[bench] building {args.requests:,} requests over {args.keys:,} IPs at {args.rate:g}/s")
+    ips, times = make_stream(args.keys, args.requests, args.rate, args.seed)
+
+    # the current server's behaviour, with a plain dict, is the reference every run is scored against
+    reference_limiter, reference, reference_elapsed = run("sliding_log", args.limit, args.window, ips, times)
+    print(f"{'algorithm':<16}{'ns/op':>8}{'allowed':>12}{'agree':>9}{'extra':>9}{'missing':>9}{'B/key':>8}")
+    stores = []
+    for name in args.algorithms:
+        store = ShardedStore(max_keys=args.max_keys) if args.store == "sharded" else None
+        if name == "sliding_log" and store is None:
+            limiter, decisions, elapsed = reference_limiter, reference, reference_elapsed
+        else:
+            limiter, decisions, elapsed = run(name, args.limit, args.window, ips, times, store)
+        allowed = sum(decisions)
+        extra = missing = 0
+        if decisions is not reference:
+            for got, want in zip(decisions, reference):
+                if got != want:
+                    if got:
+                        extra += 1
+                    else:
+                        missing += 1
+        agree = 1.0 - (extra + missing) / len(decisions)
+        per_key = state_bytes(limiter.store) / max(1, len(limiter.store))
+        print(f"{name:<16}{elapsed / len(ips):>8.0f}{allowed:>12,}{agree:>9.2%}{extra:>9,}{missing:>9,}{per_key:>8.0f}")
+        if store is not None:
+            stores.append((name, store.stats()))
+        del limiter, store
+    del reference_limiter
+    for name, stats in stores:
+        print(f"[bench] {name}: {stats['live_keys']:,} live keys, {stats['expired']:,} expired, "
+              f"{stats['evictions']:,} evicted")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import math
+import os
+import socket
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def client_address(i):
+    """A distinct loopback source address per simulated client (127.0.0.0/8 all routes to lo)."""
+    i += 2
+    return f"127.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ")[1])
+    length = 0
+    close = False
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        name = name.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "connection":
+            close = value.strip().lower() == "close"
+    await reader.readexactly(length)
+    return status, close
+
+
+class Client:
+    """One source IP sending GETs at `rate` per second over keep-alive (reconnecting when told to close).
+
+    With several server ports the requests rotate over them, as a load balancer would spread them.
+    """
+
+    def __init__(self, index, host, ports, rate, keep_alive):
+        self.ip = client_address(index)
+        self.host = host
+        self.ports = ports
+        self.interval = 1.0 / rate
+        self.keep_alive = keep_alive
+        self.codes = {}
+        self.errors = 0
+        self.latencies = []
+
+    async def run(self, start, until):
+        request = (f"GET / HTTP/1.1\r\nHost: {self.host}\r\n"
+                   + ("" if self.keep_alive else "Connection: close\r\n") + "\r\n").encode()
+        connections = {}
+        n = 0
+        loop = asyncio.get_running_loop()
+        while True:
+            due = start + n * self.interval
+            if due >= until:
+                break
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            port = self.ports[n % len(self.ports)]
+            n += 1
+            sent = loop.time()
+            reader, writer = connections.pop(port, (None, None))
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(self.host, port, local_addr=(self.ip, 0))
+                writer.write(request)
+                status, close = await read_response(reader)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                self.errors += 1
+                if writer is not None:
+                    writer.close()
+                continue
+            self.latencies.append(loop.time() - sent)
+            self.codes[status] = self.codes.get(status, 0) + 1
+            if close:
+                writer.close()
+            else:
+                connections[port] = (reader, writer)
+        for _, writer in connections.values():
+            writer.close()
+
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def drive(args):
+    rate = args.rate / args.clients
+    ports = [args.port + i for i in range(args.servers)]
+    clients = [Client(i, args.host, ports, rate, not args.close) for i in range(args.clients)]
+    loop = asyncio.get_running_loop()
+    start = loop.time() + 0.2
+    until = start + args.duration
+    await asyncio.gather(*(c.run(start + i * (1.0 / args.rate), until) for i, c in enumerate(clients)))
+    return clients, loop.time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test apirate_limit.py: throughput and 429/200 correctness")
+    parser.add_argument("--engine", default="threaded", choices=["serial", "threaded", "asyncio"])
+    parser.add_argument("--algorithm", default="sliding_log")
+    parser.add_argument("--rate", type=float, default=10_000.0, help="target requests per second, all clients")
+    parser.add_argument("--clients", type=int, default=200, help="distinct client IPs")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--limit", type=int, default=100, help="server limit per client")
+    parser.add_argument("--window", type=float, default=60.0)
+    parser.add_argument("--workers", type=int, default=None, help="threaded engine workers (default: the server's WORKERS)")
+    parser.add_argument("--close", action="store_true", help="a new connection per request")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5099, help="first server port")
+    parser.add_argument("--servers", type=int, default=1, help="copies of the server, each client spreads over all")
+    parser.add_argument("--store", default="memory",
+                        help="passed to the servers; service/synced start rl_service.py on --service-port")
+    parser.add_argument("--service-port", type=int, default=5098)
+    args = parser.parse_args(argv)
+    if args.store.startswith("synced") and args.algorithm != "sliding_window":
+        parser.error("--store synced needs --algorithm sliding_window")
+
+    store = args.store
+    if store in ("service", "synced"):
+        store = f"{store}:{args.host}:{args.service_port}"
+    elif store == "shm":
+        store = f"shm:/dev/shm/rl_load.{os.getpid()}"
+    processes = []
+    try:
+        if store.startswith(("service:", "synced:")):
+            processes.append(subprocess.Popen([sys.executable, os.path.join(HERE, "rl_service.py"),
+                                               "--host", args.host, "--port", str(args.service_port)],
+                                              stdout=subprocess.DEVNULL))
+            if not wait_for_port(args.host, args.service_port):
+                print("[load] limiter service did not come up")
+                return 1
+        for i in range(args.servers):
+            cmd = [sys.executable, os.path.join(HERE, "apirate_limit.py"), "--engine", args.engine, "--quiet",
+                   "--algorithm", args.algorithm, "--limit", str(args.limit), "--window", str(args.window),
+                   "--host", args.host, "--port", str(args.port + i), "--store", store]
+            if args.workers:
+                cmd += ["--workers", str(args.workers)]
+            processes.append(subprocess.Popen(cmd, stdout=subprocess.DEVNULL))
+        for i in range(args.servers):
+            if not wait_for_port(args.host, args.port + i):
+                print(f"[load] server on port {args.port + i} did not come up")
+                return 1
+        clients, elapsed = asyncio.run(drive(args))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        if store.startswith("shm:") and os.path.exists(store[4:]):
+            os.remove(store[4:])
+
+    codes = {}
+    for c in clients:
+        for status, count in c.codes.items():
+            codes[status] = codes.get(status, 0) + count
+    answered = sum(codes.values())
+    errors = sum(c.errors for c in clients)
+    latencies = [lat for c in clients for lat in c.latencies]
+    # every client sends more than its limit: it must get at least `limit` 200s, and no more than
+    # the limit plus what the window refills over the run (token bucket / gcra refill continuously)
+    most = args.limit + math.ceil(elapsed * args.limit / args.window)
+    under = sum(1 for c in clients if c.codes.get(200, 0) < min(args.limit, sum(c.codes.values())))
+    over = sum(1 for c in clients if c.codes.get(200, 0) > most)
+
+    print(f"[load] {args.servers} x {args.engine} engine, {args.algorithm} {args.limit}/{args.window:g}s, "
+          f"{store} store, {args.clients} clients, {'close' if args.close else 'keep-alive'}, "
+          f"target {args.rate:g} req/s for {args.duration:g}s")
+    print(f"[load] {answered:,} answered in {elapsed:.2f}s = {answered / elapsed:,.0f} req/s, {errors} errors")
+    print(f"[load] codes {dict(sorted(codes.items()))}")
+    print(f"[load] latency p50 {percentile(latencies, 50) * 1000:.2f}ms p99 {percentile(latencies, 99) * 1000:.2f}ms")
+    print(f"[load] clients under their limit: {under}, over it (> {most} allowed): {over}, "
+          f"most 200s for one client: {max(c.codes.get(200, 0) for c in clients)}")
+    return 0 if errors == 0 and under == 0 and over == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
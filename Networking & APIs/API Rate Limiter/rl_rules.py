@@ -0,0 +1,313 @@
+import json
+import socket
+import time
+
+from rl_algorithms import ALGORITHMS, make_limiter
+from rl_store import SharedMemoryStore, ShardedStore
+
+UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0, "d": 86400.0}
+
+
+def parse_limit(text):
+    """"20/1s", "1000/1h", "5/500ms", "100/m" or "100/60" (seconds) -> (limit, window in seconds)."""
+    count, sep, per = str(text).partition("/")
+    number = per.rstrip("abcdefghijklmnopqrstuvwxyz")
+    try:
+        limit = int(count)
+        window = float(number or 1) * UNITS[per[len(number):] or "s"]
+    except (ValueError, KeyError):
+        raise ValueError(f"limit {text!r} is not like 20/1s, 1000/1h or 5/500ms") from None
+    if not sep or limit < 1 or window <= 0:
+        raise ValueError(f"limit {text!r} needs a count >= 1 and a positive window")
+    return limit, window
+
+
+def ipv4_int(ip):
+    try:
+        return int.from_bytes(socket.inet_aton(ip), "big")
+    except OSError:
+        return None
+
+
+def parse_network(text):
+    """"10.0.0.0/8" or "10.1.2.3" -> (prefix length, network as an int)."""
+    address, _, length = str(text).partition("/")
+    value = ipv4_int(address)
+    try:
+        length = int(length or 32)
+    except ValueError:
+        value = None
+    if value is None or not 0 <= length <= 32:
+        raise ValueError(f"ip {text!r} is not an IPv4 address or network")
+    return length, value >> (32 - length)
+
+
+class Rule:
+    """One quota: which requests it covers (`match`), what it counts them by (`key`) and its `limits`.
+
+    A request is counted under the key made of its `key` parts: "ip",
+    "ip/N" (the client's /N network), "path", "method" or "header:NAME".
+    A rule whose key needs a header the request lacks does not apply.
+    `parent` names a broader rule that every request this one covers is
+    also counted against, so a per-user quota can sit under a per-tenant
+    one.
+    """
+
+    def __init__(self, name, match=None, key=("ip",), limits=(), algorithm="sliding_window", parent=None):
+        self.name = name
+        self.parent = parent
+        match = dict(match or {})
+        unknown = set(match) - {"path", "method", "ip", "headers"}
+        if unknown:
+            raise ValueError(f"rule {name!r}: unknown match fields {sorted(unknown)}")
+        path = match.get("path")
+        if path is not None and not str(path).startswith("/"):
+            raise ValueError(f"rule {name!r}: path {path!r} must start with /")
+        # "/api/*" covers everything under /api, "/login" only /login
+        self.prefix = path is not None and str(path).endswith("*")
+        self.path = None if path is None else str(path).rstrip("*")
+        methods = match.get("method")
+        if isinstance(methods, str):
+            methods = [methods]
+        self.methods = None if methods is None else frozenset(m.upper() for m in methods)
+        self.network = None if match.get("ip") is None else parse_network(match["ip"])
+        self.headers = {str(h).lower(): str(v) for h, v in (match.get("headers") or {}).items()}
+
+        if isinstance(key, str):
+            key = [key]
+        self.key_names = list(key)
+        self.key = []
+        for part in key:
+            if part in ("ip", "path", "method"):
+                self.key.append((part, None))
+            elif part.startswith("ip/") and part[3:].isdigit() and 0 <= int(part[3:]) <= 32:
+                self.key.append(("net", 32 - int(part[3:])))
+            elif part.startswith("header:") and len(part) > 7:
+                self.key.append(("header", part[7:].lower()))
+            else:
+                raise ValueError(f"rule {name!r}: key part {part!r} is not ip, ip/N, path, method or header:NAME")
+        if isinstance(limits, str):
+            limits = [limits]
+        if not limits:
+            raise ValueError(f"rule {name!r} has no limits")
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"rule {name!r}: unknown algorithm {algorithm!r}")
+        # several windows (a burst and a sustained rate); the shortest is checked first, as it is
+        # the one that usually turns a request away
+        self.limits = sorted((parse_limit(limit) for limit in limits), key=lambda lw: lw[1])
+        self.algorithm = algorithm
+        self.limiters = []
+        self.depth = 0
+
+    @classmethod
+    def from_dict(cls, item, algorithm):
+        if not isinstance(item, dict) or not item.get("name"):
+            raise ValueError(f"rule {item!r} needs a name")
+        unknown = set(item) - {"name", "match", "key", "limits", "limit", "algorithm", "parent"}
+        if unknown:
+            raise ValueError(f"rule {item['name']!r}: unknown fields {sorted(unknown)}")
+        return cls(str(item["name"]), item.get("match"), item.get("key", ("ip",)),
+                   item.get("limits", item.get("limit", ())), item.get("algorithm", algorithm), item.get("parent"))
+
+    def bind(self, store):
+        self.limiters = [(make_limiter(self.algorithm, limit, window, store), (self.name, i))
+                         for i, (limit, window) in enumerate(self.limits)]
+
+    def key_of(self, ip, ip_value, method, path, headers):
+        values = []
+        for kind, arg in self.key:
+            if kind == "ip":
+                values.append(ip)
+            elif kind == "net":
+                values.append(ip if ip_value is None else f"{ip_value >> arg << arg:x}/{32 - arg}")
+            elif kind == "path":
+                values.append(path)
+            elif kind == "method":
+                values.append(method)
+            else:
+                value = headers.get(arg)
+                if value is None:
+                    return None
+                values.append(value)
+        return tuple(values)
+
+    def describe(self):
+        limits = ", ".join(f"{limit}/{window:g}s" for limit, window in self.limits)
+        return f"{self.name}: {limits} per {' + '.join(self.key_names)}"
+
+
+class _PathNode:
+    __slots__ = ("children", "prefix", "exact")
+
+    def __init__(self):
+        self.children = {}
+        self.prefix = 0
+        self.exact = 0
+
+
+class RuleEngine:
+    """Rules compiled into bitmasks, one bit per rule.
+
+    Each match field has its own index: a trie over path segments, and hash
+    tables for methods, header values and IP networks (one table per
+    prefix length). A lookup ANDs one mask per field, so its cost grows with
+    the path depth and the number of distinct fields, not with the number
+    of rules. Bits are numbered in evaluation order, children before their
+    parents. A request is counted against every limit that covers it or
+    against none: the first limit that turns it away stops the rest from
+    seeing it, and the limits before it, which had counted it, are refunded.
+    """
+
+    def __init__(self, rules, store=None):
+        self.store = ShardedStore() if store is None else store
+        by_name = {}
+        for rule in rules:
+            if rule.name in by_name:
+                raise ValueError(f"rule {rule.name!r} is defined twice")
+            by_name[rule.name] = rule
+        for rule in rules:
+            seen = {rule.name}
+            parent = rule.parent
+            while parent is not None:
+                if parent not in by_name:
+                    raise ValueError(f"rule {rule.name!r}: parent {parent!r} is not defined")
+                if parent in seen:
+                    raise ValueError(f"rule {rule.name!r}: parents form a cycle")
+                seen.add(parent)
+                rule.depth += 1
+                parent = by_name[parent].parent
+            if rule.algorithm == "sliding_log" and isinstance(self.store, SharedMemoryStore):
+                raise ValueError(f"rule {rule.name!r}: sliding_log keeps a list per client and cannot live "
+                                 "in shared memory")
+        order = sorted(range(len(rules)), key=lambda i: (-rules[i].depth, i))
+        self.rules = [rules[i] for i in order]
+        bit = {rule.name: 1 << i for i, rule in enumerate(self.rules)}
+        for rule in self.rules:
+            rule.bind(self.store)
+
+        self._path_root = _PathNode()
+        self._path_any = self._method_any = self._ip_any = 0
+        self._methods = {}
+        self._networks = {}
+        self._header_names = sorted({h for rule in self.rules for h in rule.headers})
+        self._headers = {name: [0, 0, {}] for name in self._header_names}
+        self._with_parents = []
+        for rule in self.rules:
+            b = bit[rule.name]
+            if rule.path is None:
+                self._path_any |= b
+            else:
+                node = self._path_root
+                for segment in rule.path.split("/"):
+                    if segment:
+                        node = node.children.setdefault(segment, _PathNode())
+                if rule.prefix:
+                    node.prefix |= b
+                else:
+                    node.exact |= b
+            if rule.methods is None:
+                self._method_any |= b
+            else:
+                for method in rule.methods:
+                    self._methods[method] = self._methods.get(method, 0) | b
+            if rule.network is None:
+                self._ip_any |= b
+            else:
+                shift = 32 - rule.network[0]
+                table = self._networks.setdefault(shift, {})
+                table[rule.network[1]] = table.get(rule.network[1], 0) | b
+            for name, entry in self._headers.items():
+                value = rule.headers.get(name)
+                if value is None:
+                    entry[0] |= b
+                elif value == "*":
+                    entry[1] |= b
+                else:
+                    entry[2][value] = entry[2].get(value, 0) | b
+            closure, parent = b, rule.parent
+            while parent is not None:
+                closure |= bit[parent]
+                parent = by_name[parent].parent
+            self._with_parents.append(closure)
+        self._networks = sorted(self._networks.items())
+        self._has_parents = any(rule.parent for rule in self.rules)
+
+    def match(self, ip_value, method, path, headers):
+        """Bitmask of the rules that cover a request (parents included)."""
+        mask = self._path_any | self._path_root.prefix
+        node = self._path_root
+        for segment in path.split("/"):
+            if segment:
+                node = node.children.get(segment)
+                if node is None:
+                    break
+                mask |= node.prefix
+        else:
+            mask |= node.exact
+        mask &= self._method_any | self._methods.get(method, 0)
+        if self._networks:
+            ip_mask = self._ip_any
+            if ip_value is not None:
+                for shift, table in self._networks:
+                    ip_mask |= table.get(ip_value >> shift, 0)
+            mask &= ip_mask
+        for name in self._header_names:
+            any_value, present, values = self._headers[name]
+            value = headers.get(name)
+            mask &= any_value if value is None else any_value | present | values.get(value, 0)
+        if self._has_parents and mask:
+            expanded, rest = 0, mask
+            while rest:
+                low = rest & -rest
+                expanded |= self._with_parents[low.bit_length() - 1]
+                rest ^= low
+            mask = expanded
+        return mask
+
+    def check(self, ip, method, path, headers, now=None):
+        """(wait, rule): 0.0 and None when every covering rule allows the request.
+
+        `headers` maps lower-case header names to values; `path` should not
+        include the query string.
+        """
+        now = time.monotonic() if now is None else now
+        ip_value = ipv4_int(ip)
+        mask = self.match(ip_value, method, path, headers)
+        rules = self.rules
+        counted = []
+        while mask:
+            low = mask & -mask
+            mask ^= low
+            rule = rules[low.bit_length() - 1]
+            key = rule.key_of(ip, ip_value, method, path, headers)
+            if key is None:
+                continue
+            for limiter, prefix in rule.limiters:
+                wait = limiter.check((prefix, key), now)
+                if wait > 0:
+                    for earlier, earlier_key in counted:
+                        earlier.refund(earlier_key, now)
+                    return wait, rule
+                counted.append((limiter, (prefix, key)))
+        return 0.0, None
+
+    def describe(self):
+        return [rule.describe() for rule in self.rules]
+
+
+def parse_rules(data, algorithm="sliding_window", store=None):
+    """A RuleEngine from decoded JSON: a list of rules or {"rules": [...]}; raises ValueError."""
+    if isinstance(data, dict):
+        algorithm = data.get("algorithm", algorithm)
+        data = data.get("rules")
+    if not isinstance(data, list) or not data:
+        raise ValueError('expected a list of rules or {"rules": [...]}')
+    return RuleEngine([Rule.from_dict(item, algorithm) for item in data], store)
+
+
+def load_rules(path, algorithm="sliding_window", store=None):
+    with open(path) as f:
+        try:
+            return parse_rules(json.load(f), algorithm, store)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path}: {e}") from None
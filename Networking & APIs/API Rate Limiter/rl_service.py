@@ -0,0 +1,368 @@
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+
+from rl_algorithms import RateLimiter, make_limiter
+from rl_store import ShardedStore
+
+# Line protocol, one request per line, answered in order (clients may pipeline):
+#   C <algorithm> <limit> <window> <key>   -> "<wait>"              exact check on the service
+#   R <algorithm> <limit> <window> <key>   -> "0"                   refund a request C admitted
+#   A <window> <slot> <n> <key>            -> "<slot> <prev> <cur>"  add n to a fixed-window count
+#   S                                      -> JSON stats
+
+
+class LimiterService:
+    """A stand-in for a shared rate limiting backend (Redis and the like) that API processes talk to over TCP.
+
+    `C` runs the named algorithm on the service's own ShardedStore, so every
+    process sees one exact count. `A` keeps plain per-window counts that
+    SyncedWindowCounter clients add their local increments to in batches.
+    """
+
+    def __init__(self, host="127.0.0.1", port=5060, max_keys=None):
+        self.host = host
+        self.port = port
+        self.store = ShardedStore(max_keys=max_keys)
+        self.limiters = {}
+        self.counts = {}
+        self.requests = 0
+        self.batches = 0
+
+    def execute(self, line):
+        parts = line.split(" ", 4)
+        command = parts[0]
+        try:
+            if command in ("C", "R") and len(parts) == 5:
+                spec = (parts[1], int(parts[2]), float(parts[3]))
+                limiter = self.limiters.get(spec)
+                if limiter is None:
+                    limiter = self.limiters[spec] = make_limiter(*spec, store=_Prefixed(self.store, spec))
+                if command == "R":
+                    limiter.refund(parts[4], time.monotonic())
+                    return "0"
+                return repr(limiter.check(parts[4]))
+            if command == "A" and len(parts) == 5:
+                return self.add(float(parts[1]), float(parts[2]), int(parts[3]), parts[4])
+            if command == "S":
+                return json.dumps(self.stats())
+        except ValueError as e:
+            return f"E {e}"
+        return "E bad request"
+
+    def add(self, window, slot, n, key):
+        entry = self.counts.get((window, key))
+        if entry is None or entry[0] < slot - 1:
+            entry = [slot, 0, 0]
+        elif entry[0] == slot - 1:
+            entry = [slot, entry[2], 0]
+        if entry[0] == slot:
+            entry[2] += n
+        elif entry[0] == slot + 1:
+            # a late batch for the window that just ended
+            entry[1] += n
+        self.counts[(window, key)] = entry
+        return f"{entry[0]:.0f} {entry[1]} {entry[2]}"
+
+    def expire_counts(self):
+        now = time.time()
+        for (window, key), entry in list(self.counts.items()):
+            if entry[0] < now // window - 1:
+                del self.counts[(window, key)]
+
+    def stats(self):
+        return {"requests": self.requests, "batches": self.batches, "keys": len(self.store),
+                "counted_keys": len(self.counts), "limiters": [" ".join(map(str, s)) for s in self.limiters]}
+
+    async def _handle(self, reader, writer):
+        buffer = b""
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                *lines, buffer = (buffer + data).split(b"\n")
+                if not lines:
+                    continue
+                replies = [self.execute(line.decode()) for line in lines]
+                self.requests += len(lines)
+                self.batches += 1
+                writer.write(("\n".join(replies) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port, backlog=socket.SOMAXCONN)
+        print(f"[service] rate limiter service on {self.host}:{self.port}")
+        async with server:
+            while True:
+                await asyncio.sleep(1.0)
+                self.store.sweep()
+                self.expire_counts()
+
+
+class _Prefixed:
+    """One limiter's view of the shared service store, so different limits never share a key."""
+
+    def __init__(self, store, prefix):
+        self.store = store
+        self.prefix = prefix
+
+    def apply(self, key, step, now, idle_after):
+        return self.store.apply((self.prefix, key), step, now, idle_after)
+
+
+class _Call:
+    __slots__ = ("line", "done", "reply", "sent")
+
+    def __init__(self, line):
+        self.line = line
+        self.done = threading.Event()
+        self.reply = None
+        # False while the service cannot have seen the call; a sent call without a reply may or may not have run
+        self.sent = False
+
+
+class Pipeline:
+    """One connection to the service shared by every thread of a process.
+
+    Calls queued while a batch is in flight go out together in the next
+    write and their replies are read back in order, so many concurrent
+    checks cost one round trip. A failed batch answers None; the next one
+    reconnects. Calls still queued when their caller gives up are dropped,
+    never sent late.
+    """
+
+    def __init__(self, host, port, timeout=1.0):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.round_trips = 0
+        self.failures = 0
+        self._queue = []
+        self._ready = threading.Condition()
+        self._sock = self._file = None
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def request(self, line):
+        return self.request_many([line])[0]
+
+    def request_many(self, lines):
+        return [call.reply for call in self.submit(lines)]
+
+    def submit(self, lines):
+        """Send `lines` and wait up to `timeout` for the replies; returns the calls (reply None if none came)."""
+        calls = [_Call(line) for line in lines]
+        with self._ready:
+            self._queue.extend(calls)
+            self._ready.notify()
+        deadline = time.monotonic() + self.timeout
+        for call in calls:
+            if not call.done.wait(max(0.0, deadline - time.monotonic())):
+                pending = set(calls)
+                with self._ready:
+                    self._queue = [c for c in self._queue if c not in pending]
+                break
+        return calls
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._queue:
+                    self._ready.wait()
+                batch, self._queue = self._queue, []
+            try:
+                if self._sock is None:
+                    self._sock = socket.create_connection(self.address, timeout=self.timeout)
+                    self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self._file = self._sock.makefile("rb")
+                for call in batch:
+                    call.sent = True
+                self._sock.sendall("".join(call.line + "\n" for call in batch).encode())
+                for call in batch:
+                    line = self._file.readline()
+                    if not line:
+                        raise ConnectionError("service closed the connection")
+                    call.reply = line.decode().rstrip("\n")
+                    call.done.set()
+                self.round_trips += 1
+            except OSError as e:
+                if not self.failures:
+                    print(f"[service] {self.address[0]}:{self.address[1]} unreachable: {e}")
+                self.failures += 1
+                if self._sock is not None:
+                    self._sock.close()
+                self._sock = self._file = None
+            for call in batch:
+                call.done.set()
+
+
+class ServiceStore:
+    """A limiter store kept by the LimiterService: every check is a (pipelined) round trip.
+
+    The service runs the limiter's algorithm itself, so `step` only names
+    it (and whether this is a check or a refund). If the service cannot be
+    reached the request is allowed (fail open).
+    """
+
+    def __init__(self, host, port, timeout=1.0):
+        self.pipeline = Pipeline(host, port, timeout)
+        self.failed_open = 0
+
+    def apply(self, key, step, now, idle_after):
+        limiter = step.__self__
+        command = "R" if step == limiter._refund_step else "C"
+        reply = self.pipeline.request(f"{command} {limiter.name} {limiter.limit} {limiter.window!r} {key}")
+        if reply is None or reply.startswith("E"):
+            self.failed_open += 1
+            return 0.0
+        return float(reply)
+
+    def sweep(self, now=None):
+        return 0
+
+    def __len__(self):
+        reply = self.pipeline.request("S")
+        return json.loads(reply)["keys"] if reply and not reply.startswith("E") else 0
+
+    def values(self):
+        return iter(())
+
+    def stats(self):
+        return {"round_trips": self.pipeline.round_trips, "failures": self.pipeline.failures,
+                "failed_open": self.failed_open}
+
+
+class SyncedWindowCounter(RateLimiter):
+    """A sliding window counter whose counts are shared through the LimiterService, approximately.
+
+    Checks only touch local memory: the estimate is the global counts from
+    the last sync plus what this process admitted since. Every
+    `sync_interval` seconds the local increments go to the service in one
+    pipelined batch and the replies bring back everyone else's. Between
+    syncs each process can admit what it sees as the remaining quota, so
+    the overshoot is bounded by the traffic of one interval. Uses wall
+    clock time, so processes on different hosts agree on the windows.
+    """
+
+    name = "synced_window"
+
+    def __init__(self, limit, window, host, port, sync_interval=0.05, timeout=1.0):
+        super().__init__(limit, window)
+        self.idle_after = 2 * self.window
+        self.sync_interval = sync_interval
+        self.pipeline = Pipeline(host, port, timeout)
+        self.syncs = 0
+        self._lock = threading.Lock()
+        # key -> [slot, previous, current] as the service last reported them
+        self._global = self.store
+        # key -> {slot: requests admitted here and not yet sent}, and those in the batch being sent
+        self._local = {}
+        self._sending = {}
+        self._seen = set()
+        threading.Thread(target=self._sync_loop, daemon=True).start()
+
+    def check(self, key, now=None):
+        now = time.time() if now is None else now
+        window = self.window
+        slot = now // window
+        weight = 1.0 - (now - slot * window) / window
+        with self._lock:
+            entry = self._global.get(key)
+            previous = current = 0
+            if entry is not None:
+                if entry[0] == slot:
+                    previous, current = entry[1], entry[2]
+                elif entry[0] == slot - 1:
+                    previous = entry[2]
+            sending = self._sending.get(key)
+            if sending is not None:
+                previous += sending.get(slot - 1, 0)
+                current += sending.get(slot, 0)
+            local = self._local.get(key)
+            if local is not None:
+                previous += local.get(slot - 1, 0)
+                current += local.get(slot, 0)
+            estimate = previous * weight + current
+            self._seen.add(key)
+            if estimate >= self.limit:
+                return (slot + 1) * window - now if not previous else \
+                    min((estimate - self.limit + 1) / previous * window, (slot + 1) * window - now)
+            if local is None:
+                local = self._local[key] = {}
+            local[slot] = local.get(slot, 0) + 1
+        return 0.0
+
+    def sync(self):
+        now = time.time()
+        with self._lock:
+            local, self._local = self._local, {}
+            seen, self._seen = self._seen, set()
+            self._sending = local
+        slot = now // self.window
+        lines, adds = [], []
+        for key in seen | local.keys():
+            counts = local.get(key) or {slot: 0}
+            for count_slot, n in counts.items():
+                lines.append(f"A {self.window!r} {count_slot:.0f} {n} {key}")
+                adds.append((key, count_slot, n))
+        if not lines:
+            self._sending = {}
+            return
+        calls = self.pipeline.submit(lines)
+        with self._lock:
+            for (key, count_slot, n), call in zip(adds, calls):
+                reply = call.reply
+                if reply is None or reply.startswith("E"):
+                    # keep what the service surely did not count and send it again next time; a sent
+                    # add without a reply may have counted, so it is dropped rather than counted twice
+                    if n and (reply is not None or not call.sent):
+                        counts = self._local.setdefault(key, {})
+                        counts[count_slot] = counts.get(count_slot, 0) + n
+                    continue
+                reported = [float(v) for v in reply.split(" ")]
+                current = self._global.get(key)
+                if current is None or reported[0] >= current[0]:
+                    self._global[key] = reported
+            self._sending = {}
+        self.syncs += 1
+
+    def sweep(self, now=None):
+        """Forget keys whose counts are too old to matter; returns how many went."""
+        slot = (time.time() if now is None else now) // self.window
+        with self._lock:
+            stale = [key for key, entry in self._global.items() if entry[0] < slot - 1 and key not in self._local]
+            for key in stale:
+                del self._global[key]
+        return len(stale)
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self.sync_interval)
+            self.sync()
+
+    def stats(self):
+        return {"live_keys": len(self._global), "syncs": self.syncs, "round_trips": self.pipeline.round_trips,
+                "failures": self.pipeline.failures}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shared rate limiter service for several apirate_limit.py processes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5060)
+    parser.add_argument("--max-keys", type=int, default=None)
+    args = parser.parse_args(argv)
+    service = LimiterService(args.host, args.port, args.max_keys)
+    try:
+        asyncio.run(service.serve())
+    except KeyboardInterrupt:
+        print(f"[service] stopped: {service.stats()}")
+
+
+if __name__ == "__main__":
+    main()
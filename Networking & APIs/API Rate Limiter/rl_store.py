@@ -0,0 +1,279 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+
+# A limiter store is anything with apply(key, step, now, idle_after): run the
+# limiter's step(state, now) on the key's state, keep the new state, return the
+# wait. ShardedStore keeps state in this process, SharedMemoryStore in a file
+# every process on the host maps, rl_service.ServiceStore in a limiter service.
+
+
+class _Shard:
+    __slots__ = ("lock", "entries", "evictions", "expired")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> [state, expires], least recently used first
+        self.entries = OrderedDict()
+        self.evictions = 0
+        self.expired = 0
+
+
+class ShardedStore:
+    """Limiter state split over `shards` locked tables, with idle expiry and a size cap.
+
+    Requests for keys in different shards never wait on each other. Each
+    shard keeps its keys in least-recently-used order; a key expires once
+    it has been idle for the `idle_after` the limiter passes in (its state
+    is fresh again by then, so expiry never changes a decision). Every
+    new key sweeps a couple of expired keys off the cold end and `sweep()`
+    (or the thread from `start_sweeper()`) clears the rest. Past
+    `max_keys` the least recently used key of the shard is evicted, which
+    only forgets the quota of the coldest client.
+    """
+
+    def __init__(self, shards=16, max_keys=None, sweep_batch=2):
+        if shards < 1 or shards & (shards - 1):
+            raise ValueError("shards must be a power of two")
+        self._shards = [_Shard() for _ in range(shards)]
+        self._mask = shards - 1
+        self.max_keys = max_keys
+        self._shard_cap = None if max_keys is None else max(1, max_keys // shards)
+        self.sweep_batch = sweep_batch
+        self._sweeper = None
+        self._stopped = threading.Event()
+
+    def _shard(self, key):
+        return self._shards[hash(key) & self._mask]
+
+    def apply(self, key, step, now, idle_after):
+        """Run `step(state, now)` for `key` under its shard lock; returns step's wait."""
+        shard = self._shards[hash(key) & self._mask]
+        with shard.lock:
+            entries = shard.entries
+            entry = entries.get(key)
+            if entry is not None and entry[1] > now:
+                wait, entry[0] = step(entry[0], now)
+                entry[1] = now + idle_after
+                entries.move_to_end(key)
+                return wait
+            # a new (or expired, hence fresh) key: the only time the table grows, so sweep here
+            wait, state = step(None, now)
+            if entry is None:
+                entries[key] = [state, now + idle_after]
+            else:
+                entry[0], entry[1] = state, now + idle_after
+                entries.move_to_end(key)
+            for _ in range(self.sweep_batch):
+                oldest = next(iter(entries.values()))
+                if oldest[1] > now:
+                    break
+                entries.popitem(last=False)
+                shard.expired += 1
+            if self._shard_cap is not None and len(entries) > self._shard_cap:
+                entries.popitem(last=False)
+                shard.evictions += 1
+        return wait
+
+    def sweep(self, now=None):
+        """Drop every expired key; returns how many went."""
+        now = time.monotonic() if now is None else now
+        dropped = 0
+        for shard in self._shards:
+            with shard.lock:
+                entries = shard.entries
+                # keys are in touch order, not expiry order, when limiters with different
+                # windows share the store, so a short-lived key may wait behind a longer one
+                while entries:
+                    oldest = next(iter(entries.values()))
+                    if oldest[1] > now:
+                        break
+                    entries.popitem(last=False)
+                    shard.expired += 1
+                    dropped += 1
+        return dropped
+
+    def start_sweeper(self, interval=1.0):
+        def run():
+            while not self._stopped.wait(interval):
+                self.sweep()
+
+        self._sweeper = threading.Thread(target=run, daemon=True)
+        self._sweeper.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def get(self, key, default=None):
+        entry = self._shard(key).entries.get(key)
+        return default if entry is None else entry[0]
+
+    def values(self):
+        for shard in self._shards:
+            with shard.lock:
+                states = [entry[0] for entry in shard.entries.values()]
+            yield from states
+
+    @property
+    def evictions(self):
+        return sum(shard.evictions for shard in self._shards)
+
+    @property
+    def expired(self):
+        return sum(shard.expired for shard in self._shards)
+
+    def stats(self):
+        return {"live_keys": len(self), "evictions": self.evictions, "expired": self.expired,
+                "shards": len(self._shards), "max_keys": self.max_keys}
+
+
+class SharedMemoryStore:
+    """Limiter state in a memory-mapped file that every process opening `path` shares.
+
+    The file is a fixed hash table: buckets of `bucket` 48-byte slots, each
+    holding a key fingerprint, an expiry time and up to three numbers of
+    state, so it fits the constant-state algorithms but not sliding_log. A
+    bucket is updated under a per-stripe thread lock plus an fcntl lock on
+    the stripe's byte of the header, which other processes honour. Expired
+    slots are reused in place; when a bucket is full of live keys the one
+    idle longest is evicted. The first process sizes the file (`slots`);
+    later ones take the geometry from its header. Times in the slots are
+    time.monotonic() values, which restart from zero at boot, so the header
+    also records the boot they belong to and a file left over from an
+    earlier boot is emptied when it is opened.
+    """
+
+    MAGIC = b"RLSHM001"
+    HEADER = struct.Struct("<8sQQ16s")
+    HEADER_SIZE = 4096
+    SLOT = struct.Struct("<QdB7x3d")
+
+    def __init__(self, path, slots=1 << 20, bucket=8, stripes=256):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            boot = self._boot_id()
+            if os.fstat(self._fd).st_size < self.HEADER_SIZE:
+                slots = max(bucket, slots - slots % bucket)
+                os.ftruncate(self._fd, self.HEADER_SIZE + slots * self.SLOT.size)
+                os.pwrite(self._fd, self.HEADER.pack(self.MAGIC, slots, bucket, boot), 0)
+            magic, slots, bucket, written = self.HEADER.unpack(os.pread(self._fd, self.HEADER.size, 0))
+            if magic == self.MAGIC and written != boot:
+                # expiries from another boot's clock could lie far in the future
+                os.ftruncate(self._fd, self.HEADER_SIZE)
+                os.ftruncate(self._fd, self.HEADER_SIZE + slots * self.SLOT.size)
+                os.pwrite(self._fd, self.HEADER.pack(self.MAGIC, slots, bucket, boot), 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        if magic != self.MAGIC:
+            os.close(self._fd)
+            raise ValueError(f"{path} is not a rate limiter store")
+        self.slots = slots
+        self.bucket = bucket
+        self.buckets = slots // bucket
+        self.stripes = min(stripes, self.buckets, self.HEADER_SIZE - self.HEADER.size)
+        self._map = mmap.mmap(self._fd, self.HEADER_SIZE + slots * self.SLOT.size)
+        self._bucket = struct.Struct("<" + self.SLOT.format.lstrip("<") * bucket)
+        self._locks = [threading.Lock() for _ in range(self.stripes)]
+        self.evictions = 0
+        self.expired = 0
+
+    @staticmethod
+    def _boot_id():
+        try:
+            with open("/proc/sys/kernel/random/boot_id") as f:
+                return uuid.UUID(f.read().strip()).bytes
+        except (OSError, ValueError):
+            # no boot id: the wall-clock time of boot, to the minute, names the boot instead
+            return struct.pack("<q8x", round((time.time() - time.monotonic()) / 60))
+
+    @staticmethod
+    def _fingerprint(key):
+        # hash() differs between processes, so hash the key's text; 0 marks an empty slot
+        data = str(key).encode()
+        return (zlib.crc32(data) << 32 | zlib.adler32(data)) | 1
+
+    @staticmethod
+    def _encode(state):
+        if isinstance(state, (int, float)):
+            return 1, (float(state), 0.0, 0.0)
+        if isinstance(state, tuple) and len(state) <= 3:
+            values = [float(v) for v in state]
+            return len(values), tuple(values + [0.0] * (3 - len(values)))
+        raise ValueError("limiter state does not fit a shared memory slot (sliding_log is not supported)")
+
+    def apply(self, key, step, now, idle_after):
+        fingerprint = self._fingerprint(key)
+        index = (fingerprint >> 32) % self.buckets
+        stripe = index % self.stripes
+        first = self.HEADER_SIZE + index * self.bucket * self.SLOT.size
+        with self._locks[stripe]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self.HEADER.size + stripe)
+            try:
+                fields = self._bucket.unpack_from(self._map, first)
+                found = free = coldest = None
+                coldest_expiry = state = None
+                for i in range(0, len(fields), 6):
+                    fp, expires = fields[i], fields[i + 1]
+                    if fp == fingerprint:
+                        found = i
+                        if expires > now:
+                            size = fields[i + 2]
+                            state = fields[i + 3] if size == 1 else fields[i + 3:i + 3 + size]
+                        break
+                    if free is None and (fp == 0 or expires <= now):
+                        free = i
+                    elif coldest_expiry is None or expires < coldest_expiry:
+                        coldest, coldest_expiry = i, expires
+                if found is None:
+                    if free is not None:
+                        found = free
+                        if fields[free]:
+                            self.expired += 1
+                    else:
+                        found = coldest
+                        self.evictions += 1
+                wait, state = step(state, now)
+                size, values = self._encode(state)
+                self.SLOT.pack_into(self._map, first + found // 6 * self.SLOT.size,
+                                    fingerprint, now + idle_after, size, *values)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self.HEADER.size + stripe)
+        return wait
+
+    def sweep(self, now=None):
+        # expired slots are reused in place, there is nothing to free
+        return 0
+
+    def __len__(self):
+        now = time.monotonic()
+        live = 0
+        for offset in range(self.HEADER_SIZE, len(self._map), self.SLOT.size):
+            fp, expires = struct.unpack_from("<Qd", self._map, offset)
+            if fp and expires > now:
+                live += 1
+        return live
+
+    def values(self):
+        for offset in range(self.HEADER_SIZE, len(self._map), self.SLOT.size):
+            fp, _, size, a, b, c = self.SLOT.unpack_from(self._map, offset)
+            if fp:
+                yield a if size == 1 else (a, b, c)[:size]
+
+    def stats(self):
+        return {"live_keys": len(self), "evictions": self.evictions, "expired": self.expired,
+                "slots": self.slots, "path": self.path}
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
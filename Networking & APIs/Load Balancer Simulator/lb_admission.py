@@ -0,0 +1,259 @@
+import asyncio
+import collections
+import math
+import threading
+import time
+
+ADAPTIVE = ("aimd", "gradient")
+
+
+class ConcurrencyLimit:
+    """In-flight request limit of one backend, optionally adapted to its latency.
+
+    Both adaptive modes compare each response time with a slow EWMA of the
+    backend's latency (its "no load" baseline):
+
+    - aimd: +1/limit per success while the limit is in use, x`backoff` on an
+      error or a response slower than `tolerance` x baseline (at most once
+      per round trip).
+    - gradient: limit x clamp(tolerance x baseline / latency, 0.5, 1) plus
+      sqrt(limit) headroom, smoothed, as in Netflix's gradient limiter.
+    """
+
+    def __init__(self, max_limit, mode=None, initial=20, min_limit=1, tolerance=2.0, backoff=0.9,
+                 smoothing=0.2, baseline_alpha=0.01):
+        if mode not in (None,) + ADAPTIVE:
+            raise ValueError(f"unknown adaptive mode {mode!r}, expected one of {ADAPTIVE}")
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.mode = mode
+        self.limit = float(max_limit if mode is None else min(max_limit, initial))
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.baseline_alpha = baseline_alpha
+        self.baseline = 0.0
+        self._last_decrease = 0.0
+
+    @property
+    def allowed(self):
+        return max(self.min_limit, int(self.limit))
+
+    def update(self, inflight, latency, ok):
+        if self.mode is None:
+            return
+        if ok and latency is not None:
+            self.baseline = latency if not self.baseline else \
+                self.baseline_alpha * latency + (1 - self.baseline_alpha) * self.baseline
+        if self.mode == "aimd":
+            self._aimd(inflight, latency, ok)
+        else:
+            self._gradient(latency, ok)
+        self.limit = min(float(self.max_limit), max(float(self.min_limit), self.limit))
+
+    def _aimd(self, inflight, latency, ok):
+        slow = latency is not None and self.baseline and latency > self.tolerance * self.baseline
+        if not ok or slow:
+            now = time.monotonic()
+            if now - self._last_decrease >= (latency or self.baseline):
+                self.limit *= self.backoff
+                self._last_decrease = now
+        elif inflight * 2 >= self.limit:
+            self.limit += 1.0 / self.limit
+
+    def _gradient(self, latency, ok):
+        if not ok:
+            self.limit *= self.backoff
+            return
+        if latency is None or latency <= 0:
+            return
+        gradient = max(0.5, min(1.0, self.tolerance * self.baseline / latency))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        self.limit = (1 - self.smoothing) * self.limit + self.smoothing * target
+
+
+class _Waiter:
+    """A queued request: a threading.Event, or a future on the caller's event loop."""
+
+    __slots__ = ("event", "loop", "future")
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+        self.event = None if loop is not None else threading.Event()
+
+    def wake(self):
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+
+class AdmissionController:
+    """Per-backend concurrency limits in front of a BackendIndex, with a bounded wait queue.
+
+    A request goes to its selected backend if that backend is under its
+    limit, otherwise to the least loaded available backend with room.
+    When every backend is full it waits in a FIFO queue of at most
+    `queue_size` requests until a slot frees or its deadline passes; if the
+    queue is already full it is shed straight away. Shed requests get a
+    503, so overload costs a bounded wait instead of a pile of timeouts.
+    """
+
+    def __init__(self, index, backends, max_connections=100, queue_size=128, queue_timeout=1.0,
+                 adaptive=None, limit_options=None):
+        self.index = index
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.adaptive = adaptive
+        self.max_connections = max_connections
+        self._limit_options = limit_options or {}
+        self._limits = {}
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.queued = 0
+        self.shed_full = 0
+        self.shed_timeout = 0
+        for b in backends:
+            self.limit(b)
+
+    def limit(self, backend):
+        lim = self._limits.get(backend)
+        if lim is None:
+            lim = self._limits.setdefault(backend, ConcurrencyLimit(self.max_connections, self.adaptive,
+                                                                    **self._limit_options))
+        return lim
+
+    def forget(self, backend):
+        with self._lock:
+            self._limits.pop(backend, None)
+
+    def _take(self, backend):
+        """Reserve a slot on `backend` or the least loaded available backend; caller holds the lock."""
+        if self.index.connections(backend) < self.limit(backend).allowed:
+            chosen = backend
+        else:
+            chosen, spare = None, 0
+            for b in self.index.ring:
+                room = self.limit(b).allowed - self.index.connections(b)
+                if room > spare:
+                    chosen, spare = b, room
+            if chosen is None:
+                return None
+        self.index.acquire(chosen)
+        self.admitted += 1
+        return chosen
+
+    def reserve(self, backend):
+        """Take a slot on exactly `backend` if it has room, without queueing."""
+        with self._lock:
+            if self.index.connections(backend) >= self.limit(backend).allowed:
+                return False
+            self.index.acquire(backend)
+            self.admitted += 1
+            return True
+
+    def try_acquire(self, backend, first=False):
+        """A backend with a reserved slot, or None. Newcomers (not `first`) queue behind waiters."""
+        with self._lock:
+            if self._waiters and not first:
+                return None
+            return self._take(backend)
+
+    def _enqueue(self, waiter, front):
+        with self._lock:
+            if not front and len(self._waiters) >= self.queue_size:
+                self.shed_full += 1
+                return False
+            if front:
+                self._waiters.appendleft(waiter)
+            else:
+                self._waiters.append(waiter)
+                self.queued += 1
+            return True
+
+    def _dequeue(self, waiter, timed_out):
+        with self._lock:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+            if timed_out:
+                self.shed_timeout += 1
+
+    def acquire(self, select, deadline):
+        """Admit a request; `select()` picks its preferred backend (None if there is none).
+
+        Returns (backend, reason): backend is None when the request must be
+        shed, with reason 'no backend', 'queue full' or 'timeout'.
+        """
+        first = False
+        while True:
+            backend = select()
+            if backend is None:
+                return None, "no backend"
+            chosen = self.try_acquire(backend, first)
+            if chosen is not None:
+                self._pass_on()
+                return chosen, None
+            waiter = _Waiter()
+            if not self._enqueue(waiter, front=first):
+                return None, "queue full"
+            woken = waiter.event.wait(max(0.0, deadline - time.monotonic()))
+            self._dequeue(waiter, not woken)
+            if not woken:
+                return None, "timeout"
+            first = True
+
+    async def acquire_async(self, select, deadline):
+        loop = asyncio.get_running_loop()
+        first = False
+        while True:
+            backend = select()
+            if backend is None:
+                return None, "no backend"
+            chosen = self.try_acquire(backend, first)
+            if chosen is not None:
+                self._pass_on()
+                return chosen, None
+            waiter = _Waiter(loop)
+            if not self._enqueue(waiter, front=first):
+                return None, "queue full"
+            try:
+                await asyncio.wait_for(waiter.future, max(0.0, deadline - time.monotonic()))
+                woken = True
+            except asyncio.TimeoutError:
+                woken = False
+            self._dequeue(waiter, not woken)
+            if not woken:
+                return None, "timeout"
+            first = True
+
+    def _pass_on(self):
+        # a woken waiter that got a slot lets the next one try as well, in case more slots are free
+        with self._lock:
+            waiter = self._waiters[0] if self._waiters else None
+        if waiter is not None:
+            waiter.wake()
+
+    def release(self, backend, latency=None, ok=True):
+        with self._lock:
+            inflight = self.index.connections(backend)
+            self.index.release(backend)
+            self.limit(backend).update(inflight, latency, ok)
+            waiter = self._waiters[0] if self._waiters else None
+        if waiter is not None:
+            waiter.wake()
+
+    def stats(self):
+        return {"queue": len(self._waiters), "queue_size": self.queue_size, "admitted": self.admitted,
+                "queued": self.queued, "shed_full": self.shed_full, "shed_timeout": self.shed_timeout,
+                "limits": {b.name: {"limit": round(lim.limit, 1), "inflight": self.index.connections(b),
+                                    "baseline_ms": round(lim.baseline * 1000, 2)}
+                           for b, lim in self._limits.items()}}
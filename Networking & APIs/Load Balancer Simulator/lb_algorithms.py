@@ -0,0 +1,377 @@
+import bisect
+import collections
+import hashlib
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+class BackendIndex:
+    """Selection state kept up to date as backends change, instead of rebuilt per request.
+
+    Connection counts are tracked per index, so several LoadBalancers can
+    share Backend objects without corrupting each other's buckets.
+
+    - `ring` is an immutable tuple of available (healthy, not ejected, not
+      draining) backends, swapped on health changes, so round-robin is an index into it (O(1), lock-free).
+    - `backends` is swapped the same way by add()/remove(); `fallback` (the
+      non-draining members) is what selection falls back to when nothing is available.
+    - `_buckets[c]` holds the available backends with c active connections
+      (dicts used as insertion-ordered sets). Connections only ever move a
+      backend one bucket up or down, so least-connections is O(1) too.
+    """
+
+    def __init__(self, backends):
+        self._lock = threading.Lock()
+        self.backends = tuple(backends)
+        self.ring = ()
+        self.fallback = ()
+        self._rr = itertools.count()
+        self._conns = {b: 0 for b in self.backends}
+        self._buckets = [{}]
+        self._min = 0
+        for b in self.backends:
+            b.add_listener(self._on_health_change)
+        self.rebuild()
+
+    def rebuild(self):
+        with self._lock:
+            self._refresh()
+            self._buckets = [{}]
+            self._min = 0
+            for b in self.ring:
+                self._bucket(self._conns[b])[b] = None
+
+    def _bucket(self, count):
+        while len(self._buckets) <= count:
+            self._buckets.append({})
+        return self._buckets[count]
+
+    def _refresh(self):
+        self.ring = tuple(b for b in self.backends if b.available)
+        self.fallback = tuple(b for b in self.backends if not b.draining)
+
+    def add(self, backend):
+        with self._lock:
+            if backend in self.backends:
+                return
+            self.backends = self.backends + (backend,)
+            self._conns.setdefault(backend, 0)
+        backend.add_listener(self._on_health_change)
+        self.rebuild()
+
+    def remove(self, backend):
+        """Forget a backend; requests still running on it may release() it afterwards."""
+        backend.remove_listener(self._on_health_change)
+        with self._lock:
+            self.backends = tuple(b for b in self.backends if b is not backend)
+            if not self._conns.get(backend):
+                self._conns.pop(backend, None)
+        self.rebuild()
+
+    def _on_health_change(self, backend):
+        with self._lock:
+            self._refresh()
+            count = self._conns.get(backend, 0)
+            if backend.available:
+                self._bucket(count)[backend] = None
+                self._min = min(self._min, count)
+            else:
+                self._bucket(count).pop(backend, None)
+
+    def acquire(self, backend):
+        with self._lock:
+            backend.active_connections += 1
+            count = self._conns.get(backend, 0)
+            self._conns[backend] = count + 1
+            if self._bucket(count).pop(backend, 1) is None:
+                self._bucket(count + 1)[backend] = None
+
+    def release(self, backend):
+        with self._lock:
+            backend.active_connections = max(0, backend.active_connections - 1)
+            count = self._conns.get(backend, 0)
+            if count <= 0:
+                return
+            self._conns[backend] = count - 1
+            if count == 1 and backend not in self.backends:
+                del self._conns[backend]
+                return
+            if self._bucket(count).pop(backend, 1) is None:
+                self._buckets[count - 1][backend] = None
+                if count - 1 < self._min:
+                    self._min = count - 1
+
+    def round_robin(self):
+        ring = self.ring or self.fallback
+        if not ring:
+            return None
+        return ring[next(self._rr) % len(ring)]
+
+    def least_connections(self):
+        if not self.ring:
+            return min(self.fallback, key=self._conns.get, default=None)
+        with self._lock:
+            buckets = self._buckets
+            while self._min < len(buckets) - 1 and not buckets[self._min]:
+                self._min += 1
+            bucket = buckets[self._min]
+            return next(iter(bucket)) if bucket else None
+
+    def first(self):
+        ring = self.ring or self.fallback
+        return ring[0] if ring else None
+
+    def connections(self, backend):
+        return self._conns.get(backend, 0)
+
+
+class StickyTable:
+    """Thread-safe client -> backend-name map with LRU and TTL eviction.
+
+    Entries expire `ttl` seconds after they were last used; once `capacity`
+    entries exist the least recently used one is dropped.
+    """
+
+    def __init__(self, capacity=100000, ttl=300.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if now - entry[1] > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            entry[1] = now
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[0], entry[1] = value, now
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = [value, now]
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._expire_oldest(now)
+
+    def _expire_oldest(self, now, limit=8):
+        # amortised TTL sweep: look at a few of the least recently used entries per insert
+        for _ in range(limit):
+            if not self._entries:
+                return
+            key, entry = next(iter(self._entries.items()))
+            if now - entry[1] <= self.ttl:
+                return
+            del self._entries[key]
+            self.expirations += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"size": len(self._entries), "capacity": self.capacity, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions, "expirations": self.expirations}
+
+
+def affinity_token(backend):
+    """Opaque, stable cookie value for a backend (does not reveal its address)."""
+    return hashlib.blake2b(backend.name.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class Strategy:
+    """Base for selection algorithms; `select` must stay O(1)/O(log n) per request.
+
+    Strategies that precompute per-ring state compare `index.ring` by
+    identity, which changes whenever backend health changes.
+    """
+
+    name = None
+
+    def __init__(self, index: BackendIndex):
+        self.index = index
+
+    def select(self, client_ip, request=None):
+        raise NotImplementedError
+
+    def describe(self):
+        return self.name
+
+
+class RoundRobin(Strategy):
+    name = "roundrobin"
+
+    def select(self, client_ip, request=None):
+        return self.index.round_robin()
+
+
+class LeastConnections(Strategy):
+    name = "leastconn"
+
+    def select(self, client_ip, request=None):
+        return self.index.least_connections()
+
+
+class FirstHealthy(Strategy):
+    name = "first"
+
+    def select(self, client_ip, request=None):
+        return self.index.first()
+
+
+class SmoothWeightedRoundRobin(Strategy):
+    """Smooth weighted round-robin over Backend.weight.
+
+    The interleaved schedule (stride scheduling: each backend is due every
+    1/weight, starting half a stride in) is built once per ring with a heap
+    and then walked with a counter, so each pick is O(1).
+    """
+
+    name = "weighted"
+    MAX_SCHEDULE = 100000
+
+    def __init__(self, index):
+        super().__init__(index)
+        self._ring = None
+        self._schedule = ()
+        self._pos = itertools.count()
+
+    def _build(self, ring):
+        members = [b for b in ring if b.weight > 0] or list(ring)
+        weights = [max(1, b.weight) for b in members]
+        total = sum(weights)
+        if total > self.MAX_SCHEDULE:
+            scale = self.MAX_SCHEDULE / total
+            weights = [max(1, round(w * scale)) for w in weights]
+            total = sum(weights)
+        heap = [(0.5 / w, i) for i, w in enumerate(weights)]
+        heapq.heapify(heap)
+        schedule = []
+        for _ in range(total):
+            due, i = heapq.heappop(heap)
+            schedule.append(members[i])
+            heapq.heappush(heap, (due + 1.0 / weights[i], i))
+        self._schedule = tuple(schedule)
+        self._ring = ring
+
+    def select(self, client_ip, request=None):
+        ring = self.index.ring or self.index.fallback
+        if ring is not self._ring:
+            self._build(ring)
+        if not self._schedule:
+            return None
+        return self._schedule[next(self._pos) % len(self._schedule)]
+
+
+class PowerOfTwoChoices(Strategy):
+    """Sample two distinct backends at random and keep the less loaded one."""
+
+    name = "p2c"
+
+    def __init__(self, index, rng=None):
+        super().__init__(index)
+        self._rng = rng or random.Random()
+
+    def select(self, client_ip, request=None):
+        ring = self.index.ring or self.index.fallback
+        if len(ring) < 2:
+            return ring[0] if ring else None
+        i = self._rng.randrange(len(ring))
+        j = self._rng.randrange(len(ring) - 1)
+        if j >= i:
+            j += 1
+        a, b = ring[i], ring[j]
+        return a if self.index.connections(a) <= self.index.connections(b) else b
+
+
+class ConsistentHash(Strategy):
+    """Hash ring with virtual nodes, keyed on the client IP or a request header.
+
+    key is "ip" or "header:<Name>"; requests missing the header fall back
+    to the client IP. When a backend leaves the ring only the keys it owned
+    move, which keeps per-backend caches warm.
+    """
+
+    name = "hash"
+
+    def __init__(self, index, key="ip", vnodes=160):
+        super().__init__(index)
+        self.key = key
+        self.vnodes = vnodes
+        self._header = key.split(":", 1)[1].strip() if key.lower().startswith("header:") else None
+        self._ring = None
+        self._points = []
+        self._owners = []
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def _build(self, ring):
+        points = sorted((self._hash(f"{b.name}#{i}"), b)
+                        for b in ring for i in range(self.vnodes * max(1, b.weight)))
+        self._points = [p for p, _ in points]
+        self._owners = [b for _, b in points]
+        self._ring = ring
+
+    def key_for(self, client_ip, request=None):
+        if self._header and request is not None:
+            value = request.header(self._header)
+            if value:
+                return value
+        return client_ip
+
+    def select(self, client_ip, request=None):
+        ring = self.index.ring or self.index.fallback
+        if ring is not self._ring:
+            self._build(ring)
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, self._hash(self.key_for(client_ip, request)))
+        return self._owners[i % len(self._owners)]
+
+    def describe(self):
+        return f"{self.name}({self.key}, vnodes={self.vnodes})"
+
+
+ALGORITHMS = {cls.name: cls for cls in
+              (RoundRobin, LeastConnections, SmoothWeightedRoundRobin, PowerOfTwoChoices,
+               ConsistentHash, FirstHealthy)}
+ALIASES = {"rr": "roundrobin", "least": "leastconn", "wrr": "weighted",
+           "pow2": "p2c", "chash": "hash"}
+
+
+def make_strategy(name, index, **options):
+    name = ALIASES.get(name, name)
+    if name not in ALGORITHMS:
+        raise ValueError(f"unknown algorithm {name!r}, expected one of {sorted(ALGORITHMS)}")
+    return ALGORITHMS[name](index, **options)
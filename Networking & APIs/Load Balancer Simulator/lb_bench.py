@@ -0,0 +1,898 @@
+import argparse
+import asyncio
+import collections
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+from lb_simulator import (LoadBalancer, HealthChecker, Backend, create_backends, start_test_backend,
+                          ENGINES)
+from lb_workers import WorkerPool
+from lb_farm import BackendFarm, BackendProfile, load_farm
+from lb_algorithms import BackendIndex, ALGORITHMS
+from lb_metrics import LatencyHistogram
+from lb_http import ResponseFramer
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+def _lb_process_main(ready, stop, results, lb_kwargs, num_backends, backend_port, backend_keepalive,
+                     external_backends=None, backend_delays=(), backend_capacity=None, backend_profiles=(),
+                     farm_engine="threaded"):
+    farm = None
+    if external_backends:
+        backends, servers = [Backend(h, p, n) for h, p, n in external_backends], []
+    elif backend_profiles:
+        farm = BackendFarm(backend_profiles, start_port=backend_port, engine=farm_engine, count=num_backends)
+        backends, servers = farm.start(), farm.servers
+    else:
+        backends, servers = create_backends(num=num_backends, start_port=backend_port, host="127.0.0.1",
+                                            keepalive=backend_keepalive, delays=backend_delays,
+                                            capacity=backend_capacity)
+    hc = HealthChecker(backends, interval=5.0, timeout=2.0, use_http_health=True)
+    hc.start()
+    lb = LoadBalancer(backends=backends, **lb_kwargs)
+    lb.start()
+    time.sleep(0.5)
+    base_accepted = sum(srv.accepted for srv in servers)
+    base_served = sum(srv.served for srv in servers)
+    cpu_start = time.process_time()
+    ready.set()
+    peak = 0
+    while not stop.wait(0.05):
+        peak = max(peak, threading.active_count())
+    results.put({
+        "peak_threads": peak,
+        "cpu_s": time.process_time() - cpu_start,
+        "backend_connections": sum(srv.accepted for srv in servers) - base_accepted,
+        "backend_requests": sum(srv.served for srv in servers) - base_served,
+        "cache": lb.cache.stats() if lb.cache is not None else None,
+        "pools": {b.name: b.pool.stats() for b in backends},
+        "farm": farm.stats() if farm is not None else None,
+    })
+    lb.stop()
+    hc.stop()
+    for s in servers:
+        s.shutdown()
+
+
+class LBProcess:
+    """Runs backends + LoadBalancer in a child process so the client does not share its GIL.
+
+    Server-side counters collected by the child are available as `stats`
+    once the context exits. With `external_backends` ((host, port, name)
+    tuples) no test backends are started in the child, so its `cpu_s` is
+    the load balancer's alone. `backend_delays` (seconds) are given to the
+    test backends in turn; `backend_capacity` bounds their parallelism.
+    With `backend_profiles` (BackendProfile specs, cycled over the
+    backends) a lb_farm.BackendFarm served by `farm_engine` runs instead.
+    """
+
+    def __init__(self, port=8090, num_backends=3, backend_port=9101, backend_keepalive=True,
+                 external_backends=None, backend_delays=(), backend_capacity=None, backend_profiles=(),
+                 farm_engine="threaded", **lb_kwargs):
+        self.port = port
+        self.stats = {}
+        lb_kwargs.setdefault("conn_timeout", 10.0)
+        lb_kwargs.setdefault("backend_timeout", 5.0)
+        lb_kwargs.update(listen_host="127.0.0.1", listen_port=port)
+        ctx = multiprocessing.get_context("fork")
+        self._ready = ctx.Event()
+        self._stop = ctx.Event()
+        self._results = ctx.Queue()
+        self._proc = ctx.Process(target=_lb_process_main, daemon=True,
+                                 args=(self._ready, self._stop, self._results, lb_kwargs, num_backends,
+                                       backend_port, backend_keepalive, external_backends,
+                                       tuple(backend_delays), backend_capacity, tuple(backend_profiles),
+                                       farm_engine))
+
+    def __enter__(self):
+        self._proc.start()
+        if not self._ready.wait(10.0):
+            raise RuntimeError("load balancer process did not start")
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        try:
+            self.stats = self._results.get(timeout=5.0)
+        except Exception:
+            pass
+        self._proc.join(5.0)
+        if self._proc.is_alive():
+            self._proc.terminate()
+
+
+async def _read_response(reader: asyncio.StreamReader, method="GET"):
+    framer = ResponseFramer(method)
+    while not framer.done:
+        chunk = await reader.read(65536)
+        if not chunk:
+            if not framer.eof():
+                raise ConnectionError("connection closed mid-response")
+            break
+        framer.feed(chunk)
+    return framer
+
+
+async def _http_request(host, port, path="/", timeout=10.0, connection="close", until_close=False):
+    start = time.perf_counter()
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        conn = f"Connection: {connection}\r\n" if connection else ""
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\n{conn}\r\n".encode())
+        await writer.drain()
+        framer = await asyncio.wait_for(_read_response(reader), timeout)
+        if until_close:
+            await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    return framer.status, time.perf_counter() - start
+
+
+async def run_load(host, port, concurrency, total, path="/", timeout=10.0, histogram=None,
+                   connection="close", until_close=False, paths=None):
+    """`paths`, when given, is cycled through instead of requesting `path` every time."""
+    latencies = []
+    errors = {}
+    remaining = [total]
+
+    async def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            target = paths[remaining[0] % len(paths)] if paths else path
+            try:
+                status, elapsed = await _http_request(host, port, target, timeout, connection, until_close)
+            except Exception as e:
+                key = type(e).__name__
+                errors[key] = errors.get(key, 0) + 1
+                continue
+            if status != 200:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+            else:
+                latencies.append(elapsed)
+                if histogram is not None:
+                    histogram.record(elapsed)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "ok": len(latencies),
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "rps": round(len(latencies) / duration, 1) if duration else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def bench_engines(args):
+    results = []
+    for engine in args.engines:
+        with LBProcess(port=args.port, num_backends=args.backends, engine=engine, backlog=4096) as proc:
+            for c in args.concurrency:
+                r = asyncio.run(run_load("127.0.0.1", args.port, c, max(args.requests, c)))
+                r["engine"] = engine
+                results.append(r)
+                print(f"[bench] engine={engine:8} conc={c:5} ok={r['ok']:6} err={sum(r['errors'].values()):5} "
+                      f"rps={r['rps']:8} p50={r['p50_ms']}ms p99={r['p99_ms']}ms")
+        print(f"[bench] {engine} engine peak threads: {proc.stats.get('peak_threads')}")
+    return results
+
+
+def bench_framing(args):
+    """Time until the LB finishes a response: legacy 1s idle-wait reader vs. framing-aware reads.
+
+    Backends keep their connections alive and the LB closes each client
+    connection once it considers the response complete, which is exactly
+    what the idle-wait reader delays.
+    """
+    results = []
+    for framing in (False, True):
+        label = "framed" if framing else "idle-wait"
+        hist = LatencyHistogram()
+        with LBProcess(port=args.port, num_backends=args.backends, backend_keepalive=True,
+                       engine=args.engine, response_framing=framing, max_requests_per_conn=1):
+            asyncio.run(run_load("127.0.0.1", args.port, args.concurrency, args.requests,
+                                 histogram=hist, connection=None, until_close=True))
+        summary = hist.summary()
+        summary.update(mode=label, engine=args.engine)
+        results.append(summary)
+        print(f"\n[bench] {label} ({args.engine}): {hist.summary()}")
+        print(hist.render())
+    return results
+
+
+def bench_pool(args):
+    """Per-request upstream connections vs. the per-Backend keep-alive pool."""
+    results = []
+    for keepalive in (False, True):
+        label = "pooled" if keepalive else "connect-per-request"
+        hist = LatencyHistogram()
+        with LBProcess(port=args.port, num_backends=args.backends, engine=args.engine,
+                       upstream_keepalive=keepalive) as proc:
+            r = asyncio.run(run_load("127.0.0.1", args.port, args.concurrency, args.requests, histogram=hist))
+        r.update(hist.summary(), mode=label, engine=args.engine,
+                 backend_connections=proc.stats.get("backend_connections"))
+        results.append(r)
+        print(f"[bench] {label:20} rps={r['rps']:8} p50={r['p50_ms']}ms p99={r['p99_ms']}ms "
+              f"backend connections={r['backend_connections']} for {r['ok']} requests")
+    return results
+
+
+def bench_cache(args):
+    """Backend offload from the response cache on a Zipf-distributed set of hot URLs."""
+    rng = random.Random(args.seed)
+    urls = [f"/item/{i}" for i in range(args.urls)]
+    weights = [1.0 / (rank + 1) ** 1.1 for rank in range(args.urls)]
+    paths = rng.choices(urls, weights=weights, k=args.requests)
+    results = []
+    for cache_mb in (0, args.cache_mb):
+        label = f"cache {cache_mb}MB" if cache_mb else "no cache"
+        hist = LatencyHistogram()
+        with LBProcess(port=args.port, num_backends=args.backends, engine=args.engine,
+                       cache_bytes=cache_mb * 1048576) as proc:
+            r = asyncio.run(run_load("127.0.0.1", args.port, args.concurrency, args.requests,
+                                     histogram=hist, paths=paths))
+        r.update(hist.summary(), mode=label, engine=args.engine,
+                 backend_requests=proc.stats.get("backend_requests"), cache=proc.stats.get("cache"))
+        results.append(r)
+        hit_rate = (r["cache"] or {}).get("hit_rate", 0.0)
+        print(f"[bench] {label:12} rps={r['rps']:8} p50={r['p50_ms']}ms p99={r['p99_ms']}ms "
+              f"backend requests={r['backend_requests']} for {r['ok']} responses (hit rate {hit_rate})")
+    return results
+
+
+def bench_overload(args):
+    """Latency and shedding past saturation: no limits vs. static and adaptive per-backend limits.
+
+    Requests arrive open loop (Poisson at --rate, whether or not earlier
+    ones finished) and each test backend works on at most
+    --backend-capacity requests at a time, so load beyond the backends'
+    capacity queues inside them unless the LB holds it back.
+    """
+    delays = [ms / 1000.0 for ms in args.backend_delay_ms]
+    modes = [("unlimited", {}),
+             (f"max-conns {args.max_conns}", {"max_connections": args.max_conns}),
+             ("aimd", {"max_connections": args.max_conns * 4, "adaptive_concurrency": "aimd"}),
+             ("gradient", {"max_connections": args.max_conns * 4, "adaptive_concurrency": "gradient"})]
+    results = []
+    for label, admission in modes:
+        with LBProcess(port=args.port, num_backends=args.backends, backend_delays=delays,
+                       backend_capacity=args.backend_capacity, engine=args.engine, backlog=4096,
+                       queue_size=args.queue_size, queue_timeout=args.queue_timeout,
+                       outlier_detection=False, **admission):
+            hist, errors = asyncio.run(run_open_load("127.0.0.1", args.port, args.rate, args.duration,
+                                                     timeout=args.timeout))
+        row = {"mode": label, "engine": args.engine, "offered_rps": args.rate, "ok": hist.total,
+               "errors": errors, "goodput_rps": round(hist.total / args.duration, 1)}
+        row.update(hist.summary())
+        results.append(row)
+        print(f"[bench] {label:14} goodput={row['goodput_rps']:7}rps p50={row['p50_ms']}ms p99={row['p99_ms']}ms "
+              f"max={row['max_ms']}ms errors={errors}")
+    return results
+
+
+async def run_open_load(host, port, rate, duration, path="/", timeout=10.0, seed=1):
+    """Open-loop load: Poisson arrivals at `rate`/s for `duration` seconds over reused keep-alive clients."""
+    rng = random.Random(seed)
+    hist = LatencyHistogram()
+    errors = {}
+    idle = []
+    pending = set()
+
+    async def one():
+        client = idle.pop() if idle else _VirtualClient(host, port, True, timeout)
+        start = time.perf_counter()
+        try:
+            framer = await client.request(path, b"")
+        except Exception as e:
+            client.close()
+            key = type(e).__name__
+            errors[key] = errors.get(key, 0) + 1
+            return
+        idle.append(client)
+        if framer.status == 200:
+            hist.record(time.perf_counter() - start)
+        else:
+            errors[str(framer.status)] = errors.get(str(framer.status), 0) + 1
+
+    start = time.perf_counter()
+    next_at = start
+    while next_at < start + duration:
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.ensure_future(one())
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        next_at += rng.expovariate(rate)
+    if pending:
+        await asyncio.wait(pending)
+    for client in idle:
+        client.close()
+    return hist, errors
+
+
+def _scan_choose(backends, algo, state):
+    """The pre-index choose_backend: rebuild the healthy list and scan it per request."""
+    healthy = [b for b in backends if b.healthy]
+    if not healthy:
+        healthy = backends[:]
+    if algo == "roundrobin":
+        sel = healthy[state[0] % len(healthy)]
+        state[0] += 1
+        return sel
+    return min(healthy, key=lambda b: b.active_connections)
+
+
+def bench_algo(args):
+    """ns per selection (plus connection start/finish) for the list scan vs. BackendIndex."""
+    results = []
+    for n in args.sizes:
+        for algo in ("roundrobin", "leastconn"):
+            row = {"backends": n, "algo": algo}
+            for impl in ("scan", "index"):
+                backends = [Backend("10.0.%d.%d" % divmod(i, 256), 80) for i in range(n)]
+                for b in backends[::10]:
+                    b.healthy = False
+                index = BackendIndex(backends)
+                inflight = collections.deque()
+                state = [0]
+                start = time.perf_counter_ns()
+                for _ in range(args.iterations):
+                    if impl == "scan":
+                        b = _scan_choose(backends, algo, state)
+                        b.active_connections += 1
+                    else:
+                        b = index.round_robin() if algo == "roundrobin" else index.least_connections()
+                        index.acquire(b)
+                    inflight.append(b)
+                    if len(inflight) > 2 * n:
+                        done = inflight.popleft()
+                        if impl == "scan":
+                            done.active_connections -= 1
+                        else:
+                            index.release(done)
+                row[f"{impl}_ns"] = round((time.perf_counter_ns() - start) / args.iterations)
+            row["speedup"] = round(row["scan_ns"] / row["index_ns"], 1)
+            results.append(row)
+            print(f"[bench] backends={n:5} algo={algo:10} scan={row['scan_ns']:8}ns/op "
+                  f"index={row['index_ns']:6}ns/op speedup={row['speedup']}x")
+    return results
+
+
+def bench_health(args):
+    """Time for one full health sweep over a large pool with live, refusing and silent backends."""
+    live, _ = create_backends(num=args.live_servers, start_port=args.port, host="127.0.0.1")
+    tarpit = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tarpit.bind(("127.0.0.1", 0))
+    tarpit.listen(4096)  # never accept()ed: connects complete, probes time out
+    tarpit_port = tarpit.getsockname()[1]
+    refused = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    refused.bind(("127.0.0.1", 0))
+    refused_port = refused.getsockname()[1]
+    refused.close()
+
+    backends, expected = [], {}
+    for i in range(args.backends):
+        kind = ("live", "live", "refused", "silent")[i % 4]
+        if kind == "live":
+            src = live[i % len(live)]
+            b = Backend(src.host, src.port, f"live-{i}")
+        else:
+            b = Backend("127.0.0.1", tarpit_port if kind == "silent" else refused_port, f"{kind}-{i}")
+        backends.append(b)
+        expected[b] = kind == "live"
+
+    hc = HealthChecker(backends, interval=args.interval, timeout=args.timeout, rise=1, fall=1)
+    start = time.time()
+    hc.start()
+    while min(b.last_checked for b in backends) < start:
+        time.sleep(0.01)
+    sweep = time.time() - start
+    time.sleep(args.interval * 2)
+    probes = hc.probes
+    hc.stop()
+    tarpit.close()
+    wrong = sum(1 for b in backends if b.healthy != expected[b])
+    silent = sum(1 for b in backends if b.name.startswith("silent"))
+    result = {
+        "backends": len(backends),
+        "interval_s": args.interval,
+        "timeout_s": args.timeout,
+        "first_sweep_s": round(sweep, 3),
+        "sequential_estimate_s": round(silent * args.timeout, 1),
+        "probes_per_s": round(probes / (time.time() - start), 1),
+        "misclassified": wrong,
+    }
+    print(f"[bench] {result['backends']} backends: first full sweep in {result['first_sweep_s']}s "
+          f"(interval {args.interval}s; a serial checker needs >= {result['sequential_estimate_s']}s), "
+          f"{result['probes_per_s']} probes/s, misclassified={wrong}")
+    return [result]
+
+
+def _backend_process_main(port, name, stop):
+    srv = start_test_backend("127.0.0.1", port, name, keepalive=True)
+    stop.wait()
+    srv.shutdown()
+
+
+def _load_process_main(port, concurrency, total, results):
+    hist = LatencyHistogram()
+    r = asyncio.run(run_load("127.0.0.1", port, concurrency, total, histogram=hist))
+    results.put((r, hist))
+
+
+def _wait_for_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1.0).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+def bench_workers(args):
+    """Throughput vs. number of SO_REUSEPORT workers.
+
+    Backends and load generators each run in their own processes so
+    neither side shares a GIL with the workers being measured.
+    """
+    ctx = multiprocessing.get_context("fork")
+    stop_backends = ctx.Event()
+    backend_procs = [ctx.Process(target=_backend_process_main, daemon=True,
+                                 args=(args.backend_port + i, f"BE-{i + 1}", stop_backends))
+                     for i in range(args.backends)]
+    for p in backend_procs:
+        p.start()
+    for i in range(args.backends):
+        _wait_for_port(args.backend_port + i)
+
+    results = []
+    try:
+        for n in args.workers:
+            backends = [Backend("127.0.0.1", args.backend_port + i, f"BE-{i + 1}") for i in range(args.backends)]
+            pool = WorkerPool(backends, workers=n, listen_host="127.0.0.1", listen_port=args.port,
+                              engine=args.engine, backlog=4096, conn_timeout=10.0, backend_timeout=5.0)
+            pool.start()
+            hc = HealthChecker(backends, interval=1.0, timeout=1.0)
+            hc.start()
+            try:
+                _wait_for_port(args.port)
+                time.sleep(0.3)
+                queue = ctx.Queue()
+                per_client = args.requests // args.clients
+                clients = [ctx.Process(target=_load_process_main, daemon=True,
+                                       args=(args.port, args.concurrency, per_client, queue))
+                           for _ in range(args.clients)]
+                start = time.perf_counter()
+                for c in clients:
+                    c.start()
+                hist, ok, errors = LatencyHistogram(), 0, 0
+                for _ in clients:
+                    r, h = queue.get(timeout=300)
+                    hist.merge(h)
+                    ok += r["ok"]
+                    errors += sum(r["errors"].values())
+                duration = time.perf_counter() - start
+                for c in clients:
+                    c.join()
+            finally:
+                hc.stop()
+                pool.stop()
+            row = {"workers": n, "engine": args.engine, "cpus": os.cpu_count(), "ok": ok, "errors": errors,
+                   "duration_s": round(duration, 3), "rps": round(ok / duration, 1)}
+            row.update(hist.summary())
+            row["speedup"] = round(row["rps"] / results[0]["rps"], 2) if results and results[0]["rps"] else 1.0
+            results.append(row)
+            print(f"[bench] workers={n:3} rps={row['rps']:9} speedup={row['speedup']}x "
+                  f"p50={row['p50_ms']}ms p99={row['p99_ms']}ms errors={errors}")
+    finally:
+        stop_backends.set()
+        for p in backend_procs:
+            p.join(5.0)
+    if os.cpu_count() and max(args.workers) > os.cpu_count():
+        print(f"[bench] note: only {os.cpu_count()} CPU(s) here; workers beyond that cannot add throughput")
+    return results
+
+
+def _bulk_exchange(sock, head, body_size, view, block):
+    """Send one request (streaming `body_size` bytes) and read the full response; returns body bytes read."""
+    sock.sendall(head)
+    sent = 0
+    while sent < body_size:
+        k = min(body_size - sent, len(block))
+        sock.sendall(block[:k])
+        sent += k
+    buf = bytearray()
+    while b"\r\n\r\n" not in buf:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("connection closed before response head")
+        buf += chunk
+    head_end = buf.index(b"\r\n\r\n") + 4
+    framer = ResponseFramer("GET")
+    framer.feed(buf[:head_end])
+    remaining = int(framer.header("Content-Length", "0")) - (len(buf) - head_end)
+    while remaining > 0:
+        n = sock.recv_into(view[:min(remaining, len(view))])
+        if not n:
+            raise ConnectionError("connection closed mid-body")
+        remaining -= n
+    if framer.status != 200:
+        raise ConnectionError(f"status {framer.status}")
+    return body_size
+
+
+def bench_splice(args):
+    """LB CPU seconds per GB proxied: buffered recv_into relay vs. os.splice (threaded engine)."""
+    ctx = multiprocessing.get_context("fork")
+    stop_backend = ctx.Event()
+    backend = ctx.Process(target=_backend_process_main, daemon=True,
+                          args=(args.backend_port, "BE-1", stop_backend))
+    backend.start()
+    _wait_for_port(args.backend_port)
+    size = args.size_mb * 1048576
+    block = memoryview(b"y" * 1048576)
+    view = memoryview(bytearray(1048576))
+    results = []
+    try:
+        for direction in args.directions:
+            for zero_copy in (False, True):
+                label = "splice" if zero_copy else "buffered"
+                with LBProcess(port=args.port, external_backends=[("127.0.0.1", args.backend_port, "BE-1")],
+                               engine="threaded", zero_copy=zero_copy) as proc:
+                    with socket.create_connection(("127.0.0.1", args.port)) as sock:
+                        if direction == "download":
+                            head = f"GET /bytes/{size} HTTP/1.1\r\nHost: lb\r\n\r\n".encode()
+                            body = 0
+                        else:
+                            head = (f"POST /upload HTTP/1.1\r\nHost: lb\r\nContent-Length: {size}\r\n\r\n").encode()
+                            body = size
+                        start = time.perf_counter()
+                        for _ in range(args.requests):
+                            _bulk_exchange(sock, head, body, view, block)
+                        elapsed = time.perf_counter() - start
+                gb = size * args.requests / 1e9
+                row = {"direction": direction, "mode": label, "gb": round(gb, 3),
+                       "seconds": round(elapsed, 3), "gbit_per_s": round(gb * 8 / elapsed, 2),
+                       "lb_cpu_s": round(proc.stats.get("cpu_s", 0.0), 3)}
+                row["lb_cpu_s_per_gb"] = round(row["lb_cpu_s"] / gb, 3) if gb else None
+                results.append(row)
+                print(f"[bench] {direction:8} {label:8} {row['gb']}GB in {row['seconds']}s "
+                      f"({row['gbit_per_s']} Gbit/s), LB CPU {row['lb_cpu_s_per_gb']} s/GB")
+    finally:
+        stop_backend.set()
+        backend.join(5.0)
+    return results
+
+
+SUITE_STICKY = "sticky"
+
+
+class _VirtualClient:
+    """One simulated user: its connection (reused when keep-alive is on) and affinity cookie."""
+
+    def __init__(self, host, port, keep_alive, timeout):
+        self.host = host
+        self.port = port
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.cookie = None
+        self._conn = None
+
+    def _head(self, path, body_size):
+        method = "POST" if body_size else "GET"
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}",
+                 f"Connection: {'keep-alive' if self.keep_alive else 'close'}"]
+        if body_size:
+            lines.append(f"Content-Length: {body_size}")
+        if self.cookie:
+            lines.append(f"Cookie: {self.cookie}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode(), method
+
+    async def request(self, path, body):
+        """One exchange; returns the ResponseFramer. A stale reused connection is retried once."""
+        head, method = self._head(path, len(body))
+        for attempt in (0, 1):
+            reused = self._conn is not None
+            if not reused:
+                self._conn = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+            reader, writer = self._conn
+            try:
+                writer.write(head + body)
+                await writer.drain()
+                framer = await asyncio.wait_for(_read_response(reader, method), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except BaseException:
+                self.close()
+                raise
+            break
+        cookie = framer.header("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0].strip()
+        if not (self.keep_alive and framer.keep_alive):
+            self.close()
+        return framer
+
+    def close(self):
+        if self._conn is not None:
+            self._conn[1].close()
+            self._conn = None
+
+
+async def run_suite_load(host, port, concurrency, total, keep_alive=True, request_bytes=0, response_bytes=0,
+                         timeout=10.0):
+    """Drive the LB from `concurrency` virtual clients; latency histogram, errors and backend spread."""
+    hist = LatencyHistogram()
+    errors = {}
+    spread = {}
+    remaining = [total]
+    path = f"/bytes/{response_bytes}" if response_bytes else "/"
+    body = b"x" * request_bytes
+
+    async def worker():
+        client = _VirtualClient(host, port, keep_alive, timeout)
+        try:
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                start = time.perf_counter()
+                try:
+                    framer = await client.request(path, body)
+                except Exception as e:
+                    key = type(e).__name__
+                    errors[key] = errors.get(key, 0) + 1
+                    continue
+                if framer.status != 200:
+                    errors[str(framer.status)] = errors.get(str(framer.status), 0) + 1
+                    continue
+                hist.record(time.perf_counter() - start)
+                backend = framer.header("X-Backend-ID", "?")
+                spread[backend] = spread.get(backend, 0) + 1
+        finally:
+            client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - start
+    return hist, errors, spread, duration
+
+
+def bench_suite(args):
+    """Throughput, tail latency and errors per algorithm under one load profile."""
+    delays = [ms / 1000.0 for ms in args.backend_delay_ms]
+    profiles, farm_engine = (), args.farm_engine
+    if args.farm:
+        profiles, engine = load_farm(args.farm)
+        farm_engine = farm_engine or engine
+    elif args.profile:
+        profiles = [BackendProfile.parse(spec) for spec in args.profile]
+    results = []
+    for name in args.algos:
+        lb_kwargs = {"algo": "roundrobin", "sticky_cookie": "LBSTICKY"} if name == SUITE_STICKY else {"algo": name}
+        with LBProcess(port=args.port, num_backends=args.backends, backend_delays=delays, engine=args.engine,
+                       backend_profiles=profiles, farm_engine=farm_engine or "threaded",
+                       backlog=4096, outlier_detection=args.outlier_detection, **lb_kwargs) as lb_proc:
+            if args.warmup:
+                asyncio.run(run_suite_load("127.0.0.1", args.port, args.concurrency, args.warmup, args.keep_alive,
+                                           args.request_bytes, args.response_bytes))
+            hist, errors, spread, duration = asyncio.run(run_suite_load(
+                "127.0.0.1", args.port, args.concurrency, args.requests, args.keep_alive,
+                args.request_bytes, args.response_bytes))
+        row = {"algo": name, "engine": args.engine, "concurrency": args.concurrency,
+               "keep_alive": args.keep_alive, "request_bytes": args.request_bytes,
+               "response_bytes": args.response_bytes, "backend_delay_ms": args.backend_delay_ms,
+               "outlier_detection": args.outlier_detection,
+               "requests": args.requests, "ok": hist.total, "errors": errors,
+               "duration_s": round(duration, 3), "rps": round(hist.total / duration, 1) if duration else 0.0,
+               "p50_ms": round(hist.percentile(50) * 1000, 3), "p99_ms": round(hist.percentile(99) * 1000, 3),
+               "p999_ms": round(hist.percentile(99.9) * 1000, 3), "max_ms": round(hist.max * 1000, 3),
+               "backends": dict(sorted(spread.items()))}
+        if profiles:
+            row["profiles"] = [p.describe() for p in profiles]
+            row["farm"] = lb_proc.stats.get("farm")
+        results.append(row)
+        print(f"[bench] {name:10} rps={row['rps']:8} p50={row['p50_ms']}ms p99={row['p99_ms']}ms "
+              f"p999={row['p999_ms']}ms errors={sum(errors.values())} spread={row['backends']}")
+        if row.get("farm"):
+            print("[bench]            max in flight: " + "  ".join(f"{b}={st['max_inflight']}"
+                                                               for b, st in row["farm"].items()))
+    return results
+
+
+def compare_suite(results, baseline_path, tolerance):
+    """Print rps/p99 changes against an earlier suite JSON; returns the algorithms that regressed."""
+    with open(baseline_path) as f:
+        baseline = {row["algo"]: row for row in json.load(f)}
+    regressed = []
+    for row in results:
+        old = baseline.get(row["algo"])
+        if old is None:
+            continue
+        rps = (row["rps"] - old["rps"]) / old["rps"] if old["rps"] else 0.0
+        p99 = (row["p99_ms"] - old["p99_ms"]) / old["p99_ms"] if old["p99_ms"] else 0.0
+        worse = rps < -tolerance or p99 > tolerance
+        if worse:
+            regressed.append(row["algo"])
+        print(f"[bench] {row['algo']:10} vs baseline: rps {rps:+.1%} p99 {p99:+.1%}"
+              f"{'  REGRESSION' if worse else ''}")
+    return regressed
+
+
+def add_suite_arguments(p):
+    p.add_argument("--algos", nargs="+", choices=sorted(ALGORITHMS) + [SUITE_STICKY],
+                   default=["roundrobin", "leastconn", SUITE_STICKY],
+                   help="algorithms to compare; 'sticky' is round robin with cookie affinity")
+    p.add_argument("--engine", choices=ENGINES, default="threaded")
+    p.add_argument("--concurrency", type=int, default=32, help="simulated clients")
+    p.add_argument("--requests", type=int, default=5000, help="requests per algorithm")
+    p.add_argument("--warmup", type=int, default=200, help="unmeasured requests before each run")
+    p.add_argument("--keep-alive", action=argparse.BooleanOptionalAction, default=True,
+                   help="reuse client connections (default: on)")
+    p.add_argument("--request-bytes", type=int, default=0, help="POST body size; 0 sends GETs")
+    p.add_argument("--response-bytes", type=int, default=0, help="GET /bytes/<n> instead of the small default page")
+    p.add_argument("--backend-delay-ms", nargs="+", type=float, default=[0.0],
+                   help="per-backend service time, assigned in turn (e.g. 1 1 20)")
+    p.add_argument("--profile", nargs="+", metavar="SPEC",
+                   help="simulated backend profiles (lb_farm.BackendProfile specs), assigned in turn, e.g. "
+                        "latency=exp:2,capacity=8 latency=lognormal:10:0.8,error_rate=0.01")
+    p.add_argument("--farm", help="JSON file of backend profiles (overrides --profile)")
+    p.add_argument("--farm-engine", choices=("threaded", "asyncio"), default=None,
+                   help="how simulated backends serve (default: threaded)")
+    p.add_argument("--outlier-detection", action=argparse.BooleanOptionalAction, default=True,
+                   help="let passive outlier detection eject slow backends (default: on)")
+    p.add_argument("--backends", type=int, default=3)
+    p.add_argument("--port", type=int, default=8090)
+    p.add_argument("--json", help="write results to this file")
+    p.add_argument("--baseline", help="earlier --json output to compare against")
+    p.add_argument("--tolerance", type=float, default=0.1,
+                   help="relative rps drop or p99 rise reported as a regression (default: 0.1)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load Balancer Simulator benchmarks")
+    sub = parser.add_subparsers(dest="command")
+
+    p = sub.add_parser("engines", help="compare client concurrency of the serving engines")
+    p.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES))
+    p.add_argument("--concurrency", nargs="+", type=int, default=[10, 100, 1000])
+    p.add_argument("--requests", type=int, default=2000, help="requests per concurrency level")
+    p.add_argument("--backends", type=int, default=3)
+    p.add_argument("--port", type=int, default=8090)
+    p.add_argument("--json", help="write results to this file")
+
+    p = sub.add_parser("framing", help="latency histograms before/after response framing")
+    p.add_argument("--engine", choices=ENGINES, default="threaded")
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--requests", type=int, default=40)
+    p.add_argument("--backends", type=int, default=3)
+    p.add_argument("--port", type=int, default=8090)
+    p.add_argument("--json", help="write results to this file")
+
+    p = sub.add_parser("pool", help="latency and backend connection count with/without upstream pooling")
+    p.add_argument("--engine", choices=ENGINES, default="threaded")
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--requests", type=int, default=3000)
+    p.add_argument("--backends", type=int, default=3)
+    p.add_argument("--port", type=int, default=8090)
+    p.add_argument("--json", help="write results to this file")
+
+    p = sub.add_parser("algo", help="micro-benchmark backend selection at several pool sizes")
+    p.add_argument("--sizes", nargs="+", type=int, default=[10, 100, 1000])
+    p.add_argument("--iterations", type=int, default=100000)
+    p.add_argument("--json", help="write results to this file")
+
+    p = sub.add_parser("health", help="full health-sweep time over a large backend pool")
+    p.add_argument("--backends", type=int, default=500)
+    p.add_argument("--live-servers", type=int, default=5)
+    p.add_argument("--interval", type=float, default=5.0)
+    p.add_argument("--timeout", type=float, default=2.0)
+    p.add_argument("--port", type=int, default=9201, help="first port for the live test backends")
+    p.add_argument("--json", help="write results to this file")
+
+    p = sub.add_parser("workers", help="throughput scaling with SO_REUSEPORT worker processes")
+    p.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4])
+    p.add_argument("--engine", choices=ENGINES, default="asyncio")
+    p.add_argument("--clients", type=int, default=4, help="load generator processes")
+    p.add_argument("--concurrency", type=int, default=32, help="connections per load generator")
+    p.add_argument("--requests", type=int, default=8000)
+    p.add_argument("--backends", type=int, default=4)
+    p.add_argument("--backend-port", type=int, default=9301)
+    p.add_argument("--port", type=int, default=8090)
+    p.add_argument("--json", help="write results to this file")
+
+    p = sub.add_parser("splice", help="LB CPU per GB proxied with and without os.splice")
+    p.add_argument("--directions", nargs="+", choices=("download", "upload"), default=["download", "upload"])
+    p.add_argument("--size-mb", type=int, default=256, help="body size per request")
+    p.add_argument("--requests", type=int, default=4, help="requests per mode and direction")
+    p.add_argument("--backend-port", type=int, default=9301)
+    p.add_argument("--port", type=int, default=8090)
+    p.add_argument("--json", help="write results to this file")
+
+    p = sub.add_parser("cache", help="backend offload and latency with the GET response cache")
+    p.add_argument("--engine", choices=ENGINES, default="asyncio")
+    p.add_argument("--cache-mb", type=int, default=16)
+    p.add_argument("--urls", type=int, default=1000, help="distinct URLs (Zipf popularity)")
+    p.add_argument("--concurrency", type=int, default=32)
+    p.add_argument("--requests", type=int, default=5000)
+    p.add_argument("--backends", type=int, default=3)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--port", type=int, default=8090)
+    p.add_argument("--json", help="write results to this file")
+
+    p = sub.add_parser("suite", help="throughput and p50/p99/p999 per algorithm (also: lb_simulator.py bench)")
+    add_suite_arguments(p)
+
+    p = sub.add_parser("overload", help="tail latency and 503 shedding with/without admission control")
+    p.add_argument("--engine", choices=ENGINES, default="asyncio")
+    p.add_argument("--rate", type=float, default=400.0, help="offered requests per second (open loop)")
+    p.add_argument("--duration", type=float, default=10.0, help="seconds of arrivals per mode")
+    p.add_argument("--max-conns", type=int, default=4, help="static per-backend limit")
+    p.add_argument("--queue-size", type=int, default=64)
+    p.add_argument("--queue-timeout", type=float, default=0.5)
+    p.add_argument("--backend-delay-ms", nargs="+", type=float, default=[50.0])
+    p.add_argument("--backend-capacity", type=int, default=4, help="requests each backend works on at once")
+    p.add_argument("--timeout", type=float, default=5.0, help="client timeout per request")
+    p.add_argument("--backends", type=int, default=3)
+    p.add_argument("--port", type=int, default=8090)
+    p.add_argument("--json", help="write results to this file")
+
+    args = parser.parse_args(argv)
+    regressed = []
+    if args.command == "engines":
+        results = bench_engines(args)
+    elif args.command == "framing":
+        results = bench_framing(args)
+    elif args.command == "pool":
+        results = bench_pool(args)
+    elif args.command == "algo":
+        results = bench_algo(args)
+    elif args.command == "health":
+        results = bench_health(args)
+    elif args.command == "workers":
+        results = bench_workers(args)
+    elif args.command == "splice":
+        results = bench_splice(args)
+    elif args.command == "cache":
+        results = bench_cache(args)
+    elif args.command == "overload":
+        results = bench_overload(args)
+    elif args.command == "suite":
+        results = bench_suite(args)
+        if args.baseline:
+            regressed = compare_suite(results, args.baseline, args.tolerance)
+    else:
+        parser.print_help()
+        return
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressed:
+        print(f"[bench] regressed against {args.baseline}: {', '.join(regressed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
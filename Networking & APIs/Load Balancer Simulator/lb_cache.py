@@ -0,0 +1,375 @@
+import asyncio
+import collections
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
+
+from lb_http import RequestHead, build_head
+
+CACHEABLE_STATUS = {200, 203, 300, 301, 404, 410}
+CONDITIONAL = ("if-none-match", "if-modified-since")
+
+
+def _cache_control(value):
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('"')
+    return directives
+
+
+def _header(headers, name, default=None):
+    name = name.lower()
+    for k, v in headers:
+        if k.lower() == name:
+            return v
+    return default
+
+
+def _weak(etag):
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def _http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class FrequencySketch:
+    """Count-min sketch of recent key popularity for TinyLFU admission.
+
+    Four rows of saturating 4-bit counters (stored in bytearrays); after
+    `sample` increments every counter is halved so old popularity fades.
+    """
+
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0x85EBCA77C2B2AE63)
+
+    def __init__(self, width=4096):
+        self.width = 1 << max(4, (width - 1).bit_length())
+        self.rows = [bytearray(self.width) for _ in self.SEEDS]
+        self.sample = 10 * self.width
+        self.additions = 0
+
+    def _slots(self, key):
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        mask = self.width - 1
+        return [((h * seed) & 0xFFFFFFFFFFFFFFFF) >> 40 & mask for seed in self.SEEDS]
+
+    def increment(self, key):
+        for row, i in zip(self.rows, self._slots(key)):
+            if row[i] < 15:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample:
+            self.rows = [bytearray(c >> 1 for c in row) for row in self.rows]
+            self.additions //= 2
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self.rows, self._slots(key)))
+
+
+class CacheEntry:
+    __slots__ = ("key", "version", "status", "headers", "body", "stored_at", "expires_at",
+                 "etag", "last_modified", "size")
+
+    def __init__(self, key, version, status, headers, body, stored_at, ttl):
+        self.key = key
+        self.version = version or "HTTP/1.1"
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.stored_at = stored_at
+        self.expires_at = stored_at + ttl
+        self.etag = _header(headers, "ETag")
+        self.last_modified = _header(headers, "Last-Modified")
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers) + 64
+
+    def fresh(self, now):
+        return now < self.expires_at
+
+
+class _Fill:
+    """One in-flight upstream fetch that concurrent misses for the same key wait on."""
+
+    def __init__(self):
+        self.entry = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._waiters = []
+
+    def wait(self, timeout):
+        return self._event.wait(timeout)
+
+    async def wait_async(self, timeout):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        with self._lock:
+            if self._event.is_set():
+                return True
+            self._waiters.append((loop, fut))
+        try:
+            await asyncio.wait_for(fut, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def finish(self, entry):
+        with self._lock:
+            self.entry = entry
+            self._event.set()
+            waiters, self._waiters = self._waiters, []
+        for loop, fut in waiters:
+            loop.call_soon_threadsafe(_resolve, fut)
+
+
+def _resolve(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+
+class CaptureSink:
+    """Stands in for the client while a response may be stored in the cache.
+
+    Holds up to `limit` bytes (the first write is the response head); past
+    that the held bytes are flushed and everything passes straight through,
+    so large responses are never buffered. Works for a socket (`sendall`)
+    or an asyncio StreamWriter (`write` + `drain`).
+    """
+
+    def __init__(self, send, limit, drain=None):
+        self.limit = limit
+        self.passthrough = False
+        self._send = send
+        self._drain = drain
+        self._parts = []
+        self._size = 0
+
+    def write(self, data):
+        if self.passthrough:
+            self._send(data)
+            return
+        self._parts.append(bytes(data))
+        self._size += len(data)
+        if self._size > self.limit:
+            self.flush()
+
+    sendall = write
+
+    async def drain(self):
+        if self.passthrough and self._drain is not None:
+            await self._drain()
+
+    def flush(self):
+        parts, self._parts = self._parts, []
+        self.passthrough = True
+        if parts:
+            self._send(b"".join(parts))
+
+    @property
+    def body(self):
+        return b"".join(self._parts[1:])
+
+
+class ResponseCache:
+    """Shared HTTP cache for GET responses, consulted before choose_backend.
+
+    - Freshness comes from Cache-Control (s-maxage, max-age) or Expires;
+      responses with neither use `default_ttl`. no-store, private, Vary,
+      Set-Cookie and requests carrying Authorization are never cached;
+      no-cache entries are stored but revalidated on every use.
+    - Stale entries with an ETag or Last-Modified are revalidated with
+      If-None-Match / If-Modified-Since; a 304 refreshes them in place.
+    - Entries are kept in LRU order within `max_bytes`. When space is
+      needed, TinyLFU admission compares the candidate's recent request
+      frequency with the LRU victim's and drops the less popular one, so
+      one-off URLs cannot flush hot content.
+    - Concurrent misses for one key share a single upstream fetch.
+    """
+
+    def __init__(self, max_bytes=64 * 1048576, max_object_bytes=1048576, default_ttl=0.0):
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.default_ttl = default_ttl
+        self.bytes = 0
+        self._entries = collections.OrderedDict()
+        self._fills = {}
+        self._sketch = FrequencySketch(max(1024, max_bytes // 16384))
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.coalesced = 0
+        self.stores = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    @staticmethod
+    def key(request: RequestHead):
+        return (request.header("Host", ""), request.target)
+
+    @staticmethod
+    def accepts(request: RequestHead):
+        if request.method != "GET" or request.header("Authorization") is not None:
+            return False
+        return "no-store" not in _cache_control(request.header("Cache-Control"))
+
+    def lookup(self, key, request: RequestHead):
+        """Return (entry, fresh); entry is None on a miss."""
+        now = time.time()
+        with self._lock:
+            self._sketch.increment(key)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            self._entries.move_to_end(key)
+            request_cc = _cache_control(request.header("Cache-Control"))
+            fresh = entry.fresh(now) and "no-cache" not in request_cc
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry, fresh
+
+    def begin_fill(self, key):
+        """Return (fill, leader): the leader fetches, everyone else waits on `fill`."""
+        with self._lock:
+            fill = self._fills.get(key)
+            if fill is not None:
+                self.coalesced += 1
+                return fill, False
+            fill = self._fills[key] = _Fill()
+            return fill, True
+
+    def end_fill(self, key, fill, entry):
+        with self._lock:
+            self._fills.pop(key, None)
+        fill.finish(entry)
+
+    @staticmethod
+    def upstream_request(request: RequestHead, entry):
+        """The request to send upstream: client validators replaced by the cached entry's."""
+        extra = []
+        if entry is not None and entry.etag:
+            extra.append(("If-None-Match", entry.etag))
+        if entry is not None and entry.last_modified:
+            extra.append(("If-Modified-Since", entry.last_modified))
+        if not extra and not any(k.lower() in CONDITIONAL for k, _ in request.headers):
+            return request
+        return request.with_headers(extra, drop=CONDITIONAL)
+
+    def _ttl(self, headers, now):
+        cc = _cache_control(_header(headers, "Cache-Control"))
+        if "no-store" in cc or "private" in cc:
+            return None
+        if "no-cache" in cc:
+            return 0.0
+        for directive in ("s-maxage", "max-age"):
+            if directive in cc:
+                try:
+                    return max(0.0, float(cc[directive]))
+                except ValueError:
+                    return 0.0
+        expires = _header(headers, "Expires")
+        if expires is not None:
+            expires_at = _http_date(expires)
+            date = _http_date(_header(headers, "Date")) or now
+            return max(0.0, expires_at - date) if expires_at is not None else 0.0
+        return self.default_ttl
+
+    def store(self, key, version, status, headers, body):
+        """Cache a complete response if it is storable; returns the entry or None."""
+        if status not in CACHEABLE_STATUS or len(body) > self.max_object_bytes:
+            return None
+        if _header(headers, "Vary") or _header(headers, "Set-Cookie"):
+            return None
+        now = time.time()
+        ttl = self._ttl(headers, now)
+        if ttl is None:
+            return None
+        entry = CacheEntry(key, version, status, headers, body, now, ttl)
+        if ttl == 0 and not (entry.etag or entry.last_modified):
+            return None
+        with self._lock:
+            old = self._entries.get(key)
+            if not self._make_room(key, entry.size, old):
+                self.rejected += 1
+                return None
+            if old is not None:
+                del self._entries[key]
+                self.bytes -= old.size
+            self._entries[key] = entry
+            self.bytes += entry.size
+            self.stores += 1
+        return entry
+
+    def _make_room(self, key, size, old=None):
+        # pick every victim and check admission first, so a rejected candidate evicts nothing
+        if size > self.max_bytes:
+            return False
+        needed = self.bytes - (old.size if old is not None else 0) + size - self.max_bytes
+        victims = []
+        if needed > 0:
+            candidate = self._sketch.estimate(key)
+            for victim_key, victim in self._entries.items():
+                if victim_key == key:
+                    continue
+                if self._sketch.estimate(victim_key) > candidate:
+                    return False
+                victims.append(victim)
+                needed -= victim.size
+                if needed <= 0:
+                    break
+        for victim in victims:
+            del self._entries[victim.key]
+            self.bytes -= victim.size
+            self.evictions += 1
+        return True
+
+    def refresh(self, entry, headers):
+        """Apply a 304's headers to a stored entry and restart its freshness."""
+        now = time.time()
+        updated = {k.lower() for k, _ in headers}
+        with self._lock:
+            merged = [(k, v) for k, v in entry.headers if k.lower() not in updated]
+            merged.extend((k, v) for k, v in headers if k.lower() not in ("content-length", "transfer-encoding"))
+            entry.headers = merged
+            ttl = self._ttl(merged, now)
+            entry.stored_at = now
+            entry.expires_at = now + (ttl or 0.0)
+            entry.etag = _header(merged, "ETag")
+            entry.last_modified = _header(merged, "Last-Modified")
+            self.revalidated += 1
+
+    def render(self, entry, request: RequestHead, connection):
+        """Serialized response for a client: a 304 if its validators match, else the stored one."""
+        age = ("Age", str(int(max(0.0, time.time() - entry.stored_at))))
+        inm = request.header("If-None-Match")
+        if entry.etag and inm and (inm.strip() == "*" or _weak(entry.etag) in
+                                   {_weak(t.strip()) for t in inm.split(",")}):
+            headers = [(k, v) for k, v in entry.headers
+                       if k.lower() not in ("content-length", "transfer-encoding", "content-type")]
+            return build_head(f"{entry.version} 304 Not Modified", headers, connection, (age,))
+        try:
+            reason = HTTPStatus(entry.status).phrase
+        except ValueError:
+            reason = ""
+        first = f"{entry.version} {entry.status} {reason}".rstrip()
+        return build_head(first, entry.headers, connection, (age,)) + entry.body
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "revalidated": self.revalidated, "coalesced": self.coalesced, "stores": self.stores,
+                "evictions": self.evictions, "rejected": self.rejected}
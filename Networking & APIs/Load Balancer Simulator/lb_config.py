@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+
+
+def parse_backends(data):
+    """Backend entries from a decoded config: a list, or {"backends": [...]}.
+
+    Each entry is "host:port" or {"host": ..., "port": ..., "name": ..., "weight": ...}
+    (name and weight optional). Returns a list of dicts; raises ValueError.
+    """
+    if isinstance(data, dict):
+        data = data.get("backends")
+    if not isinstance(data, list):
+        raise ValueError('expected a list of backends or {"backends": [...]}')
+    entries = []
+    for item in data:
+        if isinstance(item, str):
+            host, sep, port = item.rpartition(":")
+            if not sep:
+                raise ValueError(f"backend {item!r} is not host:port")
+            item = {"host": host, "port": port}
+        if not isinstance(item, dict) or "host" not in item or "port" not in item:
+            raise ValueError(f"backend {item!r} needs host and port")
+        try:
+            entry = {"host": str(item["host"]), "port": int(item["port"]), "weight": int(item.get("weight", 1))}
+        except (TypeError, ValueError):
+            raise ValueError(f"backend {item!r} has a non-numeric port or weight") from None
+        if not 0 < entry["port"] < 65536 or entry["weight"] < 0:
+            raise ValueError(f"backend {item!r} is out of range")
+        if item.get("name"):
+            entry["name"] = str(item["name"])
+        entries.append(entry)
+    return entries
+
+
+def load_config(path):
+    with open(path) as f:
+        try:
+            return parse_backends(json.load(f))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path}: {e}") from None
+
+
+class ConfigWatcher(threading.Thread):
+    """Polls a JSON backend list and hands every valid new version to `apply(entries)`.
+
+    A change is noticed through the file's mtime and size. Invalid files
+    are reported and ignored, so a half-written edit never empties the
+    pool; write the file elsewhere and rename it over for atomic updates.
+    """
+
+    def __init__(self, path, apply, interval=1.0):
+        super().__init__(daemon=True)
+        self.path = path
+        self.apply = apply
+        self.interval = interval
+        self.reloads = 0
+        self._seen = None
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def check(self):
+        """Reload if the file changed; returns True if a new config was applied."""
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            if self._seen is not None:
+                print(f"[config] cannot read {self.path}: {e}")
+                self._seen = None
+            return False
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self._seen:
+            return False
+        self._seen = stamp
+        try:
+            entries = load_config(self.path)
+        except (OSError, ValueError) as e:
+            print(f"[config] ignoring {self.path}: {e}")
+            return False
+        added, removed, updated = self.apply(entries)
+        self.reloads += 1
+        print(f"[config] {self.path}: {len(entries)} backends ({added} added, {removed} removed, {updated} updated)")
+        return True
+
+    def run(self):
+        while True:
+            self.check()
+            if self._stopped.wait(self.interval):
+                return
@@ -0,0 +1,484 @@
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+from lb_http import RequestHead, MAX_HEADER_BYTES
+from lb_simulator import Backend, TestBackendServer
+
+FARM_ENGINES = ("threaded", "asyncio")
+
+
+class Latency:
+    """Service-time distribution. Times are given in ms, `sample()` returns seconds.
+
+    const:MS             always MS
+    uniform:LO:HI        uniform between LO and HI
+    exp:MEAN             exponential (M/M/1-style service times)
+    lognormal:MEDIAN:S   median MEDIAN, shape S (typical real-service tails)
+    pareto:MIN:ALPHA     heavy tail above MIN; smaller ALPHA means a longer tail
+    bimodal:FAST:SLOW:P  FAST, except a fraction P of requests take SLOW
+    """
+
+    KINDS = {"const": 1, "uniform": 2, "exp": 1, "lognormal": 2, "pareto": 2, "bimodal": 3}
+
+    def __init__(self, kind="const", *params):
+        if kind not in self.KINDS:
+            raise ValueError(f"unknown latency distribution {kind!r}, expected one of {sorted(self.KINDS)}")
+        if len(params) != self.KINDS[kind]:
+            raise ValueError(f"{kind} latency takes {self.KINDS[kind]} parameter(s), got {len(params)}")
+        self.kind = kind
+        self.params = tuple(float(p) for p in params)
+
+    @classmethod
+    def parse(cls, spec):
+        kind, *params = str(spec).split(":")
+        try:
+            return cls(kind, *params)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"bad latency {spec!r}: {e}") from None
+
+    def sample(self, rng):
+        p = self.params
+        if self.kind == "const":
+            ms = p[0]
+        elif self.kind == "uniform":
+            ms = rng.uniform(p[0], p[1])
+        elif self.kind == "exp":
+            ms = rng.expovariate(1.0 / p[0]) if p[0] > 0 else 0.0
+        elif self.kind == "lognormal":
+            ms = p[0] * math.exp(p[1] * rng.gauss(0.0, 1.0))
+        elif self.kind == "pareto":
+            ms = p[0] * rng.paretovariate(p[1])
+        else:
+            ms = p[1] if rng.random() < p[2] else p[0]
+        return ms / 1000.0
+
+    @property
+    def mean(self):
+        """Mean service time in seconds (inf for a pareto tail with ALPHA <= 1)."""
+        p = self.params
+        if self.kind == "const" or self.kind == "exp":
+            ms = p[0]
+        elif self.kind == "uniform":
+            ms = (p[0] + p[1]) / 2
+        elif self.kind == "lognormal":
+            ms = p[0] * math.exp(p[1] ** 2 / 2)
+        elif self.kind == "pareto":
+            ms = p[0] * p[1] / (p[1] - 1) if p[1] > 1 else math.inf
+        else:
+            ms = p[0] * (1 - p[2]) + p[1] * p[2]
+        return ms / 1000.0
+
+    def __str__(self):
+        return ":".join([self.kind] + [f"{p:g}" for p in self.params])
+
+
+class ScriptEvent:
+    """A scripted failure: KIND@START+DURATION seconds after the farm started.
+
+    down   connections are closed without a response and /health fails
+    hang   requests are held until the event ends, then dropped
+    slow   latency is multiplied, e.g. slow@60+10x4
+    errors the error rate is replaced, e.g. errors@20+5=0.5
+    """
+
+    KINDS = ("down", "hang", "slow", "errors")
+
+    def __init__(self, kind, start, duration, value=None):
+        if kind not in self.KINDS:
+            raise ValueError(f"unknown script event {kind!r}, expected one of {self.KINDS}")
+        if (value is None) != (kind in ("down", "hang")):
+            raise ValueError("slow takes a factor (xN), errors a rate (=R), down and hang neither")
+        self.kind = kind
+        self.start = float(start)
+        self.end = self.start + float(duration)
+        self.value = value
+
+    @classmethod
+    def parse(cls, spec):
+        try:
+            kind, _, rest = spec.partition("@")
+            value = None
+            if "x" in rest:
+                rest, _, value = rest.partition("x")
+            elif "=" in rest:
+                rest, _, value = rest.partition("=")
+            start, _, duration = rest.partition("+")
+            return cls(kind, start, duration, None if value is None else float(value))
+        except ValueError as e:
+            raise ValueError(f"bad script event {spec!r}: {e}") from None
+
+    def __str__(self):
+        suffix = {"slow": "x", "errors": "="}.get(self.kind)
+        suffix = f"{suffix}{self.value:g}" if suffix else ""
+        return f"{self.kind}@{self.start:g}+{self.end - self.start:g}{suffix}"
+
+
+class BackendProfile:
+    """How one simulated backend behaves.
+
+    latency: a Latency or its spec; error_rate: fraction of requests answered 500;
+    capacity: requests served at once, the rest queue (None = unlimited);
+    queue_limit: queued requests beyond which new ones get 503 at once;
+    slow_start: seconds after start (or after a `down` event) during which
+    latency falls linearly from slow_start_factor x to normal;
+    script: ScriptEvents or their specs; weight: the LB weight of the backend.
+    """
+
+    FIELDS = ("latency", "error_rate", "capacity", "queue_limit", "slow_start", "slow_start_factor",
+              "script", "weight", "name")
+
+    def __init__(self, latency="const:0", error_rate=0.0, capacity=None, queue_limit=None, slow_start=0.0,
+                 slow_start_factor=4.0, script=(), weight=1, name=None):
+        self.latency = latency if isinstance(latency, Latency) else Latency.parse(latency)
+        self.error_rate = float(error_rate)
+        self.capacity = int(capacity) if capacity else None
+        self.queue_limit = None if queue_limit is None else int(queue_limit)
+        self.slow_start = float(slow_start)
+        self.slow_start_factor = float(slow_start_factor)
+        self.script = [e if isinstance(e, ScriptEvent) else ScriptEvent.parse(e) for e in script]
+        self.weight = int(weight)
+        self.name = name
+
+    @classmethod
+    def from_dict(cls, data):
+        unknown = set(data) - set(cls.FIELDS)
+        if unknown:
+            raise ValueError(f"unknown backend profile keys {sorted(unknown)}")
+        return cls(**data)
+
+    @classmethod
+    def parse(cls, spec):
+        """From 'latency=lognormal:5:0.5,error_rate=0.01,capacity=8,script=down@30+5;slow@60+10x4'."""
+        data = {}
+        for item in filter(None, spec.split(",")):
+            key, sep, value = item.partition("=")
+            if not sep:
+                raise ValueError(f"bad backend profile item {item!r}, expected key=value")
+            data[key.strip()] = value.split(";") if key.strip() == "script" else value
+        return cls.from_dict(data)
+
+    def describe(self):
+        parts = [f"latency={self.latency}"]
+        if self.error_rate:
+            parts.append(f"error_rate={self.error_rate:g}")
+        if self.capacity:
+            parts.append(f"capacity={self.capacity}")
+        if self.queue_limit is not None:
+            parts.append(f"queue_limit={self.queue_limit}")
+        if self.slow_start:
+            parts.append(f"slow_start={self.slow_start:g}")
+        if self.script:
+            parts.append("script=" + ";".join(str(e) for e in self.script))
+        if self.weight != 1:
+            parts.append(f"weight={self.weight}")
+        return ",".join(parts)
+
+
+def load_farm(path):
+    """Profiles from a JSON file: a list, or {"engine": ..., "backends": [...]}; entries are dicts or specs."""
+    with open(path) as f:
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path}: {e}") from None
+    engine = None
+    if isinstance(data, dict):
+        engine, data = data.get("engine"), data.get("backends")
+    if not isinstance(data, list) or not data:
+        raise ValueError(f'{path}: expected a list of backend profiles or {{"backends": [...]}}')
+    profiles = [BackendProfile.parse(p) if isinstance(p, str) else BackendProfile.from_dict(p) for p in data]
+    return profiles, engine
+
+
+class SimulatedBackend:
+    """State and decisions of one simulated backend, shared by both server flavours."""
+
+    def __init__(self, name, profile: BackendProfile, started, seed=None):
+        self.name = name
+        self.profile = profile
+        self.started = started
+        self.rng = random.Random(seed)
+        self.inflight = 0
+        self.max_inflight = 0
+        self.served = 0
+        self.errors = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.busy_time = 0.0
+        self._lock = threading.Lock()
+
+    def conditions(self, now):
+        """(down, hang_until, latency factor, error rate) at monotonic time `now`."""
+        t = now - self.started
+        down, hang_until, factor, error_rate = False, None, 1.0, self.profile.error_rate
+        warm_from = 0.0
+        for e in self.profile.script:
+            if e.kind == "down" and e.end <= t:
+                warm_from = max(warm_from, e.end)
+            if not e.start <= t < e.end:
+                continue
+            if e.kind == "down":
+                down = True
+            elif e.kind == "hang":
+                hang_until = self.started + e.end
+            elif e.kind == "slow":
+                factor *= e.value
+            else:
+                error_rate = e.value
+        ramp = self.profile.slow_start
+        if ramp and t - warm_from < ramp:
+            factor *= 1.0 + (self.profile.slow_start_factor - 1.0) * (1.0 - (t - warm_from) / ramp)
+        return down, hang_until, factor, error_rate
+
+    def arrive(self):
+        """What happens to a new request: ('drop'|'hang'|'reject'|'serve', detail)."""
+        now = time.monotonic()
+        down, hang_until, factor, error_rate = self.conditions(now)
+        if down:
+            self.dropped += 1
+            return "drop", None
+        if hang_until is not None:
+            self.dropped += 1
+            return "hang", hang_until - now
+        with self._lock:
+            limit = self.profile.queue_limit
+            if self.profile.capacity and limit is not None and self.inflight - self.profile.capacity >= limit:
+                self.rejected += 1
+                return "reject", None
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+            # the error is decided up front so failing requests cost service time too
+            failed = self.rng.random() < error_rate
+            service = self.profile.latency.sample(self.rng) * factor
+        return "serve", (service, failed)
+
+    def done(self, service, failed):
+        with self._lock:
+            self.inflight -= 1
+            self.served += 1
+            self.busy_time += service
+            if failed:
+                self.errors += 1
+
+    def healthy(self):
+        return not self.conditions(time.monotonic())[0]
+
+    def stats(self):
+        return {"served": self.served, "errors": self.errors, "rejected": self.rejected, "dropped": self.dropped,
+                "inflight": self.inflight, "max_inflight": self.max_inflight,
+                "mean_service_ms": round(self.busy_time / self.served * 1000, 3) if self.served else 0.0}
+
+
+def _response(sim: SimulatedBackend, method, path, status, keep_alive):
+    if status == 200:
+        body = f"Hello from {sim.name}! You requested {path}\n".encode("utf-8")
+    else:
+        body = {500: b"Simulated failure\n", 503: b"Busy\n"}[status]
+    reason = {200: "OK", 500: "Internal Server Error", 503: "Service Unavailable"}[status]
+    head = (f"HTTP/1.1 {status} {reason}\r\nContent-Type: text/plain\r\nContent-Length: {len(body)}\r\n"
+            f"X-Backend-ID: {sim.name}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode("iso-8859-1") + (b"" if method == "HEAD" else body)
+
+
+def _health(sim: SimulatedBackend, keep_alive):
+    ok = sim.healthy()
+    body = json.dumps({"status": "ok" if ok else "down", "inflight": sim.inflight}).encode()
+    head = (f"HTTP/1.1 {200 if ok else 503} {'OK' if ok else 'Service Unavailable'}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode("iso-8859-1") + body
+
+
+class FarmHandler(BaseHTTPRequestHandler):
+    """Thread-per-connection flavour: capacity is a semaphore, service time a sleep."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    sim = None
+    slots = None
+
+    def _serve(self):
+        length = int(self.headers.get("Content-Length", "0") or 0)
+        while length > 0:
+            chunk = self.rfile.read(min(length, 1048576))
+            if not chunk:
+                return
+            length -= len(chunk)
+        keep_alive = not self.close_connection
+        if self.path == "/health":
+            self.wfile.write(_health(self.sim, keep_alive))
+            return
+        action, detail = self.sim.arrive()
+        if action in ("drop", "hang"):
+            if action == "hang":
+                time.sleep(detail)
+            self.close_connection = True
+            return
+        if action == "reject":
+            self.wfile.write(_response(self.sim, self.command, self.path, 503, keep_alive))
+            return
+        service, failed = detail
+        try:
+            if self.slots is not None:
+                with self.slots:
+                    time.sleep(service)
+            else:
+                time.sleep(service)
+        finally:
+            self.sim.done(service, failed)
+        self.server.count_request()
+        self.wfile.write(_response(self.sim, self.command, self.path, 500 if failed else 200, keep_alive))
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _serve
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AsyncFarmServer:
+    """Event-loop flavour: one thread runs every connection, so capacity can be far above thread limits."""
+
+    def __init__(self, host, port, sim: SimulatedBackend):
+        self.host = host
+        self.port = port
+        self.sim = sim
+        self.accepted = 0
+        self.served = 0
+        self._loop = None
+        self._stopped = None
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"farm-{sim.name}")
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.sim.profile.capacity) if self.sim.profile.capacity else None
+        try:
+            server = await asyncio.start_server(self._handle, self.host, self.port, reuse_address=True,
+                                                backlog=1024, limit=MAX_HEADER_BYTES)
+        except OSError as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        async with server:
+            await self._stopped.wait()
+
+    def shutdown(self):
+        if self._loop is not None and self._stopped is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+        self._thread.join(5.0)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.accepted += 1
+        try:
+            while True:
+                try:
+                    request = RequestHead.parse(await reader.readuntil(b"\r\n\r\n"))
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+                    return
+                if request.content_length:
+                    await reader.readexactly(request.content_length)
+                keep_alive = request.keep_alive
+                if request.target == "/health":
+                    writer.write(_health(self.sim, keep_alive))
+                else:
+                    action, detail = self.sim.arrive()
+                    if action in ("drop", "hang"):
+                        if action == "hang":
+                            await asyncio.sleep(detail)
+                        return
+                    if action == "reject":
+                        writer.write(_response(self.sim, request.method, request.target, 503, keep_alive))
+                    else:
+                        service, failed = detail
+                        try:
+                            if self._slots is not None:
+                                async with self._slots:
+                                    await asyncio.sleep(service)
+                            else:
+                                await asyncio.sleep(service)
+                        finally:
+                            self.sim.done(service, failed)
+                        self.served += 1
+                        writer.write(_response(self.sim, request.method, request.target, 500 if failed else 200, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass  # cancelled when the farm stops with keep-alive connections still open
+        finally:
+            writer.close()
+
+
+class BackendFarm:
+    """Simulated backends on consecutive ports, each with its own BackendProfile.
+
+    `count` backends are started (default: one per profile), cycling through
+    the profiles. The "threaded" engine serves each connection on a thread
+    like the plain test backends; "asyncio" runs each backend on its own
+    event loop. Script times count from start(). `servers` expose the
+    same `accepted`/`served` counters and `shutdown()` as TestBackendServer.
+    """
+
+    def __init__(self, profiles, host="127.0.0.1", start_port=9001, engine="threaded", count=None, seed=1):
+        if engine not in FARM_ENGINES:
+            raise ValueError(f"unknown farm engine {engine!r}, expected one of {FARM_ENGINES}")
+        if not profiles:
+            raise ValueError("a farm needs at least one backend profile")
+        self.profiles = [p if isinstance(p, BackendProfile) else BackendProfile.parse(p) for p in profiles]
+        self.host = host
+        self.start_port = start_port
+        self.engine = engine
+        self.count = count or len(self.profiles)
+        self.seed = seed
+        self.sims = []
+        self.servers = []
+
+    def start(self):
+        """Start every backend; returns the Backend objects to give the LB."""
+        started = time.monotonic()
+        backends = []
+        for i in range(self.count):
+            profile = self.profiles[i % len(self.profiles)]
+            name = profile.name if profile.name and self.count == len(self.profiles) else f"BE-{i + 1}"
+            port = self.start_port + i
+            sim = SimulatedBackend(name, profile, started, seed=None if self.seed is None else self.seed + i)
+            if self.engine == "asyncio":
+                srv = AsyncFarmServer(self.host, port, sim)
+                srv.start()
+            else:
+                handler = type("Handler", (FarmHandler,), {"sim": sim, "slots": threading.Semaphore(profile.capacity)
+                                                           if profile.capacity else None})
+                srv = TestBackendServer((self.host, port), handler)
+                threading.Thread(target=srv.serve_forever, daemon=True).start()
+            self.sims.append(sim)
+            self.servers.append(srv)
+            backends.append(Backend(self.host, port, name, profile.weight))
+            print(f"[farm] {name} on {self.host}:{port} ({self.engine}): {profile.describe()}")
+        return backends
+
+    def stop(self):
+        for srv in self.servers:
+            srv.shutdown()
+
+    def stats(self):
+        return {sim.name: sim.stats() for sim in self.sims}
+
+    def report(self):
+        return "\n".join(f"  {name}: {st}" for name, st in self.stats().items())
@@ -0,0 +1,496 @@
+import os
+import select
+import socket
+import time
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+MAX_HEADER_BYTES = 65536
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-connection"}
+SPLICE_AVAILABLE = hasattr(os, "splice")
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class RelayResult:
+    """Outcome of one proxied exchange, as seen by the client connection."""
+
+    __slots__ = ("status", "bytes", "keep_alive", "latency", "failed", "version", "headers")
+
+    def __init__(self, status=None, nbytes=0, keep_alive=False):
+        self.status = status
+        self.bytes = nbytes
+        self.keep_alive = keep_alive
+        self.version = None
+        self.headers = ()  # the backend's response headers, as received
+        self.latency = None  # seconds until the response head arrived
+        self.failed = False  # backend broke off mid-response
+
+    def __repr__(self):
+        return (f"<RelayResult status={self.status} bytes={self.bytes} keep_alive={self.keep_alive} "
+                f"latency={self.latency} failed={self.failed}>")
+
+
+def _tokens(value):
+    return {t.strip().lower() for t in (value or "").split(",") if t.strip()}
+
+
+def build_head(first_line, headers, connection, extra_headers=()):
+    """Serialize a message head, replacing hop-by-hop headers with `Connection: <connection>`."""
+    drop = HOP_BY_HOP.copy()
+    for k, v in headers:
+        if k.lower() == "connection":
+            drop |= _tokens(v)
+    lines = [first_line]
+    lines.extend(f"{k}: {v}" for k, v in headers if k.lower() not in drop)
+    lines.extend(f"{k}: {v}" for k, v in extra_headers)
+    lines.append(f"Connection: {connection}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
+
+
+class RequestHead:
+    __slots__ = ("method", "target", "version", "headers", "raw", "received")
+
+    def __init__(self, method, target, version, headers, raw, received=None):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.raw = raw
+        self.received = time.monotonic() if received is None else received
+
+    @classmethod
+    def parse(cls, raw: bytes):
+        lines = raw.decode("iso-8859-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise ValueError(f"malformed request line: {lines[0]!r}")
+        headers = []
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise ValueError(f"malformed header line: {line!r}")
+            headers.append((name.strip(), value.strip()))
+        request = cls(parts[0].upper(), parts[1], parts[2], headers, raw)
+        if request.header("Transfer-Encoding") is not None and not request.chunked:
+            raise ValueError("request Transfer-Encoding must end in chunked")
+        return request
+
+    def header(self, name, default=None):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return default
+
+    @property
+    def content_length(self):
+        """Length of a Content-Length body; 0 for a chunked one, which Transfer-Encoding frames instead."""
+        if self.chunked:
+            return 0
+        try:
+            return max(0, int(self.header("Content-Length", "0")))
+        except ValueError:
+            return 0
+
+    @property
+    def chunked(self):
+        codings = [t.strip().lower() for t in (self.header("Transfer-Encoding") or "").split(",")]
+        return codings[-1] == "chunked"
+
+    @property
+    def has_body(self):
+        return self.chunked or self.content_length > 0
+
+    def cookie(self, name):
+        for header in (v for k, v in self.headers if k.lower() == "cookie"):
+            for part in header.split(";"):
+                k, sep, v = part.strip().partition("=")
+                if sep and k == name:
+                    return v.strip('"')
+        return None
+
+    @property
+    def keep_alive(self):
+        conn = _tokens(self.header("Connection"))
+        if self.version == "HTTP/1.0":
+            return "keep-alive" in conn
+        return "close" not in conn
+
+    def with_headers(self, extra, drop=()):
+        """Copy of this request without the `drop` headers (lower-case names) and with `extra` appended."""
+        drop = set(drop) | {k.lower() for k, _ in extra}
+        headers = [(k, v) for k, v in self.headers if k.lower() not in drop] + list(extra)
+        lines = [f"{self.method} {self.target} {self.version}"] + [f"{k}: {v}" for k, v in headers]
+        raw = ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
+        return RequestHead(self.method, self.target, self.version, headers, raw, self.received)
+
+    def serialize(self, connection=None):
+        """Rebuild the head; with `connection` set, hop-by-hop headers are replaced."""
+        if connection is None:
+            return self.raw
+        return build_head(f"{self.method} {self.target} {self.version}", self.headers, connection)
+
+    def __repr__(self):
+        return f"<RequestHead {self.method} {self.target} {self.version}>"
+
+
+class SocketReader:
+    """Buffered reader over a client socket.
+
+    Bytes received past the end of a request head are kept and handed out
+    first by recv_into(), so nothing read ahead is ever lost.
+    """
+
+    def __init__(self, sock: socket.socket, bufsize=65536):
+        self.sock = sock
+        self.bufsize = bufsize
+        self._buf = bytearray()
+
+    def read_head(self, limit=MAX_HEADER_BYTES):
+        scanned = 0
+        while True:
+            idx = self._buf.find(b"\r\n\r\n", max(0, scanned - 3))
+            if idx >= 0:
+                head = bytes(self._buf[:idx + 4])
+                del self._buf[:idx + 4]
+                return head
+            if len(self._buf) > limit:
+                return None
+            scanned = len(self._buf)
+            chunk = self.sock.recv(self.bufsize)
+            if not chunk:
+                return None
+            self._buf += chunk
+
+    def take_buffered(self, limit):
+        """Hand out up to `limit` read-ahead bytes (so the socket can be read directly afterwards)."""
+        data = bytes(self._buf[:limit])
+        del self._buf[:limit]
+        return data
+
+    def read_exact(self, n):
+        """Read n bytes (fewer only if the peer closes first)."""
+        out = bytearray(self.take_buffered(n))
+        while len(out) < n:
+            chunk = self.sock.recv(min(self.bufsize, n - len(out)))
+            if not chunk:
+                break
+            out += chunk
+        return bytes(out)
+
+    def read_line(self, limit=8192):
+        """One CRLF-terminated line, terminator included; ClientDisconnected past `limit` or at EOF."""
+        while True:
+            idx = self._buf.find(b"\n")
+            if idx >= 0:
+                line = bytes(self._buf[:idx + 1])
+                del self._buf[:idx + 1]
+                return line
+            if len(self._buf) > limit:
+                raise ClientDisconnected("chunk framing line too long")
+            try:
+                chunk = self.sock.recv(self.bufsize)
+            except OSError as e:
+                raise ClientDisconnected() from e
+            if not chunk:
+                raise ClientDisconnected("client closed inside a chunked body")
+            self._buf += chunk
+
+    def recv_into(self, view: memoryview):
+        if self._buf:
+            n = min(len(view), len(self._buf))
+            view[:n] = self._buf[:n]
+            del self._buf[:n]
+            return n
+        return self.sock.recv_into(view)
+
+
+def _wait(sock, events):
+    poller = select.poll()
+    poller.register(sock, events)
+    timeout = sock.gettimeout()
+    if not poller.poll(None if timeout is None else timeout * 1000):
+        raise socket.timeout("timed out")
+
+
+class Splicer:
+    """Socket-to-socket copies through a kernel pipe with os.splice (Linux).
+
+    Payload bytes never enter user space. Bodies shorter than `threshold`
+    are not worth the extra syscalls and go through the normal buffer.
+    The pipe is created on first use; close() releases it.
+    """
+
+    def __init__(self, threshold=65536, pipe_size=1 << 20):
+        self.threshold = threshold
+        self.pipe_size = pipe_size
+        self.chunk = 65536
+        self._pipe = None
+        self._pending = 0
+
+    def _open(self):
+        r, w = os.pipe()
+        if fcntl is not None and hasattr(fcntl, "F_SETPIPE_SZ"):
+            try:
+                self.chunk = fcntl.fcntl(w, fcntl.F_SETPIPE_SZ, self.pipe_size)
+            except OSError:
+                pass  # above /proc/sys/fs/pipe-max-size: keep the default
+        self._pipe = (r, w)
+        self._pending = 0
+
+    def _move(self, fd_in, fd_out, count, sock, events, client):
+        while True:
+            try:
+                return os.splice(fd_in, fd_out, count, flags=os.SPLICE_F_MOVE)
+            except BlockingIOError:
+                try:
+                    _wait(sock, events)
+                except OSError as e:
+                    if sock is client:
+                        raise ClientDisconnected() from e
+                    raise
+            except OSError as e:
+                if sock is client:
+                    raise ClientDisconnected() from e
+                raise
+
+    def relay(self, src: socket.socket, dst: socket.socket, length, client=None):
+        """Move exactly `length` bytes from src to dst; failures on `client` raise ClientDisconnected."""
+        if self._pipe is None:
+            self._open()
+        r, w = self._pipe
+        remaining = length
+        try:
+            while remaining > 0:
+                n = self._move(src.fileno(), w, min(remaining, self.chunk), src, select.POLLIN, client)
+                if not n:
+                    if src is client:
+                        raise ClientDisconnected(f"client closed with {remaining} body bytes outstanding")
+                    raise ConnectionError("backend closed before the response was complete")
+                self._pending = n
+                while self._pending:
+                    self._pending -= self._move(r, dst.fileno(), self._pending, dst, select.POLLOUT, client)
+                remaining -= n
+        finally:
+            if self._pending:
+                self.close()  # bytes stranded in the pipe: start over with a fresh one
+        return length
+
+    def close(self):
+        if self._pipe is not None:
+            for fd in self._pipe:
+                os.close(fd)
+            self._pipe = None
+
+
+def relay_exact(reader: SocketReader, dst: socket.socket, length, view: memoryview, splicer=None):
+    """Copy exactly `length` bytes from reader to dst through the bounded buffer `view`.
+
+    With a Splicer and a large enough body, read-ahead bytes are sent first
+    and the rest is spliced straight from the client socket.
+    """
+    if splicer is not None and length >= splicer.threshold:
+        buffered = reader.take_buffered(length)
+        dst.sendall(buffered)
+        splicer.relay(reader.sock, dst, length - len(buffered), client=reader.sock)
+        return length
+    remaining = length
+    while remaining > 0:
+        try:
+            n = reader.recv_into(view[:min(remaining, len(view))])
+        except OSError as e:
+            raise ClientDisconnected() from e
+        if not n:
+            raise ClientDisconnected(f"client closed with {remaining} body bytes outstanding")
+        dst.sendall(view[:n])
+        remaining -= n
+    return length
+
+
+def parse_chunk_size(line):
+    try:
+        return int(line.split(b";", 1)[0].strip(), 16)
+    except ValueError:
+        raise ValueError(f"bad chunk size line: {line[:40]!r}") from None
+
+
+def relay_chunked(reader: SocketReader, dst: socket.socket, view: memoryview):
+    """Copy a chunked body (sizes, data, trailers) from reader to dst as is; returns the bytes sent.
+
+    The framing is parsed only to find where the body ends, so whatever the
+    client sent after it stays in the reader for the next request. Broken
+    framing is the client's fault and raises ClientDisconnected.
+    """
+    total = 0
+    while True:
+        line = reader.read_line()
+        try:
+            size = parse_chunk_size(line)
+        except ValueError as e:
+            raise ClientDisconnected(str(e)) from e
+        dst.sendall(line)
+        total += len(line)
+        if size == 0:
+            break
+        total += relay_exact(reader, dst, size + 2, view)
+    while True:
+        line = reader.read_line()
+        dst.sendall(line)
+        total += len(line)
+        if line in (b"\r\n", b"\n"):
+            return total
+
+
+class ResponseFramer:
+    """Incremental HTTP/1.x response parser that only tracks message boundaries.
+
+    feed() returns how many of the given bytes belong to the current
+    response; once `done` is set the response is complete and any further
+    bytes belong to whatever the backend sends next.
+    """
+
+    MAX_LINE = 8192
+
+    def __init__(self, method="GET"):
+        self.method = method
+        self.version = None
+        self.status = None
+        self.headers = []
+        self.head = None
+        self.head_end = 0
+        self.done = False
+        self.until_close = False
+        self._state = "head"
+        self._remaining = 0
+        self._buf = bytearray()
+
+    def header(self, name, default=None):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return default
+
+    @property
+    def keep_alive(self):
+        conn = _tokens(self.header("Connection"))
+        if self.until_close or "close" in conn:
+            return False
+        if self.version == "HTTP/1.0":
+            return "keep-alive" in conn
+        return True
+
+    def serialize_head(self, connection, extra_headers=()):
+        reason = self.head.split(b"\r\n", 1)[0].decode("iso-8859-1").split(" ", 2)[2:]
+        first = f"{self.version} {self.status} {reason[0] if reason else ''}".rstrip()
+        return build_head(first, self.headers, connection, extra_headers)
+
+    def feed(self, data):
+        pos, end = 0, len(data)
+        while pos < end and not self.done:
+            state = self._state
+            if state in ("length", "chunk_data", "chunk_crlf"):
+                k = min(self._remaining, end - pos)
+                pos += k
+                self._remaining -= k
+                if self._remaining == 0:
+                    if state == "length":
+                        self.done = True
+                    elif state == "chunk_data":
+                        self._state, self._remaining = "chunk_crlf", 2
+                    else:
+                        self._state = "chunk_size"
+            elif state == "close":
+                pos = end
+            elif state == "head":
+                start = max(0, len(self._buf) - 3)
+                self._buf += data[pos:]
+                idx = self._buf.find(b"\r\n\r\n", start)
+                if idx < 0:
+                    if len(self._buf) > MAX_HEADER_BYTES:
+                        raise ValueError("response head too large")
+                    pos = end
+                    continue
+                head_len = idx + 4
+                pos = end - (len(self._buf) - head_len)
+                self.head_end = pos
+                head = bytes(self._buf[:head_len])
+                self._buf.clear()
+                self._parse_head(head)
+            else:
+                line, pos = self._take_line(data, pos)
+                if line is None:
+                    continue
+                if state == "chunk_size":
+                    size = parse_chunk_size(line)
+                    if size == 0:
+                        self._state = "trailer"
+                    else:
+                        self._state, self._remaining = "chunk_data", size
+                elif not line:
+                    self.done = True
+        return pos
+
+    @property
+    def body_remaining(self):
+        """Bytes of a Content-Length body still to come (0 for other framings)."""
+        return self._remaining if self._state == "length" and not self.done else 0
+
+    def consume(self, n):
+        """Account for `n` body bytes relayed without passing through feed()."""
+        self._remaining -= n
+        if self._remaining <= 0:
+            self.done = True
+
+    def eof(self):
+        if self._state == "close":
+            self.done = True
+        return self.done
+
+    def _take_line(self, data, pos):
+        idx = bytes(data[pos:pos + 128]).find(b"\n")
+        if idx < 0:
+            idx = bytes(data[pos:pos + self.MAX_LINE]).find(b"\n")
+        if idx < 0:
+            self._buf += data[pos:]
+            if len(self._buf) > self.MAX_LINE:
+                raise ValueError("chunk framing line too long")
+            return None, len(data)
+        self._buf += data[pos:pos + idx + 1]
+        line = bytes(self._buf).rstrip(b"\r\n")
+        self._buf.clear()
+        return line, pos + idx + 1
+
+    def _parse_head(self, head):
+        lines = head.decode("iso-8859-1").split("\r\n")
+        parts = lines[0].split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise ValueError(f"malformed status line: {lines[0]!r}")
+        status = int(parts[1])
+        if 100 <= status < 200 and status != 101:
+            return
+        self.version, self.status = parts[0], status
+        self.headers = [(k.strip(), v.strip()) for k, _, v in
+                        (line.partition(":") for line in lines[1:] if line)]
+        self.head = head
+        te = (self.header("Transfer-Encoding") or "").lower()
+        cl = self.header("Content-Length")
+        if self.method == "HEAD" or status in (204, 304) or status == 101:
+            self.done = True
+        elif "chunked" in te:
+            self._state = "chunk_size"
+        elif cl is not None:
+            self._remaining = int(cl)
+            self._state = "length"
+            self.done = self._remaining == 0
+        else:
+            self.until_close = True
+            self._state = "close"
@@ -0,0 +1,250 @@
+import math
+import threading
+import time
+
+
+class LatencyHistogram:
+    """Log-linear latency histogram (HDR style, ~3% relative precision).
+
+    Values are recorded in seconds and bucketed by their binary exponent
+    and SUB_BUCKETS linear steps inside each power of two, so memory stays
+    constant no matter how many samples are recorded.
+    """
+
+    SUB_BUCKETS = 16
+    UNIT = 1e-6  # resolution: one microsecond
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def _index(self, value):
+        units = value / self.UNIT
+        if units < 1.0:
+            return 0
+        m, e = math.frexp(units)
+        return e * self.SUB_BUCKETS + int((m - 0.5) * 2 * self.SUB_BUCKETS)
+
+    def _upper(self, index):
+        e, sub = divmod(index, self.SUB_BUCKETS)
+        return math.ldexp(0.5 + (sub + 1) / (2.0 * self.SUB_BUCKETS), e) * self.UNIT
+
+    def record(self, value):
+        idx = self._index(value)
+        self.counts[idx] = self.counts.get(idx, 0) + 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        # list() copies atomically under the GIL, so merging a histogram another thread is writing is safe
+        for idx, n in list(other.counts.items()):
+            self.counts[idx] = self.counts.get(idx, 0) + n
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        if not self.total:
+            return 0.0
+        rank = max(1, math.ceil(p / 100.0 * self.total))
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                return min(self._upper(idx), self.max)
+        return self.max
+
+    def cumulative(self, bounds):
+        """Counts of samples <= each bound (seconds), for Prometheus-style buckets."""
+        out = [0] * len(bounds)
+        for idx, n in list(self.counts.items()):
+            upper = self._upper(idx)
+            for i, bound in enumerate(bounds):
+                if upper <= bound:
+                    out[i] += n
+        return out
+
+    @property
+    def mean(self):
+        return self.sum / self.total if self.total else 0.0
+
+    def summary(self):
+        return {
+            "count": self.total,
+            "mean_ms": round(self.mean * 1000, 3),
+            "p50_ms": round(self.percentile(50) * 1000, 3),
+            "p90_ms": round(self.percentile(90) * 1000, 3),
+            "p99_ms": round(self.percentile(99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+    def render(self, bounds_ms=(0.5, 1, 2, 5, 10, 50, 100, 500, 1000, 2000), width=40):
+        rows = []
+        buckets = [0] * (len(bounds_ms) + 1)
+        for idx, n in self.counts.items():
+            upper_ms = self._upper(idx) * 1000
+            slot = next((i for i, b in enumerate(bounds_ms) if upper_ms <= b), len(bounds_ms))
+            buckets[slot] += n
+        peak = max(buckets) or 1
+        for i, n in enumerate(buckets):
+            label = f"<= {bounds_ms[i]:>6}ms" if i < len(bounds_ms) else f" > {bounds_ms[-1]:>6}ms"
+            rows.append(f"  {label} | {'#' * int(width * n / peak):<{width}} {n}")
+        return "\n".join(rows)
+
+
+class _Shard:
+    """Metrics written by one thread only; merged with the others when read."""
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.codes = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.opened = 0
+        self.closed = 0
+        self.duration = LatencyHistogram()
+        self.queue = LatencyHistogram()
+        self.latency = {}
+        self.connect = {}
+        self.outcomes = {}
+
+    def merge(self, other):
+        for code, n in list(other.codes.items()):
+            self.codes[code] = self.codes.get(code, 0) + n
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.opened += other.opened
+        self.closed += other.closed
+        self.duration.merge(other.duration)
+        self.queue.merge(other.queue)
+        for mine, theirs in ((self.latency, other.latency), (self.connect, other.connect)):
+            for name, hist in list(theirs.items()):
+                mine.setdefault(name, LatencyHistogram()).merge(hist)
+        for key, n in list(other.outcomes.items()):
+            self.outcomes[key] = self.outcomes.get(key, 0) + n
+
+
+class Metrics:
+    """Load balancer counters and latency histograms.
+
+    Every thread records into its own shard, so the request path never
+    takes a lock; snapshot() merges the shards (folding those of finished
+    threads into a retired total). The asyncio engine uses a single shard.
+    """
+
+    COMPACT_AT = 256
+
+    def __init__(self):
+        self.started = time.time()
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard()
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = _Shard(threading.current_thread())
+            with self._lock:
+                if len(self._shards) >= self.COMPACT_AT:
+                    self._compact()
+                self._shards.append(shard)
+        return shard
+
+    def _compact(self):
+        live = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                live.append(shard)
+            else:
+                self._retired.merge(shard)
+        self._shards = live
+
+    def connection_opened(self):
+        self._shard().opened += 1
+
+    def connection_closed(self):
+        self._shard().closed += 1
+
+    def exchange(self, status, bytes_in, bytes_out, duration):
+        shard = self._shard()
+        shard.codes[status] = shard.codes.get(status, 0) + 1
+        shard.bytes_in += bytes_in
+        shard.bytes_out += bytes_out
+        shard.duration.record(duration)
+
+    def queued(self, seconds):
+        self._shard().queue.record(seconds)
+
+    def connected(self, backend, seconds):
+        shard = self._shard()
+        hist = shard.connect.get(backend)
+        if hist is None:
+            hist = shard.connect[backend] = LatencyHistogram()
+        hist.record(seconds)
+
+    def backend_result(self, backend, outcome, latency=None):
+        shard = self._shard()
+        key = (backend, outcome)
+        shard.outcomes[key] = shard.outcomes.get(key, 0) + 1
+        if latency is not None:
+            hist = shard.latency.get(backend)
+            if hist is None:
+                hist = shard.latency[backend] = LatencyHistogram()
+            hist.record(latency)
+
+    def snapshot(self):
+        total = _Shard()
+        with self._lock:
+            self._compact()
+            total.merge(self._retired)
+            for shard in self._shards:
+                total.merge(shard)
+        return total
+
+
+LATENCY_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels.items():
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class PrometheusText:
+    """Builds a Prometheus text-format (0.0.4) exposition."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, kind, help_text, samples):
+        """samples: iterable of (labels dict, value)."""
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            self.lines.append(f"{name}{_labels(labels)} {value}")
+
+    def histogram(self, name, help_text, series, bounds=LATENCY_BOUNDS):
+        """series: iterable of (labels dict, LatencyHistogram)."""
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} histogram")
+        for labels, hist in series:
+            for bound, count in zip(bounds, hist.cumulative(bounds)):
+                self.lines.append(f"{name}_bucket{_labels(dict(labels, le=repr(bound)))} {count}")
+            self.lines.append(f"{name}_bucket{_labels(dict(labels, le='+Inf'))} {hist.total}")
+            self.lines.append(f"{name}_sum{_labels(labels)} {hist.sum:.6f}")
+            self.lines.append(f"{name}_count{_labels(labels)} {hist.total}")
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
@@ -0,0 +1,178 @@
+import heapq
+import threading
+import time
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+
+class CircuitBreaker:
+    """Passive health of one backend, fed by the results of proxied requests."""
+
+    def __init__(self, window=20):
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.latency_ewma = 0.0
+        self.samples = 0
+        self.ejections = 0
+        self.reopen_at = 0.0
+        self._window = [True] * window
+        self._pos = 0
+        self._errors = 0
+        self._seen = 0
+
+    def observe(self, success, latency, alpha):
+        if self._window[self._pos] is False:
+            self._errors -= 1
+        self._window[self._pos] = success
+        if not success:
+            self._errors += 1
+        self._pos = (self._pos + 1) % len(self._window)
+        self._seen = min(self._seen + 1, len(self._window))
+        if success:
+            self.consecutive_failures = 0
+            if latency is not None:
+                self.latency_ewma = latency if not self.samples else \
+                    alpha * latency + (1 - alpha) * self.latency_ewma
+                self.samples += 1
+        else:
+            self.consecutive_failures += 1
+
+    @property
+    def error_rate(self):
+        return self._errors / self._seen if self._seen else 0.0
+
+    def reset(self):
+        self.consecutive_failures = 0
+        self._window = [True] * len(self._window)
+        self._errors = 0
+        self._seen = 0
+        self.samples = 0
+        self.latency_ewma = 0.0
+
+    def stats(self):
+        return {"state": self.state, "error_rate": round(self.error_rate, 3),
+                "consecutive_failures": self.consecutive_failures,
+                "latency_ewma_ms": round(self.latency_ewma * 1000, 2), "ejections": self.ejections}
+
+
+class OutlierDetector:
+    """Ejects backends that fail or slow down under live traffic, Envoy style.
+
+    A backend is ejected (Backend.ejected, so it leaves the selection ring)
+    when it hits `consecutive_failures` failures in a row, when its error
+    rate over the last `window` results reaches `error_rate` (after at least
+    `min_requests`), or when its latency EWMA exceeds `slow_factor` times the
+    pool-wide EWMA. Ejection lasts `base_ejection` times the number of
+    ejections so far (capped at `max_ejection`); then one trial request is
+    let through (half-open) and its outcome closes or re-opens the breaker.
+    At most `max_ejection_percent` of the pool is ejected at once.
+    """
+
+    def __init__(self, consecutive_failures=3, error_rate=0.5, window=20, min_requests=10,
+                 slow_factor=3.0, ewma_alpha=0.1, base_ejection=1.0, max_ejection=30.0,
+                 max_ejection_percent=50):
+        self.consecutive_failures = consecutive_failures
+        self.error_rate = error_rate
+        self.window = window
+        self.min_requests = min_requests
+        self.slow_factor = slow_factor
+        self.ewma_alpha = ewma_alpha
+        self.base_ejection = base_ejection
+        self.max_ejection = max_ejection
+        self.max_ejection_percent = max_ejection_percent
+        self.pool_latency_ewma = 0.0
+        self._breakers = {}
+        self._reopen = []
+        self._lock = threading.Lock()
+
+    def breaker(self, backend):
+        br = self._breakers.get(backend)
+        if br is None:
+            br = self._breakers.setdefault(backend, CircuitBreaker(self.window))
+        return br
+
+    def trial(self):
+        """Return a backend whose ejection has expired and that should take one trial request."""
+        if not self._reopen or self._reopen[0][0] > time.monotonic():
+            return None
+        with self._lock:
+            now = time.monotonic()
+            while self._reopen and self._reopen[0][0] <= now:
+                due, _, backend = heapq.heappop(self._reopen)
+                br = self._breakers.get(backend)
+                if br is None or br.state == CLOSED or due != br.reopen_at:
+                    continue  # superseded entry, or the backend left the pool
+                if not backend.healthy or backend.draining:
+                    # actively marked DOWN: leave recovery to the health checker
+                    self._close(backend, br)
+                    continue
+                br.state = HALF_OPEN
+                # if the trial never reports back (client hung up), issue another later
+                self._schedule(backend, br, now + self.base_ejection)
+                return backend
+        return None
+
+    def forget(self, backend):
+        """Drop a backend that left the pool; its pending reopen entry is skipped later."""
+        with self._lock:
+            self._breakers.pop(backend, None)
+
+    def _schedule(self, backend, br, when):
+        br.reopen_at = when
+        heapq.heappush(self._reopen, (when, id(backend), backend))
+
+    def _close(self, backend, br):
+        br.state = CLOSED
+        br.reset()
+        backend.ejected = False
+
+    def record(self, backend, success, latency=None):
+        with self._lock:
+            br = self.breaker(backend)
+            br.observe(success, latency, self.ewma_alpha)
+            if br.state == HALF_OPEN:
+                slow = (latency is not None and self.slow_factor and self.pool_latency_ewma > 0
+                        and latency > self.slow_factor * self.pool_latency_ewma)
+                if success and not slow:
+                    self._close(backend, br)
+                    print(f"[outlier] {backend.name} recovered")
+                else:
+                    self._eject(backend, br, "trial request failed" if not success else "trial request slow")
+            elif br.state == CLOSED:
+                reason = self._trip_reason(br)
+                if reason and self._can_eject(backend):
+                    self._eject(backend, br, reason)
+            if success and latency is not None:
+                self.pool_latency_ewma = latency if not self.pool_latency_ewma else \
+                    self.ewma_alpha * latency + (1 - self.ewma_alpha) * self.pool_latency_ewma
+
+    def _is_slow(self, br):
+        return (self.slow_factor and br.samples >= self.min_requests and self.pool_latency_ewma > 0
+                and br.latency_ewma > self.slow_factor * self.pool_latency_ewma)
+
+    def _trip_reason(self, br):
+        if br.consecutive_failures >= self.consecutive_failures:
+            return f"{br.consecutive_failures} consecutive failures"
+        if br._seen >= self.min_requests and br.error_rate >= self.error_rate:
+            return f"error rate {br.error_rate:.0%}"
+        if self._is_slow(br):
+            return (f"latency {br.latency_ewma * 1000:.1f}ms vs pool "
+                    f"{self.pool_latency_ewma * 1000:.1f}ms")
+        return None
+
+    def _can_eject(self, backend):
+        pool = [b for b in self._breakers if b.healthy and not b.draining]
+        ejected = sum(1 for b in pool if b.ejected)
+        return (ejected + 1) * 100 <= self.max_ejection_percent * max(1, len(pool))
+
+    def _eject(self, backend, br, reason):
+        br.ejections += 1
+        br.state = OPEN
+        duration = min(self.max_ejection, self.base_ejection * br.ejections)
+        self._schedule(backend, br, time.monotonic() + duration)
+        backend.ejected = True
+        backend.pool.drain()
+        print(f"[outlier] {backend.name} ejected for {duration:.1f}s ({reason})")
+
+    def stats(self):
+        return {b.name: br.stats() for b, br in self._breakers.items()}
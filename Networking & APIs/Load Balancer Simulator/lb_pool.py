@@ -0,0 +1,103 @@
+import asyncio
+import collections
+import socket
+import threading
+import time
+
+
+class UpstreamPool:
+    """Idle keep-alive connections to one backend.
+
+    Sockets are handed out LIFO so the warmest connection is reused first.
+    Expired, stale (peer closed or sent unsolicited bytes) and over-capacity
+    sockets are closed instead of being returned.
+    """
+
+    def __init__(self, backend, max_size=32, idle_timeout=30.0):
+        self.backend = backend
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._idle)
+
+    def connect(self, timeout):
+        s = socket.create_connection((self.backend.host, self.backend.port), timeout=timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.created += 1
+        return s
+
+    async def connect_async(self, loop, timeout):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(s, (self.backend.host, self.backend.port)), timeout)
+        except BaseException:
+            s.close()
+            raise
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.created += 1
+        return s
+
+    def acquire(self):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                s, released_at = self._idle.pop()
+            if now - released_at > self.idle_timeout or self._is_stale(s):
+                self._close(s)
+                continue
+            self.reused += 1
+            return s
+
+    def release(self, s):
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            while self._idle and now - self._idle[0][1] > self.idle_timeout:
+                expired.append(self._idle.popleft()[0])
+            keep = self.backend.healthy and not self.backend.draining and len(self._idle) < self.max_size
+            if keep:
+                self._idle.append((s, now))
+        for old in expired:
+            self._close(old)
+        if not keep:
+            self._close(s)
+
+    def drain(self):
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        for s, _ in idle:
+            self._close(s)
+
+    def _close(self, s):
+        self.evicted += 1
+        try:
+            s.close()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _is_stale(s):
+        timeout = s.gettimeout()
+        s.setblocking(False)
+        try:
+            s.recv(1, socket.MSG_PEEK)
+            return True
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+        finally:
+            s.settimeout(timeout)
+
+    def stats(self):
+        return {"idle": len(self._idle), "created": self.created,
+                "reused": self.reused, "evicted": self.evicted}
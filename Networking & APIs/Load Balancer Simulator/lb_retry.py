@@ -0,0 +1,137 @@
+import threading
+import time
+
+from lb_metrics import LatencyHistogram
+
+# methods a backend may see twice without changing the outcome (RFC 9110 9.2.2)
+IDEMPOTENT = frozenset(("GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE"))
+# hedging doubles work on the backends, so only for requests that are also safe
+HEDGEABLE = frozenset(("GET", "HEAD", "OPTIONS"))
+
+
+class RetryBudget:
+    """Caps retries and hedges at a fraction of the request rate.
+
+    Every request deposits `ratio` tokens and every retry spends one, so in
+    steady state at most `ratio` extra requests per request reach the
+    backends; `min_per_second` tokens also trickle in so a quiet LB can
+    still retry. At most `burst` tokens are saved up. Without a budget a
+    struggling backend pool would get its load multiplied by the retries.
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=10.0, burst=20.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.burst = burst
+        self._balance = burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+        self.spent = 0
+        self.denied = 0
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self.burst, self._balance + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            now = time.monotonic()
+            self._balance = min(self.burst, self._balance + (now - self._stamp) * self.min_per_second)
+            self._stamp = now
+            if self._balance < 1.0:
+                self.denied += 1
+                return False
+            self._balance -= 1.0
+            self.spent += 1
+            return True
+
+    @property
+    def balance(self):
+        return self._balance
+
+
+class LatencyWindow:
+    """A latency quantile over the last full window (`window` seconds) of responses.
+
+    Samples go into a LatencyHistogram that is swapped out every window; the
+    quantile is taken once per swap, so reading it costs nothing. It is
+    None until a window held at least `min_samples` responses.
+    """
+
+    def __init__(self, quantile=95, window=5.0, min_samples=50):
+        self.quantile = quantile
+        self.window = window
+        self.min_samples = min_samples
+        self.value = None
+        self._current = LatencyHistogram()
+        self._until = time.monotonic() + window
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._until:
+                done, self._current = self._current, LatencyHistogram()
+                self._until = now + self.window
+                if done.total >= self.min_samples:
+                    self.value = done.percentile(self.quantile)
+            self._current.record(latency)
+
+
+class RetryPolicy:
+    """When a failed request may go to another backend, and when to hedge it.
+
+    A request is retried (at most `retries` times, each time on a backend
+    it has not tried) only if nothing reached the client yet, its method is
+    idempotent and it has no body, since request bodies are streamed and
+    cannot be replayed. With `hedge` on, a safe request whose backend has
+    not answered within the p95 response time (at least `hedge_min_delay`)
+    is also sent to a second backend and the first answer wins. Retries and
+    hedges share one RetryBudget.
+    """
+
+    def __init__(self, retries=1, hedge=False, budget_ratio=0.2, budget_min_per_second=10.0,
+                 hedge_quantile=95, hedge_min_delay=0.005, latency_window=5.0):
+        self.retries = retries
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.budget = RetryBudget(budget_ratio, budget_min_per_second)
+        self.latency = LatencyWindow(hedge_quantile, latency_window)
+        self.retried = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    @staticmethod
+    def _replayable(request):
+        return request.content_length == 0 and request.header("Transfer-Encoding") is None
+
+    def retryable(self, request, retried):
+        return retried < self.retries and request.method in IDEMPOTENT and self._replayable(request)
+
+    def hedge_delay(self, request):
+        """Seconds to wait before hedging `request`, or None if it is not hedged."""
+        if not self.hedge or request.method not in HEDGEABLE or not self._replayable(request):
+            return None
+        p = self.latency.value
+        return None if p is None else max(self.hedge_min_delay, p)
+
+    def stats(self):
+        return {"retries": self.retried, "hedges": self.hedged, "hedge_wins": self.hedge_wins,
+                "budget_denied": self.budget.denied, "budget_balance": round(self.budget.balance, 1),
+                "hedge_delay_ms": None if self.latency.value is None else round(self.latency.value * 1000, 2)}
+
+
+class Hedge:
+    """One request's race: `start()` reserves a second backend (or returns None).
+
+    The relay sets `backend` when the second request went out and `winner`
+    to whichever backend's answer it relayed.
+    """
+
+    __slots__ = ("delay", "start", "backend", "winner")
+
+    def __init__(self, delay, start):
+        self.delay = delay
+        self.start = start
+        self.backend = None
+        self.winner = None
@@ -0,0 +1,395 @@
+import argparse
+import array
+import collections
+import heapq
+import json
+import math
+import random
+import statistics
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:  # optional: vectorised sampling and statistics
+    np = None
+
+from lb_simulator import Backend
+from lb_algorithms import BackendIndex, PowerOfTwoChoices, make_strategy, ALGORITHMS
+from lb_farm import BackendProfile
+
+
+def _client_ips(n):
+    return [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(n)]
+
+
+def simulate_strategy(name, weights, clients=5000, requests=200000, concurrency=64,
+                      cache_size=500, zipf_s=1.1, fail_at=0.5, seed=1):
+    """Drive one strategy with a socket-free request stream and report skew and cache affinity.
+
+    Clients are drawn from a Zipf popularity curve; every request holds its
+    backend for an exponential number of ticks scaled down by the backend's
+    weight (bigger backends finish sooner). Each backend keeps an LRU of
+    the client keys it served, so a request is a cache hit when its key is
+    already resident on the chosen backend. At `fail_at` of the run the
+    first backend goes DOWN to show how much affinity each strategy keeps.
+    """
+    rng = random.Random(seed)
+    backends = [Backend("10.255.0.%d" % (i + 1), 80, f"BE-{i + 1}", weight=w) for i, w in enumerate(weights)]
+    index = BackendIndex(backends)
+    if name == "p2c":
+        strategy = PowerOfTwoChoices(index, rng=random.Random(seed))
+    else:
+        strategy = make_strategy(name, index)
+
+    ips = _client_ips(clients)
+    popularity = [1.0 / (rank + 1) ** zipf_s for rank in range(clients)]
+    stream = rng.choices(range(clients), weights=popularity, k=requests)
+    caches = {b: collections.OrderedDict() for b in backends}
+    served = collections.Counter()
+    peak = collections.Counter()
+    hits = [0, 0]
+    counted = [0, 0]
+    inflight = []
+    fail_tick = int(requests * fail_at) if fail_at else None
+
+    for tick, client in enumerate(stream):
+        while inflight and inflight[0][0] <= tick:
+            index.release(heapq.heappop(inflight)[2])
+        if tick == fail_tick:
+            backends[0].healthy = False
+        key = ips[client]
+        b = strategy.select(key)
+        index.acquire(b)
+        served[b] += 1
+        peak[b] = max(peak[b], index.connections(b))
+        phase = 1 if fail_tick is not None and tick >= fail_tick else 0
+        cache = caches[b]
+        counted[phase] += 1
+        if key in cache:
+            hits[phase] += 1
+            cache.move_to_end(key)
+        else:
+            cache[key] = None
+            if len(cache) > cache_size:
+                cache.popitem(last=False)
+        service = rng.expovariate(1.0 / concurrency) / b.weight
+        heapq.heappush(inflight, (tick + max(1, int(service)), tick, b))
+
+    per_weight = [served[b] / b.weight for b in backends]
+    mean = statistics.fmean(per_weight)
+    return {
+        "algo": strategy.describe(),
+        "requests": requests,
+        "skew_max_over_mean": round(max(per_weight) / mean, 3),
+        "cv": round(statistics.pstdev(per_weight) / mean, 3),
+        "peak_inflight": {b.name: peak[b] for b in backends},
+        "hit_rate": round(sum(hits) / requests, 4),
+        "hit_rate_before_failure": round(hits[0] / counted[0], 4) if counted[0] else None,
+        "hit_rate_after_failure": round(hits[1] / counted[1], 4) if counted[1] else None,
+    }
+
+
+def service_times(latency, seed, use_numpy):
+    """Endless iterator of one backend's service times, drawn in blocks (vectorised with NumPy)."""
+    g = np.random.default_rng(seed) if use_numpy else None
+    rng = random.Random(seed)
+    n, p = 65536, latency.params
+    while True:
+        if g is None:
+            yield from [latency.sample(rng) for _ in range(n)]
+            continue
+        if latency.kind == "const":
+            ms = np.full(n, p[0])
+        elif latency.kind == "uniform":
+            ms = g.uniform(p[0], p[1], n)
+        elif latency.kind == "exp":
+            ms = g.exponential(p[0], n)
+        elif latency.kind == "lognormal":
+            ms = p[0] * np.exp(p[1] * g.standard_normal(n))
+        elif latency.kind == "pareto":
+            ms = p[0] * (1.0 + g.pareto(p[1], n))
+        else:
+            ms = np.where(g.random(n) < p[2], p[1], p[0])
+        yield from (ms / 1000.0).tolist()
+
+
+def poisson_arrivals(rate, n, seed=1, burst=0.0, burst_period=1.0, use_numpy=True):
+    """`n` arrival times of a Poisson stream, or with `burst` > 0 a two-state MMPP.
+
+    The bursty stream alternates between rate x (1 + burst) and
+    rate x (1 - burst) for exponential periods of mean `burst_period`
+    seconds, so the mean rate stays `rate` but arrivals clump.
+    """
+    if burst <= 0:
+        if use_numpy and np is not None:
+            return np.cumsum(np.random.default_rng(seed).exponential(1.0 / rate, n)).tolist()
+        rng, t, out = random.Random(seed), 0.0, []
+        for _ in range(n):
+            t += rng.expovariate(rate)
+            out.append(t)
+        return out
+    rng, t, high, out = random.Random(seed), 0.0, True, []
+    while len(out) < n:
+        period = rng.expovariate(1.0 / burst_period)
+        r = rate * (1 + burst if high else 1 - burst)
+        end = t + period
+        if r > 0:
+            while True:
+                t += rng.expovariate(r)
+                if t >= end or len(out) >= n:
+                    break
+                out.append(t)
+        t, high = end, not high
+    return out
+
+
+def load_trace(path):
+    """Arrivals from a text file: one request per line, "<seconds> [client key]"; '#' starts a comment.
+
+    Times are shifted to start at 0 and sorted. Returns (times, keys); keys
+    is None when no line names a client.
+    """
+    rows = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            stamp, _, key = line.partition(" ")
+            try:
+                rows.append((float(stamp.rstrip(",")), key.strip() or None))
+            except ValueError:
+                raise ValueError(f"{path}:{lineno}: bad timestamp {stamp!r}") from None
+    if not rows:
+        raise ValueError(f"{path}: no arrivals")
+    rows.sort(key=lambda r: r[0])
+    start = rows[0][0]
+    times = [t - start for t, _ in rows]
+    keys = [k for _, k in rows] if any(k for _, k in rows) else None
+    return times, keys
+
+
+def zipf_keys(n, clients=5000, zipf_s=1.1, seed=1):
+    ips = _client_ips(clients)
+    popularity = [1.0 / (rank + 1) ** zipf_s for rank in range(clients)]
+    return [ips[i] for i in random.Random(seed).choices(range(clients), weights=popularity, k=n)]
+
+
+def farm_capacity(profiles):
+    """Requests per second the profiles can serve, counting unlimited capacity as one at a time."""
+    return sum((p.capacity or 1) / p.latency.mean for p in profiles if p.latency.mean > 0)
+
+
+def _percentiles(values, ps, use_numpy):
+    if use_numpy:
+        return [float(v) for v in np.percentile(np.frombuffer(values, dtype=np.float64), ps)]
+    ordered = sorted(values)
+    return [ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100.0 * len(ordered)) - 1))] for p in ps]
+
+
+def simulate_queueing(name, profiles, arrivals, keys=None, seed=1, use_numpy=True):
+    """Replay `arrivals` (seconds, ascending) through one strategy in simulated time.
+
+    Each backend is a FIFO queue in front of `capacity` servers (unlimited
+    if unset) with service times drawn from its profile's latency; `down`
+    script events take it out of the ring (requests already sent finish)
+    and `slow` events stretch its service times. Selection runs through
+    the real BackendIndex and strategy classes, with in-flight counts
+    covering queued and served requests as the LB sees them. Returns
+    queueing delay and response time percentiles plus per-backend share
+    and utilisation (busy server time / (servers x makespan)).
+    """
+    n = len(arrivals)
+    backends = [Backend("10.255.0.%d" % (i + 1), 80, p.name or f"BE-{i + 1}", weight=p.weight)
+                for i, p in enumerate(profiles)]
+    index = BackendIndex(backends)
+    if name == "p2c":
+        strategy = PowerOfTwoChoices(index, rng=random.Random(seed))
+    else:
+        strategy = make_strategy(name, index)
+    if strategy.name == "hash" and keys is None:
+        keys = zipf_keys(n, seed=seed)
+    use_numpy = use_numpy and np is not None
+    slot = {b: i for i, b in enumerate(backends)}
+    samples = [service_times(p.latency, seed * 1000 + i, use_numpy) for i, p in enumerate(profiles)]
+    servers = [p.capacity or math.inf for p in profiles]
+    slow = [[(e.start, e.end, e.value) for e in p.script if e.kind == "slow"] for p in profiles]
+    flips = sorted([(e.start, i, False) for i, p in enumerate(profiles) for e in p.script if e.kind == "down"] +
+                   [(e.end, i, True) for i, p in enumerate(profiles) for e in p.script if e.kind == "down"])
+    busy = [0] * len(backends)
+    queues = [collections.deque() for _ in backends]
+    busy_time = [0.0] * len(backends)
+    wait = array.array("d", bytes(8 * n))
+    resp = array.array("d", bytes(8 * n))
+    where = array.array("H", bytes(2 * n))
+    done_heap = []
+    push, pop = heapq.heappush, heapq.heappop
+    release, acquire, select = index.release, index.acquire, strategy.select
+    next_flip = flips[0][0] if flips else math.inf
+    flip_pos = 0
+
+    def complete(now, i):
+        release(backends[i])
+        q = queues[i]
+        if q:
+            arrived, service, j = q.popleft()
+            wait[j] = now - arrived
+            resp[j] = now - arrived + service
+            push(done_heap, (now + service, i))
+        else:
+            busy[i] -= 1
+
+    started = time.perf_counter()
+    for k in range(n):
+        t = arrivals[k]
+        while done_heap and done_heap[0][0] <= t:
+            complete(*pop(done_heap))
+        while t >= next_flip:
+            _, i, healthy = flips[flip_pos]
+            backends[i].healthy = healthy
+            flip_pos += 1
+            next_flip = flips[flip_pos][0] if flip_pos < len(flips) else math.inf
+        b = select(keys[k] if keys is not None else None)
+        i = slot[b]
+        acquire(b)
+        service = next(samples[i])
+        for start, end, factor in slow[i]:
+            if start <= t < end:
+                service *= factor
+        busy_time[i] += service
+        where[k] = i
+        if busy[i] < servers[i]:
+            busy[i] += 1
+            resp[k] = service
+            push(done_heap, (t + service, i))
+        else:
+            queues[i].append((t, service, k))
+    makespan = arrivals[-1] if n else 0.0
+    while done_heap:
+        makespan, i = pop(done_heap)
+        complete(makespan, i)
+    elapsed = time.perf_counter() - started
+
+    ps = (50, 99, 99.9)
+    w50, w99, w999 = _percentiles(wait, ps, use_numpy)
+    r50, r99, r999 = _percentiles(resp, ps, use_numpy)
+    if use_numpy:
+        counts = np.bincount(np.frombuffer(where, dtype=np.uint16), minlength=len(backends)).tolist()
+        wait_sums = np.bincount(np.frombuffer(where, dtype=np.uint16), weights=np.frombuffer(wait),
+                                minlength=len(backends)).tolist()
+        mean_wait, mean_resp = float(np.mean(wait)), float(np.mean(resp))
+    else:
+        counts, wait_sums = [0] * len(backends), [0.0] * len(backends)
+        for i, w in zip(where, wait):
+            counts[i] += 1
+            wait_sums[i] += w
+        mean_wait, mean_resp = math.fsum(wait) / n, math.fsum(resp) / n
+    per_backend = {}
+    for i, b in enumerate(backends):
+        util = busy_time[i] / (servers[i] * makespan) if makespan and servers[i] != math.inf else None
+        per_backend[b.name] = {"share": round(counts[i] / n, 4), "utilisation": None if util is None else round(util, 3),
+                               "busy_servers": round(busy_time[i] / makespan, 2) if makespan else 0.0,
+                               "mean_wait_ms": round(wait_sums[i] / counts[i] * 1000, 3) if counts[i] else 0.0}
+    ms = lambda v: round(v * 1000, 3)
+    return {"algo": strategy.describe(), "requests": n, "duration_s": round(makespan, 3),
+            "offered_rps": round(n / arrivals[-1], 1) if n and arrivals[-1] else None,
+            "queued": sum(1 for w in wait if w > 0), "mean_wait_ms": ms(mean_wait),
+            "wait_p50_ms": ms(w50), "wait_p99_ms": ms(w99), "wait_p999_ms": ms(w999),
+            "mean_response_ms": ms(mean_resp), "response_p50_ms": ms(r50), "response_p99_ms": ms(r99),
+            "response_p999_ms": ms(r999), "backends": per_backend,
+            "sim_seconds": round(elapsed, 3), "sim_requests_per_s": round(n / elapsed) if elapsed else None,
+            "numpy": use_numpy}
+
+
+QUEUEING_PROFILES = ["latency=exp:10,capacity=4,weight=2", "latency=exp:10,capacity=4,weight=2",
+                     "latency=exp:10,capacity=4,weight=2", "latency=lognormal:20:0.6,capacity=4,weight=1"]
+
+
+def main_queueing(argv):
+    parser = argparse.ArgumentParser(prog="lb_sim.py queueing",
+                                     description="Discrete-event queueing simulation of load-balancing algorithms")
+    parser.add_argument("--algos", nargs="+", default=["roundrobin", "leastconn", "weighted", "p2c"],
+                        choices=sorted(ALGORITHMS))
+    parser.add_argument("--profile", nargs="+", metavar="SPEC", default=QUEUEING_PROFILES,
+                        help="backend profiles (lb_farm.BackendProfile specs), one per backend")
+    parser.add_argument("--requests", type=int, default=1000000)
+    parser.add_argument("--load", type=float, default=0.8,
+                        help="offered load as a fraction of the pool's capacity (default: 0.8)")
+    parser.add_argument("--rate", type=float, help="arrival rate in requests/s (overrides --load)")
+    parser.add_argument("--burst", type=float, default=0.0,
+                        help="0..1: alternate between rate x (1+burst) and x (1-burst) (default: 0, Poisson)")
+    parser.add_argument("--burst-period", type=float, default=1.0, help="mean seconds per burst phase")
+    parser.add_argument("--trace", help="replay arrivals from a file: '<seconds> [client]' per line")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-numpy", action="store_true", help="use the pure-Python sampling and statistics")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    profiles = [BackendProfile.parse(spec) for spec in args.profile]
+    use_numpy = not args.no_numpy and np is not None
+    keys = None
+    if args.trace:
+        arrivals, keys = load_trace(args.trace)
+        print(f"[sim] {len(arrivals)} arrivals over {arrivals[-1]:.1f}s from {args.trace}")
+    else:
+        rate = args.rate or args.load * farm_capacity(profiles)
+        arrivals = poisson_arrivals(rate, args.requests, args.seed, args.burst, args.burst_period, use_numpy)
+        print(f"[sim] {args.requests} arrivals at {rate:.0f} req/s "
+              f"({rate / farm_capacity(profiles):.0%} of capacity{', bursty' if args.burst > 0 else ''})"
+              f"{'' if use_numpy else ', pure Python'}")
+    for p in profiles:
+        print(f"[sim]   {p.describe()}")
+
+    results = []
+    print(f"{'algorithm':28} {'wait p50':>9} {'wait p99':>9} {'resp p99':>9} {'resp p999':>10} {'queued':>7} "
+          f"{'utilisation':>24} {'sim s':>6}")
+    for name in args.algos:
+        r = simulate_queueing(name, profiles, arrivals, keys, seed=args.seed, use_numpy=use_numpy)
+        results.append(r)
+        util = " ".join(f"{st['utilisation']:.2f}" if st["utilisation"] is not None else "-"
+                        for st in r["backends"].values())
+        print(f"{r['algo']:28} {r['wait_p50_ms']:9.2f} {r['wait_p99_ms']:9.2f} {r['response_p99_ms']:9.2f} "
+              f"{r['response_p999_ms']:10.2f} {r['queued'] / r['requests']:7.1%} {util:>24} {r['sim_seconds']:6.2f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["queueing"]:
+        return main_queueing(argv[1:])
+    parser = argparse.ArgumentParser(description="Offline load-balancing strategy simulation",
+                                     epilog="'lb_sim.py queueing --help' for the discrete-event queueing model")
+    parser.add_argument("--algos", nargs="+", default=["roundrobin", "leastconn", "weighted", "p2c", "hash"],
+                        choices=sorted(ALGORITHMS))
+    parser.add_argument("--weights", nargs="+", type=int, default=[1, 1, 1, 1, 2, 2, 4, 4],
+                        help="one weight per simulated backend")
+    parser.add_argument("--clients", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--concurrency", type=int, default=64, help="mean ticks a request stays in flight")
+    parser.add_argument("--cache-size", type=int, default=500, help="keys each backend can keep warm")
+    parser.add_argument("--fail-at", type=float, default=0.5, help="fraction of the run when BE-1 goes down (0: never)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    print(f"{'algorithm':28} {'skew':>6} {'cv':>6} {'hit%':>6} {'hit% pre':>9} {'hit% post':>10}")
+    for name in args.algos:
+        r = simulate_strategy(name, args.weights, clients=args.clients, requests=args.requests,
+                              concurrency=args.concurrency, cache_size=args.cache_size,
+                              fail_at=args.fail_at, seed=args.seed)
+        results.append(r)
+        pre, post = r["hit_rate_before_failure"], r["hit_rate_after_failure"]
+        print(f"{r['algo']:28} {r['skew_max_over_mean']:6} {r['cv']:6} {r['hit_rate'] * 100:6.1f} "
+              f"{(pre or 0) * 100:9.1f} {(post or 0) * 100:10.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,64 @@
 
+import select
 import socket
 import threading
 import time
-import select
 import sys
-from urllib.parse import urlparse
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import random
+import argparse
+import asyncio
+import json
+import zlib
+from http import HTTPStatus
+from urllib.parse import unquote, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
 
+from lb_algorithms import (BackendIndex, StickyTable, affinity_token, make_strategy,
+                           ALIASES, ALGORITHMS)
+from lb_pool import UpstreamPool
+from lb_outlier import OutlierDetector
+from lb_admission import AdmissionController
+from lb_retry import Hedge, RetryPolicy
+from lb_config import ConfigWatcher, parse_backends
+from lb_cache import CaptureSink, ResponseCache
+from lb_http import (ClientDisconnected, RelayResult, RequestHead, ResponseFramer, SocketReader,
+                     Splicer, build_head, parse_chunk_size, relay_chunked, relay_exact, MAX_HEADER_BYTES,
+                     SPLICE_AVAILABLE)
+from lb_metrics import Metrics, PrometheusText
+
 
 class SimpleBackendHandler(BaseHTTPRequestHandler):
     server_id = "backend-unknown"
+    disable_nagle_algorithm = True
+    max_age = 5
+    delay = 0.0  # seconds of simulated work before each non-health response
+    slots = None  # semaphore bounding how many requests do that work at once
+    BULK_BLOCK = b"x" * 1048576
+
+    def _work(self):
+        if self.slots is not None:
+            with self.slots:
+                time.sleep(self.delay)
+        elif self.delay:
+            time.sleep(self.delay)
 
     def do_GET(self):
+        if self.path != "/health":
+            self._work()
+        if self.path.startswith("/bytes/"):
+            # bulk payload for relay benchmarks
+            n = int(self.path[len("/bytes/"):] or 0)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(n))
+            self.end_headers()
+            block = memoryview(self.BULK_BLOCK)
+            while n > 0:
+                self.wfile.write(block[:min(n, len(block))])
+                n -= len(block)
+            return
+
         if self.path == "/health":
             self.send_response(200)
             self.send_header("Content-Type", "text/plain")
@@ -21,32 +67,74 @@ class SimpleBackendHandler(BaseHTTPRequestHandler):
             self.wfile.write(b"OK")
             return
 
+        self.server.count_request()
         body = f"Hello from {self.server_id}! You requested {self.path}\n".encode("utf-8")
+        etag = f'"{zlib.crc32(body):08x}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", f"max-age={self.max_age}")
+            self.end_headers()
+            return
         self.send_response(200)
         self.send_header("Content-Type", "text/plain")
         self.send_header("Content-Length", str(len(body)))
         self.send_header("X-Backend-ID", self.server_id)
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", f"max-age={self.max_age}")
         self.end_headers()
         self.wfile.write(body)
 
     def do_POST(self):
+        self._work()
         length = int(self.headers.get("Content-Length", "0"))
-        data = self.rfile.read(length) if length > 0 else b""
-        body = f"POST to {self.server_id}: got {len(data)} bytes\n".encode("utf-8")
+        received = 0
+        while received < length:
+            chunk = self.rfile.read(min(length - received, 1048576))
+            if not chunk:
+                break
+            received += len(chunk)
+        body = f"POST to {self.server_id}: got {received} bytes\n".encode("utf-8")
         self.send_response(200)
         self.send_header("Content-Type", "text/plain")
         self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Backend-ID", self.server_id)
         self.end_headers()
         self.wfile.write(body)
 
     def log_message(self, format, *args):
         pass
 
-def start_test_backend(bind_host, bind_port, server_id):
+class TestBackendServer(ThreadingHTTPServer):
+    request_queue_size = 128
+    daemon_threads = True
+    accepted = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._served_lock = threading.Lock()
+        self.served = 0
+
+    def count_request(self):
+        with self._served_lock:
+            self.served += 1
+
+    def process_request(self, request, client_address):
+        self.accepted += 1
+        super().process_request(request, client_address)
+
+
+def start_test_backend(bind_host, bind_port, server_id, keepalive=False, delay=0.0, capacity=None):
+    """`capacity` limits how many requests spend `delay` at once; the rest wait their turn."""
     class Handler(SimpleBackendHandler):
         pass
     Handler.server_id = server_id
-    httpd = HTTPServer((bind_host, bind_port), Handler)
+    Handler.delay = delay
+    if capacity:
+        Handler.slots = threading.Semaphore(capacity)
+    if keepalive:
+        Handler.protocol_version = "HTTP/1.1"
+    httpd = TestBackendServer((bind_host, bind_port), Handler)
     t = threading.Thread(target=httpd.serve_forever, daemon=True)
     t.start()
     print(f"[backend {server_id}] started at {bind_host}:{bind_port}")
@@ -54,312 +142,1731 @@ def start_test_backend(bind_host, bind_port, server_id):
 
 
 class Backend:
-    def __init__(self, host, port, name=None):
+    def __init__(self, host, port, name=None, weight=1):
         self.host = host
         self.port = port
         self.name = name or f"{host}:{port}"
+        self.weight = weight
         self.lock = threading.Lock()
         self.active_connections = 0
-        self.healthy = True
+        self._healthy = True
+        self._ejected = False
+        self._draining = False
+        self._listeners = []
         self.last_checked = 0.0
+        self.pool = UpstreamPool(self)
+
+    @property
+    def healthy(self):
+        return self._healthy
+
+    @healthy.setter
+    def healthy(self, value):
+        value = bool(value)
+        if value == self._healthy:
+            return
+        self._healthy = value
+        self._notify()
+
+    @property
+    def ejected(self):
+        """Set by passive outlier detection; ejected backends leave the selection ring."""
+        return self._ejected
+
+    @ejected.setter
+    def ejected(self, value):
+        value = bool(value)
+        if value == self._ejected:
+            return
+        self._ejected = value
+        self._notify()
+
+    @property
+    def draining(self):
+        """Set while the backend is being taken out of service: no new requests, in-flight ones finish."""
+        return self._draining
+
+    @draining.setter
+    def draining(self, value):
+        value = bool(value)
+        if value == self._draining:
+            return
+        self._draining = value
+        self._notify()
+
+    @property
+    def available(self):
+        return self._healthy and not self._ejected and not self._draining
+
+    def _notify(self):
+        for callback in list(self._listeners):
+            callback(self)
+
+    def add_listener(self, callback):
+        """callback(backend) runs whenever `healthy`, `ejected` or `draining` flips."""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        try:
+            self._listeners.remove(callback)
+        except ValueError:
+            pass
 
     def __repr__(self):
-        return f"<Backend {self.name} healthy={self.healthy} active={self.active_connections}>"
+        return (f"<Backend {self.name} weight={self.weight} healthy={self.healthy} "
+                f"ejected={self.ejected} draining={self.draining} active={self.active_connections}>")
+
+
+class BackendPool:
+    """The live set of backends, shared by LoadBalancer and HealthChecker.
+
+    `members` is an immutable tuple replaced on every change, so readers
+    iterate it without locking. Subscribers are called as
+    callback(added, removed) after each change.
+    """
+
+    def __init__(self, backends=()):
+        self.members = tuple(backends)
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        try:
+            self._subscribers.remove(callback)
+        except ValueError:
+            pass
+
+    def find(self, key):
+        """A member by name or "host:port" (case-insensitive name match), else None."""
+        for b in self.members:
+            if b.name == key or f"{b.host}:{b.port}" == key:
+                return b
+        key = key.lower()
+        return next((b for b in self.members if b.name.lower() == key), None)
+
+    def add(self, backend):
+        with self._lock:
+            if any((b.host, b.port) == (backend.host, backend.port) for b in self.members):
+                raise ValueError(f"{backend.host}:{backend.port} is already in the pool")
+            self.members = self.members + (backend,)
+        for callback in list(self._subscribers):
+            callback([backend], [])
+
+    def remove(self, backend):
+        with self._lock:
+            if backend not in self.members:
+                return False
+            self.members = tuple(b for b in self.members if b is not backend)
+        for callback in list(self._subscribers):
+            callback([], [backend])
+        return True
+
+class _ProbeState:
+    __slots__ = ("successes", "failures", "reader", "writer")
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.reader = None
+        self.writer = None
+
 
 class HealthChecker(threading.Thread):
-    def __init__(self, backends, interval=5.0, timeout=2.0, use_http_health=True):
+    """Active health checks for every backend, run concurrently on one asyncio loop.
+
+    Each backend has its own probe schedule: `interval` with +/- `jitter`
+    spread, stretched exponentially (up to `max_backoff`) while the backend
+    stays DOWN. A backend goes DOWN after `fall` consecutive failed probes
+    and comes back UP after `rise` consecutive successes. HTTP probes keep
+    their connection alive between checks when the backend allows it.
+    """
+
+    def __init__(self, backends, interval=5.0, timeout=2.0, use_http_health=True,
+                 rise=2, fall=3, jitter=0.1, max_backoff=30.0, max_concurrency=256):
+        """backends: a list, or a BackendPool whose later additions/removals are followed."""
         super().__init__(daemon=True)
-        self.backends = backends
+        self.pool = backends if isinstance(backends, BackendPool) else BackendPool(backends)
         self.interval = interval
         self.timeout = timeout
         self.use_http_health = use_http_health
-        self._stop = threading.Event()
+        self.rise = rise
+        self.fall = fall
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.max_concurrency = max_concurrency
+        self.probes = 0
+        self._state = {}
+        self._tasks = {}
+        self._loop = None
+        self._rng = random.Random()
+        self._stopped = threading.Event()
+
+    @property
+    def backends(self):
+        return self.pool.members
 
     def run(self):
-        while not self._stop.is_set():
-            for b in self.backends:
-                self.check_backend(b)
-            time.sleep(self.interval)
+        asyncio.run(self._run())
 
     def stop(self):
-        self._stop.set()
+        self._stopped.set()
 
-    def check_backend(self, backend: Backend):
-        addr = (backend.host, backend.port)
-        success = False
+    def _on_pool_change(self, added, removed):
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._follow, added, removed)
+
+    def _follow(self, added, removed):
+        for b in added:
+            if b not in self._tasks:
+                self._tasks[b] = asyncio.create_task(self._watch(b))
+        for b in removed:
+            task = self._tasks.pop(b, None)
+            if task is not None:
+                task.cancel()
+            st = self._state.pop(b, None)
+            if st is not None and st.writer is not None:
+                st.writer.close()
+
+    async def _run(self):
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+        self._loop = asyncio.get_running_loop()
+        self.pool.subscribe(self._on_pool_change)
+        self._follow(self.pool.members, ())
+        while not self._stopped.is_set():
+            await asyncio.sleep(0.2)
+        self.pool.unsubscribe(self._on_pool_change)
+        self._loop = None
+        tasks = list(self._tasks.values())
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for st in self._state.values():
+            if st.writer is not None:
+                st.writer.close()
+
+    def _next_delay(self, backend: Backend, st: _ProbeState):
+        delay = self.interval
+        if not backend.healthy and st.failures > self.fall:
+            delay = min(self.max_backoff, self.interval * 2 ** (st.failures - self.fall))
+        return delay * self._rng.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def _watch(self, backend: Backend):
+        st = self._state.setdefault(backend, _ProbeState())
+        await asyncio.sleep(self._rng.uniform(0, self.interval * self.jitter))
+        while not self._stopped.is_set():
+            async with self._sem:
+                success = await self._probe(backend, st)
+            self._record(backend, st, success)
+            await asyncio.sleep(self._next_delay(backend, st))
+
+    async def _probe(self, backend: Backend, st: _ProbeState, reuse=True):
         try:
-            if self.use_http_health:
-                s = socket.create_connection(addr, timeout=self.timeout)
-                s.settimeout(self.timeout)
-                req = b"GET /health HTTP/1.1\r\nHost: %b:%d\r\nConnection: close\r\n\r\n" % (backend.host.encode(), backend.port)
-                s.sendall(req)
-                resp = b""
-                try:
-                    resp = s.recv(1024)
-                except Exception:
-                    resp = b""
-                s.close()
-                if b"200" in resp and b"OK" in resp:
-                    success = True
-            else:
-                s = socket.create_connection(addr, timeout=self.timeout)
-                s.close()
-                success = True
+            return await asyncio.wait_for(self._probe_once(backend, st, reuse), self.timeout)
         except Exception:
-            success = False
-        backend.healthy = success
+            if st.writer is not None:
+                st.writer.close()
+                st.reader = st.writer = None
+            return False
+
+    async def _probe_once(self, backend: Backend, st: _ProbeState, reuse):
+        if not self.use_http_health:
+            _, writer = await asyncio.open_connection(backend.host, backend.port)
+            writer.close()
+            return True
+        connection = "keep-alive" if reuse else "close"
+        request = (b"GET /health HTTP/1.1\r\nHost: %b:%d\r\nConnection: %b\r\n\r\n"
+                   % (backend.host.encode(), backend.port, connection.encode()))
+        while True:
+            reused = reuse and st.writer is not None
+            if not reused:
+                st.reader, st.writer = await asyncio.open_connection(backend.host, backend.port)
+            try:
+                st.writer.write(request)
+                await st.writer.drain()
+                chunk = await st.reader.read(4096)
+                if not chunk:
+                    raise ConnectionError("health endpoint closed the connection without responding")
+            except ConnectionError:
+                st.writer.close()
+                st.reader = st.writer = None
+                if reused:
+                    # the backend closed the idle kept-alive connection: try once on a fresh one
+                    continue
+                raise
+            break
+        framer = ResponseFramer("GET")
+        framer.feed(chunk)
+        while not framer.done:
+            chunk = await st.reader.read(4096)
+            if not chunk:
+                if not framer.eof():
+                    raise ConnectionError("health endpoint closed mid-response")
+                break
+            framer.feed(chunk)
+        if not (reuse and framer.keep_alive):
+            st.writer.close()
+            st.reader = st.writer = None
+        return framer.status == 200
+
+    def _record(self, backend: Backend, st: _ProbeState, success):
+        self.probes += 1
         backend.last_checked = time.time()
-        status = "UP" if success else "DOWN"
-        print(f"[health] {backend.name} -> {status}")
+        if success:
+            st.successes, st.failures = st.successes + 1, 0
+            if not backend.healthy and st.successes >= self.rise:
+                backend.healthy = True
+                print(f"[health] {backend.name} -> UP")
+        else:
+            st.successes, st.failures = 0, st.failures + 1
+            if backend.healthy and st.failures >= self.fall:
+                backend.healthy = False
+                print(f"[health] {backend.name} -> DOWN")
+            if not backend.healthy:
+                backend.pool.drain()
+
+    def check_backend(self, backend: Backend):
+        """Probe one backend right now, outside its schedule; returns True if it answered."""
+        st = self._state.setdefault(backend, _ProbeState())
+        success = asyncio.run(self._probe(backend, _ProbeState(), reuse=False))
+        self._record(backend, st, success)
+        return success
+
+def _error_response(status, reason):
+    body = reason.encode("ascii")
+    return (b"HTTP/1.1 %d %b\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%b"
+            % (status, body, len(body), body))
+
+
+RESP_500 = _error_response(500, "Internal Server Error")
+RESP_502 = _error_response(502, "Bad Gateway")
+RESP_503 = _error_response(503, "Service Unavailable")
+# admission control sheds with a keep-alive 503 so retrying clients do not reconnect
+RESP_503_BUSY = (b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 11\r\nRetry-After: 1\r\n"
+                 b"Connection: keep-alive\r\n\r\nOverloaded\n")
+
+
+def _failed(status, response, keep_alive=False):
+    """RelayResult for an error response the LB sent itself."""
+    result = RelayResult(status, len(response), keep_alive)
+    result.failed = True
+    return result
+
+ENGINES = ("threaded", "asyncio")
+ADMIN_PREFIX = "/__lb/"
+ADMIN_MAX_BODY = 65536
+LOOPBACK = ("127.0.0.1", "::1")
+
 
 class LoadBalancer:
     def __init__(self, listen_host, listen_port, backends,
                  algo="roundrobin", sticky_by_ip=False,
-                 conn_timeout=10.0, backend_timeout=10.0):
+                 conn_timeout=10.0, backend_timeout=10.0,
+                 engine="threaded", backlog=200, relay_buffer_size=65536,
+                 response_framing=True, upstream_keepalive=True,
+                 pool_size=32, pool_idle_timeout=30.0,
+                 keepalive_timeout=15.0, max_requests_per_conn=100, hash_key="ip",
+                 sticky_capacity=100000, sticky_ttl=300.0, sticky_cookie=None,
+                 outlier_detection=True, outlier_options=None, reuse_port=False,
+                 zero_copy=False, splice_threshold=65536, cache_bytes=0, cache_options=None,
+                 max_connections=None, adaptive_concurrency=None, queue_size=128, queue_timeout=1.0,
+                 admission_options=None, max_clients=None, retries=1, hedge=False, retry_options=None):
         """
-        backends: list of Backend objects
-        algo: 'roundrobin' or 'leastconn'
-        sticky_by_ip: boolean
+        backends: list of Backend objects, or a BackendPool to share with a HealthChecker
+              (add_backend/remove_backend/apply_config change it at runtime)
+        algo: 'roundrobin', 'leastconn', 'weighted' (smooth weighted round-robin on
+              Backend.weight), 'p2c' (power of two random choices) or 'hash'
+              (consistent hash ring keyed by hash_key: 'ip' or 'header:<Name>')
+        sticky_by_ip: boolean; remembers each client IP's backend in a bounded
+              table (sticky_capacity entries, idle entries expire after sticky_ttl)
+        sticky_cookie: cookie name; when set, affinity travels in that cookie
+              instead of the per-IP table, so it survives NAT and IP changes
+        engine: 'threaded' (one thread per client) or 'asyncio' (one event loop
+                multiplexing every client and backend socket)
+        relay_buffer_size: bytes buffered per direction while streaming bodies
+        response_framing: end backend reads on Content-Length / chunked terminator /
+                close; False falls back to waiting for 1s of backend silence
+        upstream_keepalive: reuse backend connections from each Backend's pool
+                (at most pool_size idle sockets, closed after pool_idle_timeout)
+        keepalive_timeout: how long an idle client connection waits for its next request
+        max_requests_per_conn: requests served on one client connection before closing it
+        outlier_detection: eject backends that fail or slow down under live traffic
+                (see OutlierDetector; outlier_options are passed to it)
+        reuse_port: bind with SO_REUSEPORT so several worker processes can share
+                the listen port (see lb_workers.WorkerPool)
+        zero_copy: relay Content-Length bodies of at least splice_threshold bytes with
+                os.splice through a pipe (Linux, threaded engine); elsewhere the
+                buffered relay is used
+        cache_bytes: size budget of the GET response cache (0 disables it; see
+                ResponseCache, cache_options are passed to it)
+        max_connections: in-flight requests allowed per backend; adaptive_concurrency
+                ('aimd' or 'gradient') adapts each backend's limit below that to its
+                latency. With either set, requests that find every backend full wait
+                in a queue of queue_size for up to queue_timeout, then get a 503
+                (see AdmissionController, admission_options are passed to it)
+        max_clients: client connections served at once; further connections get an
+                immediate 503 instead of a thread (threaded) or a task (asyncio)
+        retries: times an idempotent, body-less request that failed before any byte
+                reached the client is sent again, each time to a backend it has not
+                tried; hedge: also send safe requests to a second backend once the
+                first has not answered within the p95 response time. Both draw on one
+                retry budget (see RetryPolicy, retry_options are passed to it)
         """
+        if engine not in ENGINES:
+            raise ValueError(f"unknown engine {engine!r}, expected one of {ENGINES}")
         self.listen_host = listen_host
         self.listen_port = listen_port
-        self.backends = backends[:]  
-        self.algo = algo
+        self.pool = backends if isinstance(backends, BackendPool) else BackendPool(backends)
+        self.pool_size = pool_size
+        self.pool_idle_timeout = pool_idle_timeout
         self.sticky_by_ip = sticky_by_ip
         self.conn_timeout = conn_timeout
         self.backend_timeout = backend_timeout
-
-        self._rr_index = 0
-        self._sticky_map = {} 
+        self.engine = engine
+        self.backlog = backlog
+        self.relay_buffer_size = relay_buffer_size
+        self.response_framing = response_framing
+        self.upstream_keepalive = upstream_keepalive and response_framing
+        self.keepalive_timeout = keepalive_timeout
+        self.max_requests_per_conn = max_requests_per_conn
+        self.reuse_port = reuse_port
+        self.zero_copy = zero_copy and SPLICE_AVAILABLE and engine == "threaded" and response_framing
+        self.splice_threshold = splice_threshold
+        if zero_copy and not self.zero_copy:
+            print("[lb] zero-copy relay needs os.splice, the threaded engine and response framing; using buffered relay")
+        self._index = BackendIndex(self.backends)
+        self._by_name = {}
+        self._by_token = {}
+        # backends with a removal under way, and those of them a config reload started
+        self._removing = set()
+        self._reload_removing = set()
+        self.hash_key = hash_key
+        self.algo = algo
+        self._sticky = StickyTable(sticky_capacity, sticky_ttl)
+        self.sticky_cookie = sticky_cookie
+        self.metrics = Metrics()
+        self._report_mark = (self.metrics.started, 0)
+        self.cache = ResponseCache(cache_bytes, **(cache_options or {})) if cache_bytes else None
+        self.outliers = OutlierDetector(**(outlier_options or {})) if outlier_detection else None
+        self.admission = None
+        if max_connections or adaptive_concurrency:
+            self.admission = AdmissionController(self._index, self.backends, max_connections or 1000, queue_size,
+                                                 queue_timeout, adaptive_concurrency, admission_options)
+        self.retry = RetryPolicy(retries, hedge, **(retry_options or {})) if retries or hedge else None
+        self.max_clients = max_clients
+        self._client_slots = threading.BoundedSemaphore(max_clients) if max_clients else None
+        self._async_clients = 0
+        for b in self.backends:
+            self._attach(b)
+        self.pool.subscribe(self._on_pool_change)
         self._lock = threading.Lock()
         self._stop = threading.Event()
 
+    @property
+    def backends(self):
+        return self.pool.members
+
+    def _attach(self, backend: Backend):
+        backend.pool.max_size = self.pool_size
+        backend.pool.idle_timeout = self.pool_idle_timeout
+        self._by_name[backend.name] = backend
+        self._by_token[affinity_token(backend)] = backend
+        if self.outliers is not None:
+            self.outliers.breaker(backend)
+        if self.admission is not None:
+            self.admission.limit(backend)
+
+    def _detach(self, backend: Backend):
+        self._index.remove(backend)
+        if self._by_name.get(backend.name) is backend:
+            del self._by_name[backend.name]
+        self._by_token.pop(affinity_token(backend), None)
+        if self.outliers is not None:
+            self.outliers.forget(backend)
+        if self.admission is not None:
+            self.admission.forget(backend)
+        backend.pool.drain()
+
+    def _on_pool_change(self, added, removed):
+        for b in added:
+            self._attach(b)
+            self._index.add(b)
+        for b in removed:
+            self._detach(b)
+
+    def add_backend(self, host, port, name=None, weight=1):
+        """Put a new backend into rotation (it starts taking requests right away)."""
+        backend = Backend(host, port, name, weight)
+        self.pool.add(backend)
+        print(f"[lb] added {backend.name} ({host}:{port}, weight {weight})")
+        return backend
+
+    def drain_backend(self, backend: Backend):
+        """Stop sending new requests to a backend; requests already on it finish."""
+        backend.draining = True
+        backend.pool.drain()
+        print(f"[lb] draining {backend.name} ({self._index.connections(backend)} in flight)")
+
+    def undrain_backend(self, backend: Backend):
+        backend.draining = False
+        print(f"[lb] {backend.name} back in rotation")
+
+    def remove_backend(self, backend: Backend, timeout=30.0):
+        """Drain a backend, then drop it from the pool once its in-flight requests are done.
+
+        Runs in the background; returns the thread doing the wait. After
+        `timeout` seconds the backend is removed even if requests remain.
+        Returns None if a removal of the backend is already under way.
+        """
+        return self._start_removal(backend, timeout)
+
+    def _start_removal(self, backend: Backend, timeout, by_reload=False):
+        if backend in self._removing and backend.draining:
+            return None
+        # recorded before the thread starts, which may finish the removal right away
+        self._removing.add(backend)
+        if by_reload:
+            self._reload_removing.add(backend)
+        self.drain_backend(backend)
+        t = threading.Thread(target=self._finish_removal, args=(backend, timeout), daemon=True)
+        t.start()
+        return t
+
+    def _finish_removal(self, backend: Backend, timeout):
+        deadline = time.monotonic() + timeout
+        try:
+            while backend.draining and self._index.connections(backend) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            if not backend.draining:
+                print(f"[lb] removal of {backend.name} cancelled, it is back in rotation")
+                return
+            left = self._index.connections(backend)
+            if self.pool.remove(backend):
+                print(f"[lb] removed {backend.name}" + (f" with {left} requests still running" if left else ""))
+        finally:
+            self._removing.discard(backend)
+            self._reload_removing.discard(backend)
+
+    def apply_config(self, entries, drain_timeout=30.0):
+        """Make the pool match `entries` (dicts with host, port and optional name, weight).
+
+        Backends are matched on host:port: new ones are added, missing ones
+        drained and removed (also those drained by hand), and changed weights
+        take effect immediately. A backend that an earlier reload was removing
+        and that is listed again goes back into rotation; one drained by hand
+        stays drained. Returns (added, removed, updated) counts.
+        """
+        wanted = {(e["host"], int(e["port"])): e for e in entries}
+        current = {(b.host, b.port): b for b in self.backends}
+        added = removed = updated = reweighted = 0
+        for addr, b in current.items():
+            if addr not in wanted and self._start_removal(b, drain_timeout, by_reload=True) is not None:
+                removed += 1
+        for addr, e in wanted.items():
+            weight = int(e.get("weight", 1))
+            b = current.get(addr)
+            if b is None:
+                self.add_backend(addr[0], addr[1], e.get("name"), weight)
+                added += 1
+                continue
+            changed = False
+            if b in self._reload_removing:
+                self._reload_removing.discard(b)
+                self.undrain_backend(b)
+                changed = True
+            if b.weight != weight:
+                b.weight = weight
+                reweighted += 1
+                changed = True
+            if changed:
+                updated += 1
+        if reweighted:
+            self._index.rebuild()
+        return added, removed, updated
+
     def start(self):
         t = threading.Thread(target=self.serve_forever, daemon=True)
         t.start()
-        print(f"[lb] listening on {self.listen_host}:{self.listen_port} (algo={self.algo}, sticky_by_ip={self.sticky_by_ip})")
+        print(f"[lb] listening on {self.listen_host}:{self.listen_port} (engine={self.engine}, algo={self.algo}, sticky={self.sticky_mode})")
 
     def stop(self):
         self._stop.set()
+        self.pool.unsubscribe(self._on_pool_change)
 
     def serve_forever(self):
+        if self.engine == "asyncio":
+            asyncio.run(self._serve_async())
+            return
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             s.bind((self.listen_host, self.listen_port))
-            s.listen(200)
+            s.listen(self.backlog)
             s.settimeout(1.0)
             while not self._stop.is_set():
                 try:
                     client_sock, client_addr = s.accept()
                 except socket.timeout:
                     continue
-                t = threading.Thread(target=self.handle_client, args=(client_sock, client_addr), daemon=True)
+                if self._client_slots is not None and not self._client_slots.acquire(blocking=False):
+                    self._shed_client(client_sock)
+                    continue
+                t = threading.Thread(target=self._serve_client, args=(client_sock, client_addr), daemon=True)
                 t.start()
 
-    def choose_backend(self, client_ip):
-        healthy = [b for b in self.backends if b.healthy]
-        if not healthy:
-            healthy = self.backends[:]
-
-
-        if self.sticky_by_ip:
-            mapped = self._sticky_map.get(client_ip)
-            if mapped:
-                for b in healthy:
-                    if b.name == mapped:
-                        return b
-
-        if self.algo == "roundrobin":
-            with self._lock:
-                idx = self._rr_index % len(healthy)
-                sel = healthy[idx]
-                self._rr_index += 1
-        elif self.algo == "leastconn":
-            sel = min(healthy, key=lambda b: b.active_connections)
-        else:
-            sel = healthy[0]
+    def _serve_client(self, client_sock, client_addr):
+        try:
+            self.handle_client(client_sock, client_addr)
+        finally:
+            if self._client_slots is not None:
+                self._client_slots.release()
+
+    def _shed_client(self, client_sock):
+        """Turn away a connection over max_clients without spending a thread on it."""
+        try:
+            client_sock.setblocking(False)
+            client_sock.send(RESP_503)
+        except OSError:
+            pass
+        finally:
+            client_sock.close()
+        self.metrics.exchange(503, 0, len(RESP_503), 0.0)
+
+    @property
+    def algo(self):
+        return self.strategy.name
+
+    @algo.setter
+    def algo(self, name):
+        options = {"key": self.hash_key} if ALIASES.get(name, name) == "hash" else {}
+        self.strategy = make_strategy(name, self._index, **options)
+
+    def set_algorithm(self, name, hash_key=None):
+        if hash_key is not None:
+            self.hash_key = hash_key
+        self.algo = name
+        return self.strategy.describe()
 
-        if self.sticky_by_ip:
-            self._sticky_map[client_ip] = sel.name
+    @property
+    def sticky_mode(self):
+        if self.sticky_cookie:
+            return f"cookie:{self.sticky_cookie}"
+        return "ip" if self.sticky_by_ip else "off"
+
+    def choose_backend(self, client_ip, request=None):
+        if self.outliers is not None:
+            trial = self.outliers.trial()
+            if trial is not None:
+                return trial
+        if self.sticky_cookie:
+            if request is not None:
+                mapped = self._by_token.get(request.cookie(self.sticky_cookie))
+                if mapped is not None and (mapped.available or not (self._index.ring or mapped.draining)):
+                    return mapped
+        elif self.sticky_by_ip:
+            mapped = self._by_name.get(self._sticky.get(client_ip))
+            if mapped is not None and (mapped.available or not (self._index.ring or mapped.draining)):
+                return mapped
+
+        sel = self.strategy.select(client_ip, request)
+
+        if self.sticky_by_ip and not self.sticky_cookie and sel is not None:
+            self._sticky.put(client_ip, sel.name)
         return sel
 
-    def handle_client(self, client_sock: socket.socket, client_addr):
-        client_ip, client_port = client_addr[0], client_addr[1]
-        client_sock.settimeout(self.conn_timeout)
-        try:
+    def _affinity_headers(self, request: RequestHead, backend: Backend):
+        if not self.sticky_cookie:
+            return ()
+        token = affinity_token(backend)
+        if request.cookie(self.sticky_cookie) == token:
+            return ()
+        return (("Set-Cookie", f"{self.sticky_cookie}={token}; Path=/; HttpOnly"),)
 
-            request = self._recv_http_request(client_sock)
-            if not request:
-                client_sock.close()
-                return
-            backend = self.choose_backend(client_ip)
-            if not backend:
-                client_sock.sendall(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 13\r\n\r\nService Unavailable")
-                client_sock.close()
-                return
+    def sticky_stats(self):
+        return self._sticky.stats()
 
-            with backend.lock:
-                backend.active_connections += 1
+    def _observe(self, backend: Backend, result: RelayResult):
+        """Feed the outcome of one proxied request to metrics and passive outlier detection."""
+        if result is None or result.failed:
+            outcome = "error"
+        else:
+            outcome = "5xx" if (result.status or 0) >= 500 else "ok"
+        self.metrics.backend_result(backend.name, outcome, result.latency if result is not None else None)
+        if self.retry is not None and outcome == "ok":
+            self.retry.latency.record(result.latency)
+        if self.outliers is None or backend.draining:
+            return
+        if outcome == "ok":
+            self.outliers.record(backend, True, result.latency)
+        else:
+            self.outliers.record(backend, False)
+
+    def _record(self, request: RequestHead, status, nbytes):
+        self.metrics.exchange(status or 0, len(request.raw) + request.content_length, nbytes,
+                              time.monotonic() - request.received)
 
+    def _admit(self, client_ip, request: RequestHead):
+        """Choose a backend and take a slot on it.
+
+        Returns (backend, shed): backend is None when there is none to use,
+        with shed True if admission control turned the request away.
+        """
+        if self.admission is None:
+            backend = self.choose_backend(client_ip, request)
+            if backend is not None:
+                self._index.acquire(backend)
+            return backend, False
+        backend, reason = self.admission.acquire(lambda: self.choose_backend(client_ip, request),
+                                                 request.received + self.admission.queue_timeout)
+        return backend, reason not in (None, "no backend")
+
+    async def _admit_async(self, client_ip, request: RequestHead):
+        if self.admission is None:
+            return self._admit(client_ip, request)
+        backend, reason = await self.admission.acquire_async(lambda: self.choose_backend(client_ip, request),
+                                                             request.received + self.admission.queue_timeout)
+        return backend, reason not in (None, "no backend")
+
+    @staticmethod
+    def _refusal(shed, keep_alive):
+        """The 503 for a request that got no backend, and whether the connection stays open."""
+        if shed and keep_alive:
+            return RESP_503_BUSY, True
+        return RESP_503, False
+
+    def _release(self, backend: Backend, result: RelayResult, hedge=None):
+        if hedge is not None and hedge.backend is not None:
+            # the slower of two raced requests was abandoned, not failed
+            winner = hedge.winner or backend
+            self._free(hedge.backend if winner is backend else backend, None, True)
+            backend = winner
+        ok = result is not None and not result.failed and (result.status or 0) < 500
+        self._free(backend, result.latency if result is not None else None, ok)
+
+    def _free(self, backend: Backend, latency, ok):
+        if self.admission is None:
+            self._index.release(backend)
+        else:
+            self.admission.release(backend, latency, ok)
+
+    def _reserve_other(self, tried):
+        """Take a slot on the least loaded available backend not in `tried`, or return None."""
+        candidates = [b for b in self._index.ring if b not in tried]
+        while candidates:
+            backend = min(candidates, key=self._index.connections)
+            if self.admission is None:
+                self._index.acquire(backend)
+                return backend
+            if self.admission.reserve(backend):
+                return backend
+            candidates.remove(backend)
+        return None
+
+    def _spend_on(self, tried):
+        """Another backend for a retry or hedge, if one has room and the retry budget allows."""
+        backend = self._reserve_other(tried)
+        if backend is None:
+            return None
+        if not self.retry.budget.withdraw():
+            self._free(backend, None, True)
+            return None
+        tried.append(backend)
+        return backend
+
+    def _retry_backend(self, request: RequestHead, tried, retried):
+        if self.retry is None or not self.retry.retryable(request, retried):
+            return None
+        backend = self._spend_on(tried)
+        if backend is not None:
+            self.retry.retried += 1
+        return backend
+
+    def _hedge(self, request: RequestHead, tried):
+        # a hedge winner would not match the affinity cookie chosen for the first backend
+        if self.retry is None or self.sticky_cookie:
+            return None
+        delay = self.retry.hedge_delay(request)
+        if delay is None:
+            return None
+
+        def start():
+            backend = self._spend_on(tried)
+            if backend is not None:
+                self.retry.hedged += 1
+            return backend
+        return Hedge(delay, start)
+
+    def _reply(self, client_sock: socket.socket, request: RequestHead, response, keep_alive):
+        """Send a response the LB produced itself (cache hit, admin page) and record it."""
+        client_sock.sendall(response)
+        self._record(request, int(response[9:12]), len(response))
+        return keep_alive
+
+    def _admin_response(self, client_ip, request: RequestHead, body, keep_alive):
+        """Serve /__lb/ endpoints; `body` is the request body, or None if it was too large."""
+        path = urlparse(request.target).path[len(ADMIN_PREFIX):].strip("/")
+        content_type = "application/json"
+        if body is None:
+            status, payload = 413, {"error": f"admin request bodies are limited to {ADMIN_MAX_BODY} bytes"}
+        elif path == "metrics":
+            status, content_type, payload = 200, PrometheusText.CONTENT_TYPE, self.metrics_text()
+        elif path == "backends" or path.startswith("backends/"):
+            status, payload = self._admin_backends(client_ip, request.method, path.split("/")[1:], body)
+        else:
+            status, payload = 404, {"error": "unknown admin endpoint"}
+        data = payload.encode() if isinstance(payload, str) else (json.dumps(payload, indent=1) + "\n").encode()
+        headers = [("Content-Type", content_type), ("Content-Length", str(len(data)))]
+        first = f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"
+        return build_head(first, headers, "keep-alive" if keep_alive else "close") + data
+
+    def _backend_info(self, b: Backend):
+        return {"name": b.name, "host": b.host, "port": b.port, "weight": b.weight, "healthy": b.healthy,
+                "ejected": b.ejected, "draining": b.draining, "active": self._index.connections(b)}
+
+    def _admin_backends(self, client_ip, method, parts, body):
+        """GET/POST/PUT /__lb/backends, DELETE /__lb/backends/<b>, POST /__lb/backends/<b>/drain|undrain."""
+        if method == "GET" and not parts:
+            return 200, [self._backend_info(b) for b in self.backends]
+        if client_ip not in LOOPBACK:
+            return 403, {"error": "pool changes are only accepted from localhost"}
+        try:
+            data = json.loads(body or b"null")
+        except ValueError:
+            return 400, {"error": "body is not JSON"}
+        if not parts:
             try:
-                response = self._forward_to_backend(backend, request)
-                if response is None:
+                if method == "PUT":
+                    added, removed, updated = self.apply_config(parse_backends(data))
+                    return 200, {"added": added, "removed": removed, "updated": updated}
+                if method == "POST":
+                    (entry,) = parse_backends([data])
+                    return 201, self._backend_info(self.add_backend(entry["host"], entry["port"],
+                                                                    entry.get("name"), entry["weight"]))
+            except ValueError as e:
+                return (409 if "already" in str(e) else 400), {"error": str(e)}
+            return 405, {"error": "use GET, POST (one backend) or PUT (the whole list)"}
+        backend = self.pool.find(unquote(parts[0]))
+        if backend is None:
+            return 404, {"error": f"no backend {unquote(parts[0])!r}"}
+        action = parts[1] if len(parts) > 1 else None
+        if method == "DELETE" and action is None:
+            self.remove_backend(backend)
+            return 202, self._backend_info(backend)
+        if method == "POST" and action in ("drain", "undrain"):
+            (self.drain_backend if action == "drain" else self.undrain_backend)(backend)
+            return 200, self._backend_info(backend)
+        return 405, {"error": "use DELETE /__lb/backends/<b> or POST /__lb/backends/<b>/drain|undrain"}
 
-                    client_sock.sendall(b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 11\r\n\r\nBad Gateway")
-                else:
-     
-                    client_sock.sendall(response)
-            finally:
-                with backend.lock:
-                    backend.active_connections = max(0, backend.active_connections - 1)
+    def metrics_text(self):
+        """Prometheus text exposition of request, backend, pool and cache metrics."""
+        snap = self.metrics.snapshot()
+        out = PrometheusText()
+        out.metric("lb_requests_total", "counter", "Client requests answered, by status code.",
+                   [({"code": code}, n) for code, n in sorted(snap.codes.items())])
+        out.metric("lb_received_bytes_total", "counter", "Request bytes received from clients.",
+                   [({}, snap.bytes_in)])
+        out.metric("lb_sent_bytes_total", "counter", "Response bytes sent to clients.", [({}, snap.bytes_out)])
+        out.metric("lb_client_connections_total", "counter", "Client connections accepted.", [({}, snap.opened)])
+        out.metric("lb_client_connections", "gauge", "Client connections currently open.",
+                   [({}, snap.opened - snap.closed)])
+        out.histogram("lb_request_duration_seconds", "Time from request head received to response relayed.",
+                      [({}, snap.duration)])
+        out.histogram("lb_queue_seconds", "Time from request head received until a backend was acquired.",
+                      [({}, snap.queue)])
+        out.histogram("lb_upstream_connect_seconds", "Time to open a new backend connection.",
+                      [({"backend": name}, h) for name, h in sorted(snap.connect.items())])
+        out.histogram("lb_backend_response_seconds", "Time until the backend's response head arrived.",
+                      [({"backend": name}, h) for name, h in sorted(snap.latency.items())])
+        out.metric("lb_backend_responses_total", "counter", "Backend exchanges by outcome (ok, 5xx, error).",
+                   [({"backend": name, "outcome": outcome}, n) for (name, outcome), n in sorted(snap.outcomes.items())])
+        out.metric("lb_backend_up", "gauge", "1 while the backend passes active health checks.",
+                   [({"backend": b.name}, int(b.healthy)) for b in self.backends])
+        out.metric("lb_backend_ejected", "gauge", "1 while passive outlier detection ejects the backend.",
+                   [({"backend": b.name}, int(b.ejected)) for b in self.backends])
+        out.metric("lb_backend_active_requests", "gauge", "Requests in flight per backend.",
+                   [({"backend": b.name}, self._index.connections(b)) for b in self.backends])
+        pools = [(b, b.pool.stats()) for b in self.backends]
+        out.metric("lb_pool_idle_connections", "gauge", "Idle keep-alive connections per backend pool.",
+                   [({"backend": b.name}, st["idle"]) for b, st in pools])
+        out.metric("lb_pool_max_idle_connections", "gauge", "Pool capacity per backend.",
+                   [({"backend": b.name}, b.pool.max_size) for b, _ in pools])
+        for key, help_text in (("created", "Backend connections opened."),
+                               ("reused", "Requests sent on a pooled connection."),
+                               ("evicted", "Pooled connections closed as idle or stale.")):
+            out.metric(f"lb_pool_{key}_total", "counter", help_text,
+                       [({"backend": b.name}, st[key]) for b, st in pools])
+        if self.cache is not None:
+            cs = self.cache.stats()
+            for key in ("hits", "misses", "revalidated", "coalesced", "stores", "evictions", "rejected"):
+                out.metric(f"lb_cache_{key}_total", "counter", f"Response cache {key}.", [({}, cs[key])])
+            out.metric("lb_cache_bytes", "gauge", "Bytes held by the response cache.", [({}, cs["bytes"])])
+        if self.admission is not None:
+            st = self.admission.stats()
+            out.metric("lb_admission_queue", "gauge", "Requests waiting for a backend slot.", [({}, st["queue"])])
+            out.metric("lb_admission_shed_total", "counter", "Requests answered 503 by admission control.",
+                       [({"reason": "queue_full"}, st["shed_full"]), ({"reason": "timeout"}, st["shed_timeout"])])
+            out.metric("lb_backend_concurrency_limit", "gauge", "Current in-flight limit per backend.",
+                       [({"backend": name}, lim["limit"]) for name, lim in st["limits"].items()])
+        if self.retry is not None:
+            st = self.retry.stats()
+            out.metric("lb_retries_total", "counter", "Failed requests sent again to another backend.",
+                       [({}, st["retries"])])
+            out.metric("lb_hedges_total", "counter", "Slow requests also sent to a second backend.",
+                       [({}, st["hedges"])])
+            out.metric("lb_hedge_wins_total", "counter", "Hedged requests answered by the second backend.",
+                       [({}, st["hedge_wins"])])
+            out.metric("lb_retry_budget_denied_total", "counter", "Retries and hedges refused by the retry budget.",
+                       [({}, st["budget_denied"])])
+        out.metric("lb_start_time_seconds", "gauge", "Unix time the load balancer started.",
+                   [({}, round(self.metrics.started, 3))])
+        return out.render()
+
+    def metrics_report(self):
+        """Human-readable metrics summary for the CLI; rates are since the previous report."""
+        snap = self.metrics.snapshot()
+        now, total = time.time(), sum(snap.codes.values())
+        last_time, last_total = self._report_mark
+        self._report_mark = (now, total)
+        rate = (total - last_total) / max(now - last_time, 1e-9)
+
+        def ms(hist, p):
+            return f"{hist.percentile(p) * 1000:.2f}ms" if hist is not None and hist.total else "-"
+
+        lines = [f"  requests: {total} ({rate:.1f}/s since last report)  codes: {dict(sorted(snap.codes.items()))}",
+                 f"  bytes in/out: {snap.bytes_in}/{snap.bytes_out}  open client connections: {snap.opened - snap.closed}",
+                 f"  request p50/p99: {ms(snap.duration, 50)}/{ms(snap.duration, 99)}"
+                 f"  queue p50/p99: {ms(snap.queue, 50)}/{ms(snap.queue, 99)}"]
+        for b in self.backends:
+            latency, connect = snap.latency.get(b.name), snap.connect.get(b.name)
+            outcomes = {o: n for (name, o), n in snap.outcomes.items() if name == b.name}
+            st = b.pool.stats()
+            lines.append(f"  {b.name}: response p50/p99 {ms(latency, 50)}/{ms(latency, 99)} {outcomes}"
+                         f"  connect p50 {ms(connect, 50)}  pool idle {st['idle']}/{b.pool.max_size}"
+                         f" created {st['created']} reused {st['reused']}")
+        if self.retry is not None:
+            lines.append(f"  retries/hedges: {self.retry.stats()}")
+        return "\n".join(lines)
+
+    def handle_client(self, client_sock: socket.socket, client_addr):
+        client_ip, client_port = client_addr[0], client_addr[1]
+        client_sock.settimeout(self.conn_timeout)
+        # heads and bodies go out in separate sends; don't let Nagle hold the second one back
+        client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = SocketReader(client_sock, self.relay_buffer_size)
+        splicer = Splicer(self.splice_threshold) if self.zero_copy else None
+        served = 0
+        self.metrics.connection_opened()
+        try:
+            while not self._stop.is_set():
+                request = self._recv_http_request(reader)
+                if not request:
+                    break
+                client_sock.settimeout(self.conn_timeout)
+                served += 1
+                keep_alive = request.keep_alive and served < self.max_requests_per_conn
+                if not self._proxy_request(client_ip, request, reader, client_sock, keep_alive, splicer):
+                    break
+                client_sock.settimeout(self.keepalive_timeout)
+        except ClientDisconnected:
+            pass
         except Exception as e:
           
             try:
-                client_sock.sendall(b"HTTP/1.1 500 Internal Server Error\r\nContent-Length: 21\r\n\r\nInternal Server Error")
+                client_sock.sendall(RESP_500)
             except Exception:
                 pass
             print(f"[lb] error handling client {client_ip}:{client_port} -> {e}")
         finally:
+            self.metrics.connection_closed()
+            if splicer is not None:
+                splicer.close()
             try:
                 client_sock.close()
             except Exception:
                 pass
 
-    def _recv_http_request(self, sock: socket.socket):
-        sock.settimeout(self.conn_timeout)
-        data = b""
-        headers = b""
-  
+    def _proxy_request(self, client_ip, request: RequestHead, reader: SocketReader,
+                       client_sock: socket.socket, keep_alive, splicer=None):
+        """Serve one request; returns True if the client connection can take another."""
+        if request.target.startswith(ADMIN_PREFIX):
+            length = request.content_length
+            body = reader.read_exact(length) if length <= ADMIN_MAX_BODY and not request.chunked else None
+            keep_alive = keep_alive and body is not None
+            return self._reply(client_sock, request, self._admin_response(client_ip, request, body, keep_alive),
+                               keep_alive)
+        if self.cache is not None and self.cache.accepts(request):
+            return self._proxy_cached(client_ip, request, reader, client_sock, keep_alive)
+        result = self._proxy_upstream(client_ip, request, reader, client_sock, keep_alive, splicer)
+        self._record(request, result.status, result.bytes)
+        return result.keep_alive
+
+    def _proxy_upstream(self, client_ip, request: RequestHead, reader: SocketReader, client,
+                        keep_alive, splicer=None, upstream=None):
+        """Relay one exchange through a chosen backend and return its RelayResult.
+
+        When no backend can answer, the LB sends 503/502 itself and the
+        result is marked failed. `upstream` replaces the request sent to
+        the backend (e.g. with cache validators).
+        """
+        backend, shed = self._admit(client_ip, request)
+        if not backend:
+            response, keep_open = self._refusal(shed, keep_alive and not request.has_body)
+            client.sendall(response)
+            return _failed(503, response, keep_open)
+
+        self.metrics.queued(time.monotonic() - request.received)
+        if self.retry is not None:
+            self.retry.budget.deposit()
+        tried, retried = [backend], 0
         while True:
+            hedge = self._hedge(request, tried)
+            result = None
             try:
-                chunk = sock.recv(4096)
-            except socket.timeout:
-                break
-            except Exception:
-                return None
-            if not chunk:
-                break
-            data += chunk
-            if b"\r\n\r\n" in data:
-                headers, rest = data.split(b"\r\n\r\n", 1)
-                headers += b"\r\n\r\n"
-                break
-         
-            if len(data) > 65536:
-                
-                return None
-        if not headers:
+                result = self._forward_to_backend(backend, upstream or request, reader, client, keep_alive,
+                                                  self._affinity_headers(request, backend), splicer, hedge)
+                self._observe(hedge.winner or backend if hedge else backend, result)
+            finally:
+                self._release(backend, result, hedge)
+            if result is not None:
+                return result
+            backend = self._retry_backend(request, tried, retried)
+            if backend is None:
+                client.sendall(RESP_502)
+                return _failed(502, RESP_502)
+            retried += 1
+
+    def _proxy_cached(self, client_ip, request: RequestHead, reader: SocketReader,
+                      client_sock: socket.socket, keep_alive):
+        """GET through the response cache: serve hits, coalesce misses, revalidate stale entries."""
+        cache = self.cache
+        key = cache.key(request)
+        entry, fresh = cache.lookup(key, request)
+        if fresh:
+            return self._reply(client_sock, request,
+                               cache.render(entry, request, "keep-alive" if keep_alive else "close"), keep_alive)
+        fill, leader = cache.begin_fill(key)
+        if not leader:
+            if fill.wait(self.backend_timeout) and fill.entry is not None:
+                return self._reply(client_sock, request,
+                                   cache.render(fill.entry, request, "keep-alive" if keep_alive else "close"),
+                                   keep_alive)
+            result = self._proxy_upstream(client_ip, request, reader, client_sock, keep_alive)
+            self._record(request, result.status, result.bytes)
+            return result.keep_alive
+
+        filled = None
+        try:
+            sink = CaptureSink(client_sock.sendall, cache.max_object_bytes)
+            result = self._proxy_upstream(client_ip, request, reader, sink, keep_alive,
+                                          upstream=cache.upstream_request(request, entry))
+            filled, response = self._complete_fill(key, request, entry, result, sink)
+            if response is not None:
+                return self._reply(client_sock, request, response, result.keep_alive)
+            self._record(request, result.status, result.bytes)
+            return result.keep_alive
+        finally:
+            cache.end_fill(key, fill, filled)
+
+    def _complete_fill(self, key, request: RequestHead, entry, result: RelayResult, sink: CaptureSink):
+        """Store or refresh from a captured upstream response.
+
+        Returns (entry, response): `response` is what the client should get
+        instead of the captured bytes (after a 304 revalidation), else None
+        and the captured bytes have been released to the client.
+        """
+        cache = self.cache
+        if sink.passthrough or result.failed:
+            sink.flush()
+            return None, None
+        if result.status == 304 and entry is not None:
+            cache.refresh(entry, result.headers)
+            return entry, cache.render(entry, request, "keep-alive" if result.keep_alive else "close")
+        filled = cache.store(key, result.version, result.status, result.headers, sink.body)
+        sink.flush()
+        return filled, None
+
+    def _recv_http_request(self, reader: SocketReader):
+        try:
+            head = reader.read_head(MAX_HEADER_BYTES)
+        except Exception:
+            return None
+        if not head:
+            return None
+        try:
+            return RequestHead.parse(head)
+        except ValueError:
             return None
 
-        header_text = headers.decode("iso-8859-1")
-        cl = 0
-        for line in header_text.split("\r\n"):
-            if line.lower().startswith("content-length:"):
+    def _upstream_head(self, request: RequestHead):
+        return request.serialize("keep-alive") if self.upstream_keepalive else request.raw
+
+    def _upstream_connect(self, backend: Backend):
+        s = backend.pool.acquire() if self.upstream_keepalive else None
+        if s is not None:
+            s.settimeout(self.backend_timeout)
+            return s, True
+        started = time.monotonic()
+        s = backend.pool.connect(self.backend_timeout)
+        self.metrics.connected(backend.name, time.monotonic() - started)
+        return s, False
+
+    def _forward_to_backend(self, backend: Backend, request: RequestHead,
+                            client_reader: SocketReader, client_sock: socket.socket, keep_alive=False,
+                            extra_headers=(), splicer=None, hedge=None):
+        """Stream request to backend and response back to the client.
+
+        Returns a RelayResult, or None if the backend failed before anything
+        reached the client (the caller answers 502). The response head is
+        rewritten so its Connection header matches `keep_alive`, and
+        `extra_headers` (e.g. an affinity cookie) are appended to it.
+        A pooled connection that turns out to be dead before any response
+        byte arrived is retried once on a fresh connection when the request
+        has no body to replay. With a Splicer, large Content-Length bodies in
+        either direction are moved socket to socket by the kernel. With a
+        Hedge, a backend that has not answered within `hedge.delay` gets raced
+        against a second one (see _race).
+        """
+        view = memoryview(bytearray(self.relay_buffer_size))
+        result = RelayResult()
+        started = time.monotonic()
+        head_sent = False
+        s = None
+        reusable = False
+        try:
+            head = self._upstream_head(request)
+            while True:
+                s, reused = self._upstream_connect(backend)
                 try:
-                    cl = int(line.split(":",1)[1].strip())
-                except Exception:
-                    cl = 0
+                    s.sendall(head)
+                    if request.chunked:
+                        relay_chunked(client_reader, s, view)
+                    else:
+                        relay_exact(client_reader, s, request.content_length, view, splicer)
+                    framer = ResponseFramer(request.method)
+                    if hedge is not None and hedge.backend is None:
+                        s, backend, reused = self._race(s, backend, reused, head, hedge)
+                    n = s.recv_into(view)
+                    if not n:
+                        raise ConnectionError("backend closed the connection without responding")
+                except ConnectionError:
+                    if reused and not request.has_body:
+                        s.close()
+                        s = None
+                        continue
+                    raise
                 break
-        body = rest if 'rest' in locals() else b''
-        to_read = cl - len(body)
-        while to_read > 0:
+
+            if not self.response_framing:
+                s.settimeout(1.0)
+            while True:
+                start, used = 0, n
+                if self.response_framing:
+                    used = framer.feed(view[:n])
+                    if not head_sent and framer.head is not None:
+                        connection = "keep-alive" if keep_alive and not framer.until_close else "close"
+                        response_head = framer.serialize_head(connection, extra_headers)
+                        try:
+                            client_sock.sendall(response_head)
+                        except OSError as e:
+                            raise ClientDisconnected() from e
+                        result.bytes += len(response_head)
+                        result.status, result.version, result.headers = framer.status, framer.version, framer.headers
+                        result.latency = time.monotonic() - started
+                        head_sent, start = True, framer.head_end
+                elif not head_sent:
+                    result.latency = time.monotonic() - started
+                    head_sent = True
+                if head_sent:
+                    try:
+                        client_sock.sendall(view[start:used])
+                    except OSError as e:
+                        raise ClientDisconnected() from e
+                    result.bytes += used - start
+                if splicer is not None and framer.body_remaining >= splicer.threshold:
+                    remaining = framer.body_remaining
+                    splicer.relay(s, client_sock, remaining, client=client_sock)
+                    framer.consume(remaining)
+                    result.bytes += remaining
+                if framer.done:
+                    break
+                try:
+                    n = s.recv_into(view)
+                except socket.timeout:
+                    if self.response_framing:
+                        raise
+                    break
+                if not n:
+                    if self.response_framing and not framer.eof():
+                        raise ConnectionError("backend closed before the response was complete")
+                    break
+            reusable = self.upstream_keepalive and framer.done and framer.keep_alive
+            result.keep_alive = keep_alive and self.response_framing and framer.done and not framer.until_close
+            return result
+        except ClientDisconnected:
+            raise
+        except Exception as e:
+            print(f"[lb] forward error to {backend.name}: {e}")
+            backend.pool.drain()
+            result.failed = True
+            return result if head_sent else None
+        finally:
+            if s is not None:
+                if reusable:
+                    backend.pool.release(s)
+                else:
+                    s.close()
+
+    def _race(self, s, backend: Backend, reused, head, hedge: Hedge):
+        """Wait `hedge.delay` for the first answer, then send the request to a second backend too.
+
+        Returns (socket, backend, reused) of whichever answers first; the
+        other request is abandoned and its socket closed.
+        """
+        if select.select([s], [], [], hedge.delay)[0]:
+            return s, backend, reused
+        other = hedge.start()
+        if other is None:
+            return s, backend, reused
+        hedge.backend = other
+        s2 = None
+        try:
+            s2, reused2 = self._upstream_connect(other)
+            s2.sendall(head)
+        except OSError as e:
+            print(f"[lb] hedge to {other.name} failed: {e}")
+            if s2 is not None:
+                s2.close()
+            return s, backend, reused
+        ready = select.select([s, s2], [], [], self.backend_timeout)[0]
+        if s2 in ready and s not in ready:
+            s.close()
+            hedge.winner = other
+            self.retry.hedge_wins += 1
+            return s2, other, reused2
+        s2.close()
+        hedge.winner = backend
+        return s, backend, reused
+
+    async def _serve_async(self):
+        server = await asyncio.start_server(
+            self._handle_client_async, self.listen_host, self.listen_port,
+            backlog=self.backlog, reuse_address=True, reuse_port=self.reuse_port or None,
+            limit=MAX_HEADER_BYTES)
+        async with server:
+            while not self._stop.is_set():
+                await asyncio.sleep(0.5)
+
+    async def _handle_client_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client_ip, client_port = writer.get_extra_info("peername")[:2]
+        if self.max_clients and self._async_clients >= self.max_clients:
+            writer.write(RESP_503)
+            writer.close()
+            self.metrics.exchange(503, 0, len(RESP_503), 0.0)
+            return
+        self._async_clients += 1
+        served = 0
+        timeout = self.conn_timeout
+        self.metrics.connection_opened()
+        try:
+            while not self._stop.is_set():
+                request = await self._recv_http_request_async(reader, timeout)
+                if not request:
+                    break
+                served += 1
+                keep_alive = request.keep_alive and served < self.max_requests_per_conn
+                if not await self._proxy_request_async(client_ip, request, reader, writer, keep_alive):
+                    break
+                timeout = self.keepalive_timeout
+        except ClientDisconnected:
+            pass
+        except Exception as e:
             try:
-                chunk = sock.recv(4096)
-            except socket.timeout:
-                break
+                writer.write(RESP_500)
+                await writer.drain()
             except Exception:
-                return None
+                pass
+            print(f"[lb] error handling client {client_ip}:{client_port} -> {e}")
+        finally:
+            self._async_clients -= 1
+            self.metrics.connection_closed()
+            writer.close()
+
+    async def _reply_async(self, writer: asyncio.StreamWriter, request: RequestHead, response, keep_alive):
+        writer.write(response)
+        await writer.drain()
+        self._record(request, int(response[9:12]), len(response))
+        return keep_alive
+
+    async def _proxy_request_async(self, client_ip, request: RequestHead, reader: asyncio.StreamReader,
+                                   writer: asyncio.StreamWriter, keep_alive):
+        if request.target.startswith(ADMIN_PREFIX):
+            length = request.content_length
+            body = await reader.readexactly(length) if length <= ADMIN_MAX_BODY and not request.chunked else None
+            keep_alive = keep_alive and body is not None
+            return await self._reply_async(writer, request, self._admin_response(client_ip, request, body, keep_alive),
+                                           keep_alive)
+        if self.cache is not None and self.cache.accepts(request):
+            return await self._proxy_cached_async(client_ip, request, reader, writer, keep_alive)
+        result = await self._proxy_upstream_async(client_ip, request, reader, writer, keep_alive)
+        self._record(request, result.status, result.bytes)
+        return result.keep_alive
+
+    async def _proxy_upstream_async(self, client_ip, request: RequestHead, reader: asyncio.StreamReader,
+                                    writer, keep_alive, upstream=None):
+        backend, shed = await self._admit_async(client_ip, request)
+        if not backend:
+            response, keep_open = self._refusal(shed, keep_alive and not request.has_body)
+            writer.write(response)
+            await writer.drain()
+            return _failed(503, response, keep_open)
+
+        self.metrics.queued(time.monotonic() - request.received)
+        if self.retry is not None:
+            self.retry.budget.deposit()
+        tried, retried = [backend], 0
+        while True:
+            hedge = self._hedge(request, tried)
+            result = None
+            try:
+                result = await self._forward_to_backend_async(backend, upstream or request, reader, writer,
+                                                              keep_alive, self._affinity_headers(request, backend),
+                                                              hedge)
+                self._observe(hedge.winner or backend if hedge else backend, result)
+            finally:
+                self._release(backend, result, hedge)
+            if result is not None:
+                return result
+            backend = self._retry_backend(request, tried, retried)
+            if backend is None:
+                writer.write(RESP_502)
+                await writer.drain()
+                return _failed(502, RESP_502)
+            retried += 1
+
+    async def _proxy_cached_async(self, client_ip, request: RequestHead, reader: asyncio.StreamReader,
+                                  writer: asyncio.StreamWriter, keep_alive):
+        cache = self.cache
+        key = cache.key(request)
+        entry, fresh = cache.lookup(key, request)
+        if fresh:
+            return await self._reply_async(
+                writer, request, cache.render(entry, request, "keep-alive" if keep_alive else "close"), keep_alive)
+        fill, leader = cache.begin_fill(key)
+        if not leader:
+            if await fill.wait_async(self.backend_timeout) and fill.entry is not None:
+                return await self._reply_async(
+                    writer, request, cache.render(fill.entry, request, "keep-alive" if keep_alive else "close"),
+                    keep_alive)
+            result = await self._proxy_upstream_async(client_ip, request, reader, writer, keep_alive)
+            self._record(request, result.status, result.bytes)
+            return result.keep_alive
+
+        filled = None
+        try:
+            sink = CaptureSink(writer.write, cache.max_object_bytes, writer.drain)
+            result = await self._proxy_upstream_async(client_ip, request, reader, sink, keep_alive,
+                                                      upstream=cache.upstream_request(request, entry))
+            filled, response = self._complete_fill(key, request, entry, result, sink)
+            if response is not None:
+                return await self._reply_async(writer, request, response, result.keep_alive)
+            await writer.drain()
+            self._record(request, result.status, result.bytes)
+            return result.keep_alive
+        finally:
+            cache.end_fill(key, fill, filled)
+
+    async def _recv_http_request_async(self, reader: asyncio.StreamReader, timeout):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+            return RequestHead.parse(head)
+        except Exception:
+            return None
+
+    async def _upstream_connect_async(self, loop, backend: Backend):
+        s = backend.pool.acquire() if self.upstream_keepalive else None
+        if s is not None:
+            s.setblocking(False)
+            return s, True
+        started = time.monotonic()
+        s = await backend.pool.connect_async(loop, self.backend_timeout)
+        self.metrics.connected(backend.name, time.monotonic() - started)
+        return s, False
+
+    async def _relay_body_async(self, loop, client_reader: asyncio.StreamReader, s, length):
+        remaining = length
+        while remaining > 0:
+            try:
+                chunk = await asyncio.wait_for(
+                    client_reader.read(min(remaining, self.relay_buffer_size)), self.conn_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise ClientDisconnected() from e
             if not chunk:
+                raise ClientDisconnected(f"client closed with {remaining} body bytes outstanding")
+            await loop.sock_sendall(s, chunk)
+            remaining -= len(chunk)
+
+    async def _relay_chunked_async(self, loop, client_reader: asyncio.StreamReader, s):
+        """Relay a chunked request body as is, reading only up to its terminating empty trailer line."""
+        async def line():
+            try:
+                return await asyncio.wait_for(client_reader.readuntil(b"\n"), self.conn_timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+                raise ClientDisconnected() from e
+
+        while True:
+            size_line = await line()
+            try:
+                size = parse_chunk_size(size_line)
+            except ValueError as e:
+                raise ClientDisconnected(str(e)) from e
+            await loop.sock_sendall(s, size_line)
+            if size == 0:
                 break
-            body += chunk
-            to_read = cl - len(body)
-        return headers + body
+            await self._relay_body_async(loop, client_reader, s, size + 2)
+        while True:
+            trailer = await line()
+            await loop.sock_sendall(s, trailer)
+            if trailer in (b"\r\n", b"\n"):
+                return
 
-    def _forward_to_backend(self, backend: Backend, request_bytes: bytes):
-        addr = (backend.host, backend.port)
+    async def _forward_to_backend_async(self, backend: Backend, request: RequestHead,
+                                        client_reader: asyncio.StreamReader,
+                                        client_writer: asyncio.StreamWriter, keep_alive=False,
+                                        extra_headers=(), hedge=None):
+        loop = asyncio.get_running_loop()
+        view = memoryview(bytearray(self.relay_buffer_size))
+        result = RelayResult()
+        started = time.monotonic()
+        head_sent = False
+        s = None
+        reusable = False
         try:
-            s = socket.create_connection(addr, timeout=self.backend_timeout)
-            s.settimeout(self.backend_timeout)
-          
-            s.sendall(request_bytes)
-            response = b""
-            last_recv = time.time()
+            head = self._upstream_head(request)
             while True:
-                ready = select.select([s], [], [], 0.5)
-                if ready[0]:
-                    chunk = s.recv(8192)
-                    if not chunk:
-                        break
-                    response += chunk
-                    last_recv = time.time()
-                else:
-                    if time.time() - last_recv > 1.0:
-                        break
-            s.close()
-            return response
+                s, reused = await self._upstream_connect_async(loop, backend)
+                try:
+                    await loop.sock_sendall(s, head)
+                    if request.chunked:
+                        await self._relay_chunked_async(loop, client_reader, s)
+                    else:
+                        await self._relay_body_async(loop, client_reader, s, request.content_length)
+                    framer = ResponseFramer(request.method)
+                    if hedge is not None and hedge.backend is None:
+                        s, backend, reused, n = await self._race_async(loop, s, backend, reused, head, view, hedge)
+                    else:
+                        n = await asyncio.wait_for(loop.sock_recv_into(s, view), self.backend_timeout)
+                    if not n:
+                        raise ConnectionError("backend closed the connection without responding")
+                except ConnectionError:
+                    if reused and not request.has_body:
+                        s.close()
+                        s = None
+                        continue
+                    raise
+                break
+
+            idle_timeout = self.backend_timeout if self.response_framing else 1.0
+            while True:
+                start, used = 0, n
+                if self.response_framing:
+                    used = framer.feed(view[:n])
+                    if not head_sent and framer.head is not None:
+                        connection = "keep-alive" if keep_alive and not framer.until_close else "close"
+                        response_head = framer.serialize_head(connection, extra_headers)
+                        client_writer.write(response_head)
+                        result.bytes += len(response_head)
+                        result.status, result.version, result.headers = framer.status, framer.version, framer.headers
+                        result.latency = time.monotonic() - started
+                        head_sent, start = True, framer.head_end
+                elif not head_sent:
+                    result.latency = time.monotonic() - started
+                    head_sent = True
+                if head_sent:
+                    try:
+                        client_writer.write(bytes(view[start:used]))
+                        await client_writer.drain()
+                    except OSError as e:
+                        raise ClientDisconnected() from e
+                    result.bytes += used - start
+                if framer.done:
+                    break
+                try:
+                    n = await asyncio.wait_for(loop.sock_recv_into(s, view), idle_timeout)
+                except asyncio.TimeoutError:
+                    if self.response_framing:
+                        raise
+                    break
+                if not n:
+                    if self.response_framing and not framer.eof():
+                        raise ConnectionError("backend closed before the response was complete")
+                    break
+            reusable = self.upstream_keepalive and framer.done and framer.keep_alive
+            result.keep_alive = keep_alive and self.response_framing and framer.done and not framer.until_close
+            return result
+        except ClientDisconnected:
+            raise
         except Exception as e:
             print(f"[lb] forward error to {backend.name}: {e}")
-            backend.healthy = False 
-            return None
+            backend.pool.drain()
+            result.failed = True
+            return result if head_sent else None
+        finally:
+            if s is not None:
+                if reusable:
+                    backend.pool.release(s)
+                else:
+                    s.close()
+
+    async def _race_async(self, loop, s, backend: Backend, reused, head, view, hedge: Hedge):
+        """_race for the event loop; also returns the first chunk's size, read into `view`."""
+        recv = asyncio.ensure_future(loop.sock_recv_into(s, view))
+        done, _ = await asyncio.wait((recv,), timeout=hedge.delay)
+        other = None if done else hedge.start()
+        if other is None:
+            return s, backend, reused, await asyncio.wait_for(recv, self.backend_timeout)
+        hedge.backend = other
+        s2 = None
+        try:
+            s2, reused2 = await self._upstream_connect_async(loop, other)
+            await loop.sock_sendall(s2, head)
+        except (OSError, asyncio.TimeoutError) as e:
+            print(f"[lb] hedge to {other.name} failed: {e}")
+            if s2 is not None:
+                s2.close()
+            return s, backend, reused, await asyncio.wait_for(recv, self.backend_timeout)
+        view2 = memoryview(bytearray(len(view)))
+        recv2 = asyncio.ensure_future(loop.sock_recv_into(s2, view2))
+        try:
+            done, _ = await asyncio.wait((recv, recv2), timeout=self.backend_timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            recv2.cancel()
+            s2.close()
+            raise
+        if recv2 in done and recv not in done and recv2.exception() is None:
+            recv.cancel()
+            s.close()
+            hedge.winner = other
+            self.retry.hedge_wins += 1
+            n = recv2.result()
+            view[:n] = view2[:n]
+            return s2, other, reused2, n
+        recv2.cancel()
+        s2.close()
+        hedge.winner = backend
+        return s, backend, reused, await asyncio.wait_for(recv, self.backend_timeout)
 
-def create_backends(num=3, start_port=9001, host="127.0.0.1"):
+
+def create_backends(num=3, start_port=9001, host="127.0.0.1", keepalive=True, delays=(), capacity=None):
+    """`delays` (seconds) are assigned to the backends in turn, cycling if there are fewer."""
     backends = []
     servers = []
     for i in range(num):
         port = start_port + i
-        srv = start_test_backend(host, port, server_id=f"BE-{i+1}")
+        delay = delays[i % len(delays)] if delays else 0.0
+        srv = start_test_backend(host, port, server_id=f"BE-{i+1}", keepalive=keepalive, delay=delay,
+                                 capacity=capacity)
         servers.append(srv)
         backends.append(Backend(host=host, port=port, name=f"BE-{i+1}"))
     return backends, servers
 
 def main():
-    backends, backend_servers = create_backends(num=3, start_port=9001, host="127.0.0.1")
-    hc = HealthChecker(backends, interval=5.0, timeout=2.0, use_http_health=True)
+    if sys.argv[1:2] == ["bench"]:
+        # the benchmark suite lives in lb_bench (which imports this module)
+        from lb_bench import main as bench_main
+        return bench_main(["suite"] + sys.argv[2:])
+    if sys.argv[1:2] == ["simulate"]:
+        from lb_sim import main as sim_main
+        sim_main(["queueing"] + sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser(description="Load Balancer Simulator",
+                                     epilog="'lb_simulator.py bench --help' for the load generator / algorithm benchmark, "
+                                            "'lb_simulator.py simulate --help' for the offline queueing simulation")
+    parser.add_argument("--engine", choices=ENGINES, default="threaded",
+                        help="client serving engine (default: threaded)")
+    parser.add_argument("--port", type=int, default=8080, help="listen port (default: 8080)")
+    parser.add_argument("--backends", type=int, default=3, help="number of test backends (default: 3)")
+    parser.add_argument("--algo", choices=sorted(ALGORITHMS), default="roundrobin",
+                        help="load-balancing algorithm (default: roundrobin)")
+    parser.add_argument("--zero-copy", action="store_true",
+                        help="splice large bodies socket to socket (Linux, threaded engine)")
+    parser.add_argument("--cache-mb", type=int, default=0,
+                        help="in-process GET response cache size in MB (default: 0, off)")
+    parser.add_argument("--max-conns", type=int, default=None,
+                        help="in-flight requests per backend; excess requests queue, then get 503")
+    parser.add_argument("--adaptive", choices=("aimd", "gradient"), default=None,
+                        help="adapt each backend's concurrency limit to its latency")
+    parser.add_argument("--queue-size", type=int, default=128, help="requests that may wait for a backend slot")
+    parser.add_argument("--queue-timeout", type=float, default=1.0, help="seconds a request may wait (default: 1.0)")
+    parser.add_argument("--max-clients", type=int, default=None,
+                        help="client connections served at once; more get an immediate 503")
+    parser.add_argument("--retries", type=int, default=1,
+                        help="retries of failed idempotent requests on another backend (default: 1)")
+    parser.add_argument("--hedge", action="store_true",
+                        help="send slow GET/HEAD requests to a second backend after the p95 latency")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="pre-forked worker processes sharing the port via SO_REUSEPORT (default: 1)")
+    parser.add_argument("--config", help="JSON backend list to watch; the pool follows every change to it")
+    parser.add_argument("--farm", help="JSON backend profiles (latency, errors, capacity, scripted failures) "
+                                       "served instead of the plain test backends; see lb_farm.py")
+    parser.add_argument("--farm-engine", choices=("threaded", "asyncio"), default=None,
+                        help="how the farm backends serve (default: the file's \"engine\", else threaded)")
+    args = parser.parse_args()
+
+    farm = None
+    if args.farm:
+        from lb_farm import BackendFarm, load_farm
+        profiles, engine = load_farm(args.farm)
+        farm = BackendFarm(profiles, start_port=9001, engine=args.farm_engine or engine or "threaded")
+        backends, backend_servers = farm.start(), farm.servers
+    else:
+        backends, backend_servers = create_backends(num=args.backends, start_port=9001, host="127.0.0.1")
+    if args.workers > 1:
+        from lb_workers import run_workers
+        run_workers(args, backends, backend_servers)
+        return
+    pool = BackendPool(backends)
+    hc = HealthChecker(pool, interval=5.0, timeout=2.0, use_http_health=True)
     hc.start()
-    lb = LoadBalancer(listen_host="127.0.0.1", listen_port=8080,
-                      backends=backends,
-                      algo="roundrobin",  
+    lb = LoadBalancer(listen_host="127.0.0.1", listen_port=args.port,
+                      backends=pool,
+                      algo=args.algo,
                       sticky_by_ip=False,
                       conn_timeout=10.0,
-                      backend_timeout=5.0)
+                      backend_timeout=5.0,
+                      engine=args.engine,
+                      zero_copy=args.zero_copy,
+                      cache_bytes=args.cache_mb * 1048576,
+                      max_connections=args.max_conns,
+                      adaptive_concurrency=args.adaptive,
+                      queue_size=args.queue_size,
+                      queue_timeout=args.queue_timeout,
+                      max_clients=args.max_clients,
+                      retries=args.retries,
+                      hedge=args.hedge)
     lb.start()
+    watcher = None
+    if args.config:
+        watcher = ConfigWatcher(args.config, lb.apply_config)
+        watcher.start()
 
-    print("\nSimulator running. Try: curl http://127.0.0.1:8080/\n")
-    print("Commands:\n  q     quit\n  mode rr|least   switch algorithm\n  sticky on|off   toggle sticky-by-ip\n  status          print backend status\n")
+    print(f"\nSimulator running. Try: curl http://127.0.0.1:{args.port}/\n")
+    print("Commands:\n  q     quit\n  mode rr|least|wrr|p2c   switch algorithm\n  mode hash [ip|<header>] consistent hash on client IP or a request header\n"
+          "  weight <backend> <n>    set a backend's weight\n  sticky on|off   toggle sticky-by-ip\n  sticky cookie [name]    cookie-based affinity\n  status          print backend status\n"
+          "  metrics         request rates, latency percentiles, pool use (also GET /__lb/metrics)\n"
+          "  farm            served/errors/in-flight per simulated backend (with --farm)\n"
+          "  add <port>      start a local test backend and add it\n  add <host:port> [weight] add a backend\n"
+          "  drain|undrain <backend>  stop/resume new requests to a backend\n"
+          "  remove <backend>         drain, then drop it once in-flight requests finish\n"
+          "  (the same over HTTP: GET/POST/PUT /__lb/backends, DELETE /__lb/backends/<b>)\n")
     try:
         while True:
-            cmd = input("> ").strip().lower()
+            raw = input("> ").strip()
+            cmd = raw.lower()
             if not cmd:
                 continue
             if cmd in ("q", "quit", "exit"):
                 break
             if cmd.startswith("mode"):
-                parts = cmd.split()
+                parts = raw.split()
                 if len(parts) >= 2:
-                    if parts[1] in ("rr", "roundrobin"):
-                        lb.algo = "roundrobin"
-                    elif parts[1] in ("least", "leastconn"):
-                        lb.algo = "leastconn"
-                    print(f"[cli] algorithm set to {lb.algo}")
+                    key = None
+                    if len(parts) >= 3:
+                        key = "ip" if parts[2].lower() == "ip" else f"header:{parts[2]}"
+                    try:
+                        desc = lb.set_algorithm(parts[1].lower(), hash_key=key)
+                    except ValueError as e:
+                        print(f"[cli] {e}")
+                        continue
+                    print(f"[cli] algorithm set to {desc}")
                 continue
-            if cmd.startswith("sticky"):
+            if cmd.startswith("weight"):
                 parts = cmd.split()
+                b = lb.pool.find(parts[1]) if len(parts) == 3 else None
+                if b is None or not parts[2].isdigit():
+                    print("usage: weight <backend> <n>")
+                    continue
+                b.weight = int(parts[2])
+                lb.set_algorithm(lb.algo)
+                print(f"[cli] {b.name} weight = {b.weight}")
+                continue
+            if cmd.startswith("sticky"):
+                parts = raw.split()
                 if len(parts) >= 2:
-                    if parts[1] in ("on", "true", "1"):
+                    mode = parts[1].lower()
+                    if mode == "cookie":
+                        lb.sticky_cookie = parts[2] if len(parts) >= 3 else "LBSTICKY"
+                    elif mode in ("on", "true", "1", "ip"):
+                        lb.sticky_cookie = None
                         lb.sticky_by_ip = True
                     else:
+                        lb.sticky_cookie = None
                         lb.sticky_by_ip = False
-                    print(f"[cli] sticky_by_ip = {lb.sticky_by_ip}")
+                    print(f"[cli] sticky = {lb.sticky_mode}")
+                continue
+            if cmd == "metrics":
+                print(lb.metrics_report())
+                continue
+            if cmd == "farm":
+                print(farm.report() if farm is not None else "[cli] no farm; start with --farm <profiles.json>")
+                continue
+            if cmd.startswith("add"):
+                parts = raw.split()
+                try:
+                    if len(parts) == 2 and parts[1].isdigit():
+                        port = int(parts[1])
+                        backend_servers.append(start_test_backend("127.0.0.1", port, f"BE-{port}", keepalive=True))
+                        lb.add_backend("127.0.0.1", port, f"BE-{port}")
+                    elif len(parts) in (2, 3) and ":" in parts[1]:
+                        (entry,) = parse_backends([parts[1]])
+                        lb.add_backend(entry["host"], entry["port"], weight=int(parts[2]) if len(parts) == 3 else 1)
+                    else:
+                        print("usage: add <port> | add <host:port> [weight]")
+                except (OSError, ValueError) as e:
+                    print(f"[cli] {e}")
+                continue
+            if cmd.split()[0] in ("drain", "undrain", "remove"):
+                parts = raw.split()
+                b = lb.pool.find(parts[1]) if len(parts) == 2 else None
+                if b is None:
+                    print(f"usage: {parts[0].lower()} <backend name or host:port>")
+                elif parts[0].lower() == "drain":
+                    lb.drain_backend(b)
+                elif parts[0].lower() == "undrain":
+                    lb.undrain_backend(b)
+                else:
+                    lb.remove_backend(b)
                 continue
             if cmd == "status":
-                for b in backends:
-                    print(f"  {b.name}: healthy={b.healthy} active={b.active_connections} last_checked={time.ctime(b.last_checked)}")
+                print(f"  algorithm: {lb.strategy.describe()}  sticky: {lb.sticky_mode} {lb.sticky_stats()}")
+                if lb.cache is not None:
+                    print(f"  cache: {lb.cache.stats()}")
+                if lb.admission is not None:
+                    print(f"  admission: {lb.admission.stats()}")
+                breakers = lb.outliers.stats() if lb.outliers else {}
+                for b in lb.backends:
+                    print(f"  {b.name}: healthy={b.healthy} weight={b.weight} active={b.active_connections}"
+                          f"{' draining' if b.draining else ''} last_checked={time.ctime(b.last_checked)}")
+                    if b.name in breakers:
+                        print(f"    outlier: {breakers[b.name]}")
                 continue
             print("unknown command")
     except KeyboardInterrupt:
         pass
     finally:
         print("shutting down...")
+        if watcher is not None:
+            watcher.stop()
         hc.stop()
         lb.stop()
         for s in backend_servers:
@@ -367,4 +1874,4 @@ def main():
         print("done.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,153 @@
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from lb_simulator import Backend, HealthChecker, LoadBalancer
+
+
+class SharedHealth:
+    """Backend health published by one HealthChecker and mirrored by every worker.
+
+    One byte per backend plus a generation counter live in shared memory.
+    The parent writes them from a Backend listener; workers poll the
+    counter (a single word read) and only copy the flags when it moved.
+    """
+
+    def __init__(self, backends, ctx):
+        self._flags = ctx.RawArray("b", [1 if b.healthy else 0 for b in backends])
+        self._generation = ctx.RawValue("Q", 0)
+        self._lock = ctx.Lock()
+
+    def publish(self, backends):
+        for i, b in enumerate(backends):
+            b.add_listener(lambda backend, i=i: self._set(i, backend.healthy))
+
+    def _set(self, i, healthy):
+        with self._lock:
+            self._flags[i] = 1 if healthy else 0
+            self._generation.value += 1
+
+    def follow(self, backends, stop, interval=0.05):
+        seen = None
+        while not stop.wait(interval):
+            generation = self._generation.value
+            if generation == seen:
+                continue
+            seen = generation
+            for i, b in enumerate(backends):
+                b.healthy = bool(self._flags[i])
+
+    def snapshot(self):
+        return list(self._flags)
+
+
+def _worker_main(worker_id, specs, health, stop, lb_kwargs):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent handles Ctrl-C and stops us
+    backends = [Backend(host, port, name, weight) for host, port, name, weight in specs]
+    for b, flag in zip(backends, health.snapshot()):
+        b.healthy = bool(flag)
+    threading.Thread(target=health.follow, args=(backends, stop), daemon=True).start()
+    lb = LoadBalancer(backends=backends, reuse_port=True, **lb_kwargs)
+    lb.start()
+    stop.wait()
+    lb.stop()
+
+
+class WorkerPool:
+    """Pre-forked LoadBalancer workers sharing one listen port through SO_REUSEPORT.
+
+    The kernel spreads incoming connections across the workers, so proxying
+    is no longer capped by a single GIL. Health checking stays in the
+    parent: its HealthChecker updates the `backends` given here and
+    SharedHealth mirrors each flip into every worker. Passive outlier
+    ejection, pools and sticky tables stay local to each worker.
+    Start the pool before any HealthChecker thread so workers fork cleanly.
+    """
+
+    def __init__(self, backends, workers=None, **lb_kwargs):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("SO_REUSEPORT is not available on this platform")
+        self.backends = backends
+        self.workers = workers or os.cpu_count() or 1
+        self.lb_kwargs = lb_kwargs
+        self._ctx = multiprocessing.get_context("fork")
+        self.health = SharedHealth(backends, self._ctx)
+        self._stop = self._ctx.Event()
+        self._specs = [(b.host, b.port, b.name, b.weight) for b in backends]
+        self._procs = []
+
+    def _spawn(self, worker_id):
+        proc = self._ctx.Process(target=_worker_main, daemon=True, name=f"lb-worker-{worker_id}",
+                                 args=(worker_id, self._specs, self.health, self._stop, self.lb_kwargs))
+        proc.start()
+        return proc
+
+    def start(self):
+        self.health.publish(self.backends)
+        self._procs = [self._spawn(i) for i in range(self.workers)]
+        print(f"[workers] {self.workers} workers sharing port {self.lb_kwargs.get('listen_port')}: "
+              f"{[p.pid for p in self._procs]}")
+
+    def respawn(self):
+        """Replace workers that died; returns how many were restarted."""
+        restarted = 0
+        for i, proc in enumerate(self._procs):
+            if not proc.is_alive() and not self._stop.is_set():
+                print(f"[workers] worker {i} (pid {proc.pid}) exited with {proc.exitcode}, restarting")
+                self._procs[i] = self._spawn(i)
+                restarted += 1
+        return restarted
+
+    def pids(self):
+        return [p.pid for p in self._procs if p.is_alive()]
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        deadline = time.time() + timeout
+        for proc in self._procs:
+            proc.join(max(0.0, deadline - time.time()))
+            if proc.is_alive():
+                proc.terminate()
+
+
+def run_workers(args, backends, backend_servers):
+    """Interactive loop for `lb_simulator.py --workers N`."""
+    pool = WorkerPool(backends, workers=args.workers, listen_host="127.0.0.1", listen_port=args.port,
+                      algo=args.algo, conn_timeout=10.0, backend_timeout=5.0, engine=args.engine,
+                      zero_copy=args.zero_copy, cache_bytes=args.cache_mb * 1048576,
+                      max_connections=args.max_conns, adaptive_concurrency=args.adaptive,
+                      queue_size=args.queue_size, queue_timeout=args.queue_timeout, max_clients=args.max_clients,
+                      retries=args.retries, hedge=args.hedge)
+    if args.config:
+        print("[workers] --config is ignored: the backend list is fixed when workers fork")
+    pool.start()
+    hc = HealthChecker(backends, interval=5.0, timeout=2.0, use_http_health=True)
+    hc.start()
+    print(f"\nSimulator running with {pool.workers} workers. Try: curl http://127.0.0.1:{args.port}/\n")
+    print("Commands:\n  q       quit\n  status  print backend health and worker pids\n")
+    try:
+        while True:
+            pool.respawn()
+            cmd = input("> ").strip().lower()
+            if not cmd:
+                continue
+            if cmd in ("q", "quit", "exit"):
+                break
+            if cmd == "status":
+                print(f"  workers: {pool.pids()}")
+                for b in backends:
+                    print(f"  {b.name}: healthy={b.healthy} last_checked={time.ctime(b.last_checked)}")
+                continue
+            print("unknown command (algorithm, weight and sticky changes need a single-process run)")
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        print("shutting down...")
+        hc.stop()
+        pool.stop()
+        for s in backend_servers:
+            s.shutdown()
+        print("done.")
@@ -2,6 +2,7 @@
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
 from urllib.parse import urlparse, parse_qs
+from collections import OrderedDict
 import sqlite3, json, time, threading, re, os, ssl, base64, html
 
 DB_FILE = "urls.db"
@@ -15,13 +16,16 @@ ADMIN_PASS = "secret"
 
 RATE_LIMIT_WINDOW = 60  
 RATE_LIMIT_MAX = 30     
+RATE_TABLE_MAX = 100000
 
 BASE62 = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
 
 _db_lock = threading.Lock()
 rate_lock = threading.Lock()
-rate_table = {} 
+# ip -> request timestamps, least recently seen first; idle ips expire, past RATE_TABLE_MAX the oldest go
+rate_table = OrderedDict()
+rate_stats = {"expired": 0, "evictions": 0}
 
 
 def base62_encode(n: int) -> str:
@@ -115,11 +119,25 @@ def enforce_rate_limit(ip):
     with rate_lock:
         timestamps = rate_table.get(ip, [])
         timestamps = [t for t in timestamps if now - t < RATE_LIMIT_WINDOW]
-        if len(timestamps) >= RATE_LIMIT_MAX:
-            return False
-        timestamps.append(now)
+        allowed = len(timestamps) < RATE_LIMIT_MAX
+        if allowed:
+            timestamps.append(now)
+        new = ip not in rate_table
         rate_table[ip] = timestamps
-        return True
+        # limited requests move the ip too, so one that keeps sending never holds up expiry at the front
+        rate_table.move_to_end(ip)
+        if new:
+            # the table only grows here; the front ip was seen longest ago, gone once its window is over
+            while rate_table:
+                oldest = next(iter(rate_table.values()))
+                if now - oldest[-1] < RATE_LIMIT_WINDOW:
+                    break
+                rate_table.popitem(last=False)
+                rate_stats["expired"] += 1
+            if len(rate_table) > RATE_TABLE_MAX:
+                rate_table.popitem(last=False)
+                rate_stats["evictions"] += 1
+        return allowed
 
 
 class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):